@@ -12,7 +12,9 @@ from collections import OrderedDict
 from polymorph.UI.command_parser import CommandParser
 from polymorph.UI.layerinterface import LayerInterface
 from polymorph.tlayer import TLayer
-from polymorph.interceptor import Interceptor
+from polymorph.interceptor import Interceptor, BYPASS_MARK
+from polymorph.metrics import MetricsExporter
+from polymorph.replay import Replayer, PcapRewriter
 from termcolor import colored
 import hexdump
 import os
@@ -51,7 +53,7 @@ class TemplateInterface(Interface):
     def run(self):
         """Runs the interface and waits for user input commands."""
         completer = WordCompleter(['show', 'name', 'layer', 'dump', 'layers',
-                                   'functions', 'intercept', 'timestamp', 'version',
+                                   'functions', 'conditions', 'rules', 'intercept', 'replay', 'rewrite', 'timestamp', 'version',
                                    'save', 'description', 'spoof', 'clear', 'back'])
         # Initialization of the command history
         history = FileHistory(join(self._polym_path, '.tinterface_history'))
@@ -86,10 +88,18 @@ class TemplateInterface(Interface):
                     self._layer(command)
                 elif command[0] in ['funcs', 'functions']:
                     self._function(command)
+                elif command[0] in ['conds', 'conditions']:
+                    self._condition(command)
+                elif command[0] == 'rules':
+                    self._rule(command)
                 elif command[0] in ["show", "s"]:
                     self._show(command)
                 elif command[0] in ["intercept", "i"]:
                     self._intercept(command)
+                elif command[0] == "replay":
+                    self._replay(command)
+                elif command[0] == "rewrite":
+                    self._rewrite(command)
                 elif command[0] in ["layers", "ls"]:
                     self._layers(command)
                 elif command[0] == "timestamp":
@@ -384,6 +394,196 @@ class TemplateInterface(Interface):
             ("options", options)
         ])
 
+    def _condition(self, command):
+        """Manages the conditions of a particular `Template`."""
+        if len(command) == 1:
+            self._t.show_conditions()
+            return
+        # Parsing the arguments
+        cp = CommandParser(TemplateInterface._condition_opts())
+        args = cp.parse(command)
+        if not args:
+            Interface._argument_error()
+            return
+        # Print the help
+        if args['-h']:
+            Interface.print_help(TemplateInterface._condition_help())
+        # Deletes a condition
+        elif args['-d']:
+            if args['-d'].isdecimal() and \
+                    int(args['-d']) in range(len(self._t.conditions())):
+                self._t.del_condition(int(args['-d']))
+                Interface._print_info("Condition %s deleted" % args['-d'])
+            else:
+                Interface._print_error(
+                    "The condition %s is not in the list" % args['-d'])
+        # Adds a condition
+        elif args['-l'] and args['-o'] and args['-v']:
+            value = args['-v']
+            if args['-o'] in ['in', 'range']:
+                value = value.split(",")
+            try:
+                self._t.add_condition(args['-l'], args['-o'], value,
+                                      field=args['-f'],
+                                      offset=args['-off'],
+                                      mask=args['-m'])
+            except (ValueError, KeyError, TypeError) as e:
+                Interface._print_error("Wrong condition: %s" % e)
+                return
+            Interface._print_info("Condition added")
+        else:
+            Interface._argument_error()
+
+    @staticmethod
+    def _condition_opts():
+        """Returns command options in a form that can be handled by the
+        command parser."""
+        opts = {"-h": {"type": bool,
+                       "default": False},
+                "-l": {"type": str,
+                       "default": None},
+                "-f": {"type": str,
+                       "default": None},
+                "-off": {"type": int,
+                         "default": 0},
+                "-o": {"type": str,
+                       "default": None},
+                "-v": {"type": str,
+                       "default": None},
+                "-m": {"type": str,
+                       "default": None},
+                "-d": {"type": str,
+                       "default": None}}
+        return opts
+
+    @staticmethod
+    def _condition_help():
+        """Builds the help for the condition commands."""
+        options = OrderedDict([
+            ("-h", "prints the help."),
+            ("-l", "name of the layer of the new condition"),
+            ("-f", "name of the field of the new condition"),
+            ("-off", "offset from the beginning of the layer, when no field "
+                     "is given"),
+            ("-o", "operator: eq, ne, in, range, mask or contains"),
+            ("-v", "value, comma separated for in and range, hexadecimal "
+                   "bytes for mask, contains and offsets"),
+            ("-m", "mask in hexadecimal for the mask operator"),
+            ("-d", "order number of an existing condition to be deleted")
+        ])
+        return OrderedDict([
+            ("name", "condition"),
+            ("usage", "condition [-option]"),
+            ("description",
+             ("Conditions that the packets must meet before the functions "
+              "are executed. They are compiled into a single matcher, the "
+              "packets that do not meet them are forwarded without running "
+              "any function.")),
+            ("options", options)
+        ])
+
+    def _rule(self, command):
+        """Manages the rules of a particular `Template`."""
+        if len(command) == 1:
+            self._t.show_rules()
+            return
+        # Parsing the arguments
+        cp = CommandParser(TemplateInterface._rule_opts())
+        args = cp.parse(command)
+        if not args:
+            Interface._argument_error()
+            return
+        # Print the help
+        if args['-h']:
+            Interface.print_help(TemplateInterface._rule_help())
+        # Deletes a rule
+        elif args['-d']:
+            if args['-d'].isdecimal() and \
+                    int(args['-d']) in range(len(self._t.rules())):
+                self._t.del_rule(int(args['-d']))
+                Interface._print_info("Rule %s deleted" % args['-d'])
+            else:
+                Interface._print_error(
+                    "The rule %s is not in the list" % args['-d'])
+        # Adds a rule
+        elif args['-a']:
+            conditions = None
+            if args['-if']:
+                cond = args['-if'].split(" ", 3)
+                if len(cond) != 4:
+                    Interface._print_error(
+                        "The condition must be: layer field operator value")
+                    return
+                conditions = [OrderedDict([
+                    ("layer", cond[0]), ("field", cond[1]), ("op", cond[2]),
+                    ("value", cond[3].split(",") if cond[2] in [
+                        'in', 'range'] else cond[3])])]
+            try:
+                self._t.add_rule(args['-a'], layer=args['-l'],
+                                 value=args['-v'], field=args['-f'],
+                                 offset=args['-off'], old=args['-old'],
+                                 count=args['-c'], conditions=conditions)
+            except (ValueError, KeyError, TypeError) as e:
+                Interface._print_error("Wrong rule: %s" % e)
+                return
+            Interface._print_info("Rule added")
+        else:
+            Interface._argument_error()
+
+    @staticmethod
+    def _rule_opts():
+        """Returns command options in a form that can be handled by the
+        command parser."""
+        opts = {"-h": {"type": bool,
+                       "default": False},
+                "-a": {"type": str,
+                       "default": None},
+                "-l": {"type": str,
+                       "default": None},
+                "-f": {"type": str,
+                       "default": None},
+                "-off": {"type": int,
+                         "default": 0},
+                "-v": {"type": str,
+                       "default": None},
+                "-old": {"type": str,
+                         "default": None},
+                "-c": {"type": int,
+                       "default": 0},
+                "-if": {"type": str,
+                        "default": None},
+                "-d": {"type": str,
+                       "default": None}}
+        return opts
+
+    @staticmethod
+    def _rule_help():
+        """Builds the help for the rule commands."""
+        options = OrderedDict([
+            ("-h", "prints the help."),
+            ("-a", "action of the new rule: set, add, replace, regex, "
+                   "replace_all or drop"),
+            ("-l", "name of the layer"),
+            ("-f", "name of the field"),
+            ("-off", "offset from the beginning of the layer, when no field "
+                     "is given"),
+            ("-v", "new value, hexadecimal bytes for offsets and replace, "
+                   "text for regex, name of a dictionary for replace_all"),
+            ("-old", "hexadecimal bytes replaced by replace, regular "
+                     "expression replaced by regex"),
+            ("-c", "maximum number of replacements, all by default"),
+            ("-if", "condition of the rule, \"layer field operator value\""),
+            ("-d", "order number of an existing rule to be deleted")
+        ])
+        return OrderedDict([
+            ("name", "rules"),
+            ("usage", "rules [-option]"),
+            ("description",
+             ("Rules that modify the packets directly before the functions "
+              "are executed, without running user code.")),
+            ("options", options)
+        ])
+
     def _show(self, command):
         """Pretty print the `Template` fields."""
         if len(command) == 1:
@@ -650,16 +850,62 @@ class TemplateInterface(Interface):
             Interface.print_help(TemplateInterface._intercept_help())
         # Add localhost iptables rule
         elif args["-localhost"]:
+            target = Interceptor.nfqueue_target(args["-q"],
+                                                queue_bypass=args["-ht"],
+                                                cpu_fanout=not args["-seq"])
+            match4, match6 = Interceptor.template_match(
+                self._t, args["-bpf"]) if not args["-all"] else ("", "")
             i = Interceptor(
                 self._t,
-                iptables_rule="iptables -I OUTPUT -j NFQUEUE --queue-num 1",
-                ip6tables_rule="ip6tables -I OUTPUT -j NFQUEUE --queue-num 1")
-            i.intercept()
+                iptables_rule="iptables -I OUTPUT %s-j NFQUEUE %s" % (
+                    match4, target) if match4 is not None else None,
+                ip6tables_rule="ip6tables -I OUTPUT %s-j NFQUEUE %s" % (
+                    match6, target) if match6 is not None else None,
+                queues=args["-q"], match_template=not args["-all"],
+                stats=args["-stats"], bpf=args["-bpf"],
+                tcp_seq=args["-seq"],
+                bypass_mark=BYPASS_MARK if args["-bypass"] else None,
+                **TemplateInterface._throughput_opts(args["-ht"]))
+            self._run_interceptor(i, args["-metrics"])
         # Adds a new iptables rule
-        elif args["-ipt"] or args["-ip6t"]:
+        else:
             i = Interceptor(self._t, iptables_rule=args["-ipt"],
-                            ip6tables_rule=args["-ip6t"])
-            i.intercept()
+                            ip6tables_rule=args["-ip6t"], queues=args["-q"],
+                            match_template=not args["-all"],
+                            stats=args["-stats"], bpf=args["-bpf"],
+                            tcp_seq=args["-seq"],
+                            bypass_mark=BYPASS_MARK if args["-bypass"]
+                            else None,
+                            **TemplateInterface._throughput_opts(args["-ht"]))
+            self._run_interceptor(i, args["-metrics"])
+
+    def _run_interceptor(self, interceptor, metrics=None):
+        """Intercepts packets, exporting the metrics of the `Interceptor`
+        and of the ARP poisoner if an address is given."""
+        exporter = None
+        if metrics:
+            exporter = MetricsExporter(interceptor, self._poisoner, metrics)
+            try:
+                exporter.start()
+            except OSError as e:
+                Interface._print_error(
+                    "The metrics endpoint could not be started: %s" % e)
+                return
+            Interface._print_info("Metrics exported on %s" % metrics)
+        try:
+            interceptor.intercept()
+        finally:
+            if exporter:
+                exporter.stop()
+
+    @staticmethod
+    def _throughput_opts(enabled):
+        """Returns the options of the `Interceptor` for high throughput."""
+        if not enabled:
+            return {}
+        return {"max_len": 65536,
+                "sock_len": 16 * 1024 * 1024,
+                "queue_bypass": True}
 
     @staticmethod
     def _intercept_help():
@@ -668,7 +914,23 @@ class TemplateInterface(Interface):
             ("-h", "prints the help."),
             ("-ipt", "iptables rule for ipv4"),
             ("-ip6t", "iptables rule for ipv6"),
-            ("-localhost", "intercept in localhost")
+            ("-localhost", "intercept in localhost"),
+            ("-q", "number of queues, each one served by its own process"),
+            ("-all", "intercept all the packets, not only the ones with the "
+                     "protocol and ports of the template"),
+            ("-ht", "high throughput, larger queues and socket buffers and "
+                    "packets accepted while no interceptor is bound to the "
+                    "queues (packets are still dropped if a queue is full)"),
+            ("-stats", "records the latency of the functions, shown on exit "
+                       "and on SIGUSR1"),
+            ("-metrics", "exports the metrics in the Prometheus format on "
+                         "host:port or unix:/path"),
+            ("-bpf", "filters the packets with the conditions of the "
+                     "template in the kernel, with the iptables bpf match"),
+            ("-seq", "translates the sequence numbers of the TCP "
+                     "connections whose packets change their length"),
+            ("-bypass", "stops intercepting the connections of the packets "
+                        "with the bypass flag, with CONNMARK rules")
         ])
         return OrderedDict([
             ("name", "intercept"),
@@ -684,12 +946,148 @@ class TemplateInterface(Interface):
         opts = {"-h": {"type": bool,
                        "default": False},
                 "-ipt": {"type": str,
-                         "default": "iptables -A FORWARD -j NFQUEUE --queue-num 1"},
+                         "default": None},
                 "-ip6t": {"type": str,
-                          "default": "ip6tables -A FORWARD -j NFQUEUE --queue-num 1"},
+                          "default": None},
                 "-localhost": {"type": bool,
-                               "default": False}}
+                               "default": False},
+                "-q": {"type": int,
+                       "default": 1},
+                "-all": {"type": bool,
+                         "default": False},
+                "-ht": {"type": bool,
+                        "default": False},
+                "-stats": {"type": bool,
+                           "default": False},
+                "-metrics": {"type": str,
+                             "default": None},
+                "-bpf": {"type": bool,
+                         "default": False},
+                "-seq": {"type": bool,
+                         "default": False},
+                "-bypass": {"type": bool,
+                            "default": False}}
+
+        return opts
+
+    def _replay(self, command):
+        """Replays the packets of a pcap file through the functions of the
+        `Template`."""
+        # Parsing arguments
+        cp = CommandParser(TemplateInterface._replay_opts())
+        args = cp.parse(command)
+        if not args:
+            Interface._argument_error()
+            return
+        # Print the help
+        if args["-h"] or not args["-f"]:
+            Interface.print_help(TemplateInterface._replay_help())
+            return
+        if not os.path.isfile(args["-f"]):
+            Interface._print_error("The file %s does not exist" % args["-f"])
+            return
+        r = Replayer(self._t, stats=args["-stats"])
+        try:
+            r.replay(args["-f"], args["-o"], args["-c"])
+        except ValueError as e:
+            Interface._print_error(str(e))
+            return
+        r.show()
+        if args["-o"]:
+            Interface._print_info("Packets written to %s" % args["-o"])
+
+    @staticmethod
+    def _replay_help():
+        """Builds the help for the replay command."""
+        options = OrderedDict([
+            ("-h", "prints the help."),
+            ("-f", "pcap file with the packets to replay"),
+            ("-o", "pcap file where the forwarded packets are written"),
+            ("-c", "maximum number of packets to replay"),
+            ("-stats", "shows the latency of every function")
+        ])
+        return OrderedDict([
+            ("name", "replay"),
+            ("usage", "replay -f <pcap> [-option]"),
+            ("description", "Runs the functions of the template on the "
+                            "packets of a pcap file, without intercepting, "
+                            "and measures their latency."),
+            ("options", options)
+        ])
 
+    @staticmethod
+    def _replay_opts():
+        """Returns command options in a form that can be handled by the
+        command parser."""
+        opts = {"-h": {"type": bool,
+                       "default": False},
+                "-f": {"type": str,
+                       "default": None},
+                "-o": {"type": str,
+                       "default": None},
+                "-c": {"type": int,
+                       "default": None},
+                "-stats": {"type": bool,
+                           "default": False}}
+        return opts
+
+    def _rewrite(self, command):
+        """Applies the functions of the `Template` to the packets of a pcap
+        file and writes the result to another pcap file."""
+        # Parsing arguments
+        cp = CommandParser(TemplateInterface._rewrite_opts())
+        args = cp.parse(command)
+        if not args:
+            Interface._argument_error()
+            return
+        # Print the help
+        if args["-h"] or not args["-f"] or not args["-o"]:
+            Interface.print_help(TemplateInterface._rewrite_help())
+            return
+        if not os.path.isfile(args["-f"]):
+            Interface._print_error("The file %s does not exist" % args["-f"])
+            return
+        try:
+            res = PcapRewriter(self._t, workers=args["-w"]).rewrite(
+                args["-f"], args["-o"])
+        except ValueError as e:
+            Interface._print_error(str(e))
+            return
+        Interface._print_info(
+            "%d packets written to %s (%d dropped) in %.1f seconds" % (
+                res["written"], args["-o"], res["dropped"],
+                res["elapsed"] / 1e9))
+
+    @staticmethod
+    def _rewrite_help():
+        """Builds the help for the rewrite command."""
+        options = OrderedDict([
+            ("-h", "prints the help."),
+            ("-f", "pcap file with the packets to rewrite"),
+            ("-o", "pcap file where the packets are written"),
+            ("-w", "number of worker processes, by default one per CPU")
+        ])
+        return OrderedDict([
+            ("name", "rewrite"),
+            ("usage", "rewrite -f <pcap> -o <pcap> [-option]"),
+            ("description", "Applies the functions of the template to the "
+                            "packets of a pcap file, in parallel and "
+                            "preserving their order."),
+            ("options", options)
+        ])
+
+    @staticmethod
+    def _rewrite_opts():
+        """Returns command options in a form that can be handled by the
+        command parser."""
+        opts = {"-h": {"type": bool,
+                       "default": False},
+                "-f": {"type": str,
+                       "default": None},
+                "-o": {"type": str,
+                       "default": None},
+                "-w": {"type": int,
+                       "default": None}}
         return opts
 
     def _layers(self, command):
@@ -0,0 +1,179 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import array
+import re
+
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton that finds a whole dictionary of byte patterns
+    in a single pass over the data, whatever the number of patterns. The
+    transitions are precomputed in a table of 256 entries per state, so
+    every byte costs a single lookup."""
+
+    def __init__(self, patterns):
+        """Initialization method of the `AhoCorasick` class.
+
+        Parameters
+        ----------
+        patterns : :obj:`dict`
+            Dictionary of the form {pattern: replacement} with the patterns
+            and their replacements in bytes.
+
+        """
+        patterns = {bytes(p): bytes(r) for p, r in patterns.items() if p}
+        if not patterns:
+            raise ValueError("At least one non empty pattern is required")
+        # Trie of the patterns, the state 0 is the root
+        children = [{}]
+        for pattern in patterns:
+            state = 0
+            for byte in pattern:
+                if byte not in children[state]:
+                    children[state][byte] = len(children)
+                    children.append({})
+                state = children[state][byte]
+        nstates = len(children)
+        # Depth of every state and length of the longest pattern that ends
+        # in it, following the failure links
+        self._depth = array.array("H", bytes(2 * nstates))
+        self._out = array.array("H", bytes(2 * nstates))
+        self._replacements = {}
+        for pattern, repl in patterns.items():
+            state = 0
+            for byte in pattern:
+                state = children[state][byte]
+            self._out[state] = len(pattern)
+            self._replacements[pattern] = repl
+        # The transitions of a state are the ones of its failure state
+        # except for its children, the states are visited breadth first
+        table = array.array("I", bytes(4 * 256 * nstates))
+        for byte, child in children[0].items():
+            table[byte] = child
+        queue = list(children[0].values())
+        fail = [0] * nstates
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            f = fail[state]
+            if not self._out[state]:
+                self._out[state] = self._out[f]
+            row = state << 8
+            table[row:row + 256] = table[f << 8:(f << 8) + 256]
+            for byte, child in children[state].items():
+                table[row | byte] = child
+                fail[child] = table[(f << 8) | byte]
+                queue.append(child)
+        # The depth of a state is the length of its prefix
+        for state in [0] + queue:
+            for child in children[state].values():
+                self._depth[child] = self._depth[state] + 1
+        self._table = table
+        # Bytes that start some pattern, the automaton jumps to them while
+        # it is in the root state
+        self._first = re.compile(b"[" + b"".join(
+            re.escape(bytes([b])) for b in sorted(children[0])) + b"]")
+
+    def __len__(self):
+        return len(self._replacements)
+
+    def finditer(self, data, start=0):
+        """Finds the patterns that appear in some data, choosing the
+        leftmost and then the longest one when they overlap.
+
+        Parameters
+        ----------
+        data : :obj:`bytes`
+            Data in which the patterns are searched.
+        start : int
+            Position from which the data are searched.
+
+        Yields
+        ------
+        :obj:`tuple`
+            Tuples (start, stop) with the position of each match, without
+            overlapping and in order.
+
+        """
+        table, out, depth = self._table, self._out, self._depth
+        search = self._first.search
+        n = len(data)
+        i = start
+        state = 0
+        while True:
+            # The automaton is followed until some pattern ends
+            while i < n:
+                if not state:
+                    m = search(data, i)
+                    if m is None:
+                        return
+                    i = m.start()
+                state = table[state << 8 | data[i]]
+                i += 1
+                if out[state]:
+                    break
+            else:
+                return
+            cand_start, cand_stop = i - out[state], i
+            # The match is final when no pattern being followed can start
+            # before it or at its position, until then it can be replaced
+            # by a match that starts before or a longer one
+            while i < n and i - depth[state] <= cand_start:
+                state = table[state << 8 | data[i]]
+                i += 1
+                length = out[state]
+                if length and i - length <= cand_start:
+                    cand_start, cand_stop = i - length, i
+            yield cand_start, cand_stop
+            # The search continues after the match
+            i, state = cand_stop, 0
+
+    def replace(self, data, start=0):
+        """Replaces the patterns that appear in some data.
+
+        Parameters
+        ----------
+        data : :obj:`bytes`
+            Data in which the patterns are replaced.
+        start : int
+            Position from which the data are searched.
+
+        Returns
+        -------
+        :obj:`tuple`
+            The new data and the number of replacements.
+
+        """
+        pieces = []
+        pos = 0
+        replacements = self._replacements
+        for mstart, mstop in self.finditer(data, start):
+            pieces.append(data[pos:mstart])
+            pieces.append(replacements[bytes(data[mstart:mstop])])
+            pos = mstop
+        if not pieces:
+            return bytes(data), 0
+        pieces.append(data[pos:])
+        return b"".join(pieces), len(pieces) // 2
+
+    def matches(self, data, start=0):
+        """Returns the matches of some data with their replacements.
+
+        Parameters
+        ----------
+        data : :obj:`bytes`
+            Data in which the patterns are searched.
+        start : int
+            Position from which the data are searched.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`tuple`
+            Tuples (start, stop, replacement).
+
+        """
+        replacements = self._replacements
+        return [(s, e, replacements[bytes(data[s:e])])
+                for s, e in self.finditer(data, start)]
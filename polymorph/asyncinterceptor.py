@@ -0,0 +1,186 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+from polymorph.interceptor import Interceptor, _ip_length, PACKETS, BYTES, \
+    DROPPED
+from polymorph.packet import Packet
+import asyncio
+import inspect
+import platform
+import signal
+
+
+class AsyncInterceptor(Interceptor):
+    """Interceptor that serves the nfqueue queue from an asyncio event loop,
+    so that other tasks can run in the same process while intercepting.
+    The functions of the `Template` can be coroutines."""
+
+    def __init__(self, template, **kwargs):
+        """Initialization method of the `AsyncInterceptor` class.
+
+        Parameters
+        ----------
+        template : :obj:`Template`
+            A `Template` objet that will be parsed to obtain the custom functions
+            and other values.
+        **kwargs
+            Options of the `Interceptor`. Only one queue is supported.
+
+        """
+        if kwargs.get("queues", 1) > 1:
+            raise ValueError("AsyncInterceptor serves a single queue")
+        super().__init__(template, **kwargs)
+        self._coroutines = [inspect.iscoroutinefunction(f)
+                            for f in self._functions]
+        # `Packet` objects that are not being used by any task, each packet
+        # being processed by a task needs its own buffer
+        self._free = []
+        # Identities of the `Packet` objects of the free list that wait in
+        # `_pending` to be reassembled, they are recycled afterwards
+        self._reassembling = set()
+        self._tasks = set()
+        self._loop = None
+
+    def linux_modify(self, packet):
+        """This is the callback method that will be called when a packet
+        is intercepted. If no function of the `Template` is a coroutine, the
+        packet is processed immediately, otherwise a task is created.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+
+        """
+        if not any(self._coroutines):
+            super().linux_modify(packet)
+            return
+        # The verdict is issued after the callback returns
+        packet.retain()
+        task = self._loop.create_task(self._modify(packet))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _modify(self, packet):
+        """Executes the functions of the `Template` on a packet, awaiting the
+        functions that are coroutines, and issues its verdict.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+
+        """
+        current = self._free.pop() if self._free else Packet(self._template)
+        try:
+            payload = packet.get_payload()
+            current.load(payload)
+            self._counters[PACKETS] += 1
+            self._counters[BYTES] += _ip_length(current._buf) \
+                if self.copy_range else len(payload)
+            if self._match and not self._match(current._buf,
+                                               current._shifts):
+                self._linux_forward(packet, current, len(payload),
+                                    rec_chksums=False)
+                return
+            pkt = current
+            for function, coroutine in zip(self._functions, self._coroutines):
+                result = function(pkt)
+                if coroutine:
+                    result = await result
+                # If the function returns None, it is not held and the
+                # packet must be forwarded
+                if not result:
+                    self._linux_forward(packet, pkt, len(payload),
+                                        rec_chksums=False)
+                    return
+                # if the drop flag is activated, the packet is dropped
+                if result.drop:
+                    self._counters[DROPPED] += 1
+                    packet.drop()
+                    return
+                pkt = result
+            self._linux_forward(packet, pkt, len(payload), rec_chksums=True)
+        except Exception as e:
+            # The packet was retained, it is forwarded so that it does not
+            # stay in the queue
+            print("[!] Error processing a packet: %r" % e)
+            try:
+                packet.accept()
+            except RuntimeError:
+                # The verdict had already been issued
+                pass
+        finally:
+            # A truncated packet keeps its `Packet` until the whole packet
+            # is received in the reassembly queue
+            if self.copy_range and any(entry[0] is current for entry in
+                                       self._pending.values()):
+                self._reassembling.add(id(current))
+            else:
+                self._free.append(current)
+
+    def linux_reassemble(self, packet):
+        """This is the callback method of the queues that receive the whole
+        content of the truncated packets that have been modified. The
+        `Packet` used for the packet is returned to the free list.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+
+        """
+        pending = self._pending.get(packet.get_mark() & 0xfff)
+        super().linux_reassemble(packet)
+        if pending and id(pending[0]) in self._reassembling:
+            self._reassembling.discard(id(pending[0]))
+            self._free.append(pending[0])
+
+    def _defer(self, packet, delay, condition, timeout):
+        """Holds a nfqueue packet whose verdict will be issued later,
+        scheduling the ticks of the wheel in the event loop."""
+        ticking = len(self._timers) > 0
+        super()._defer(packet, delay, condition, timeout)
+        if not ticking:
+            self._loop.call_later(self._timers.tick, self._tick)
+
+    def _tick(self):
+        """Advances the wheel of held packets while it is not empty."""
+        self._release()
+        if len(self._timers):
+            self._loop.call_later(self._timers.tick, self._tick)
+
+    async def serve(self):
+        """Intercepts packets until the task is cancelled. The iptables
+        rules are set when the queue is ready and cleaned on exit."""
+        self._loop = asyncio.get_running_loop()
+        nfqueues = self._bind(self._queue_num)
+        for nfqueue in nfqueues:
+            self._loop.add_reader(nfqueue.get_fd(), nfqueue.run, False)
+        if self._stats:
+            self._loop.add_signal_handler(signal.SIGUSR1, self.show_stats)
+        try:
+            self.set_iptables_rules()
+            await self._loop.create_future()
+        finally:
+            for nfqueue in nfqueues:
+                self._loop.remove_reader(nfqueue.get_fd())
+            self.clean_iptables()
+            for task in list(self._tasks):
+                task.cancel()
+            for nfqueue in nfqueues:
+                nfqueue.unbind()
+
+    def intercept(self):
+        """This method intercepts the packets and send them to a callback
+        function, running an event loop until the user stops it."""
+        if platform.system() != "Linux":
+            print("Sorry. Platform not supported!\n")
+            return
+        print("[*] Waiting for packets...\n\n(Press Ctrl-C to exit)\n")
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.show_queue_stats()
+            self.show_stats()
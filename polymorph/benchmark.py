@@ -0,0 +1,425 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+"""Benchmarks of the hot path of polymorph.
+
+Usage::
+
+    python -m polymorph.benchmark run -o baseline.json
+    python -m polymorph.benchmark run -o current.json
+    python -m polymorph.benchmark compare baseline.json current.json
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+from collections import OrderedDict
+from time import perf_counter_ns
+from texttable import Texttable
+from scapy.all import Ether, IP, TCP, UDP, Raw
+from polymorph.converter import Converter
+from polymorph.ftype import Ftype
+from polymorph.interceptor import Interceptor
+from polymorph.packet import Packet
+from polymorph.pcap import PcapWriter
+from polymorph.replay import ReplayPacket
+from polymorph.template import Template
+from polymorph.tfield import TField
+from polymorph.tlayer import TLayer
+
+# Version of the format of the results
+FORMAT_VERSION = 1
+
+# Relative slowdown above which a benchmark is a regression
+DEFAULT_THRESHOLD = 0.10
+
+# Fields of the synthetic templates of the form
+# (layer, name, start, size, type, mask), positions relative to the
+# beginning of the Ethernet layer
+_IP_FIELDS = [("IP", "version", 14, 1, Ftype.FT_BIN_BE, 0xf0),
+              ("IP", "hdr_len", 14, 1, Ftype.FT_BIN_BE, 0x0f),
+              ("IP", "len", 16, 2, Ftype.FT_INT_BE, None),
+              ("IP", "ttl", 22, 1, Ftype.FT_INT_BE, None),
+              ("IP", "proto", 23, 1, Ftype.FT_INT_BE, None),
+              ("IP", "checksum", 24, 2, Ftype.FT_HEX, None),
+              ("IP", "src", 26, 4, Ftype.FT_IPv4, None),
+              ("IP", "dst", 30, 4, Ftype.FT_IPv4, None)]
+_L4_FIELDS = {"tcp": [("TCP", "srcport", 34, 2, Ftype.FT_INT_BE, None),
+                      ("TCP", "dstport", 36, 2, Ftype.FT_INT_BE, None),
+                      ("TCP", "seq", 38, 4, Ftype.FT_INT_BE, None),
+                      ("TCP", "ack", 42, 4, Ftype.FT_INT_BE, None),
+                      ("TCP", "flags.syn", 46, 2, Ftype.FT_BIN_BE, 0x0002),
+                      ("TCP", "checksum", 50, 2, Ftype.FT_HEX, None)],
+              "udp": [("UDP", "srcport", 34, 2, Ftype.FT_INT_BE, None),
+                      ("UDP", "dstport", 36, 2, Ftype.FT_INT_BE, None),
+                      ("UDP", "length", 38, 2, Ftype.FT_INT_BE, None),
+                      ("UDP", "checksum", 40, 2, Ftype.FT_HEX, None)]}
+
+# Samples used to benchmark the codecs of the `Converter`, of the form
+# (type, bytes, mask)
+_CODEC_SAMPLES = [(Ftype.FT_INT_BE, b"\x1f\x90", None),
+                  (Ftype.FT_INT_LE, b"\x90\x1f", None),
+                  (Ftype.FT_STRING, b"polymorph", None),
+                  (Ftype.FT_BYTES, b"\x00" * 16, None),
+                  (Ftype.FT_BIN_BE, b"\x50\x18", 0x0fc0),
+                  (Ftype.FT_BIN_LE, b"\x18\x50", 0x0fc0),
+                  (Ftype.FT_HEX, b"\xbe\xef", None),
+                  (Ftype.FT_ETHER, b"\x00\x0c\x29\xaa\xbb\xcc", None),
+                  (Ftype.FT_IPv4, b"\x0a\x00\x00\x01", None),
+                  (Ftype.FT_IPv6, b"\xfe\x80" + b"\x00" * 13 + b"\x01",
+                   None),
+                  (Ftype.FT_EUI64, b"\x01\x02\x03\x04\x05\x06\x07\x08",
+                   None)]
+
+
+def synthetic_packet(proto="tcp", payload=b"A" * 64):
+    """Builds an Ethernet/IPv4 packet with valid checksums.
+
+    Parameters
+    ----------
+    proto : :obj:`str`
+        'tcp' or 'udp'.
+    payload : :obj:`bytes`
+        Payload of the upper layer.
+
+    Returns
+    -------
+    :obj:`bytes`
+        The packet, including the Ethernet layer.
+
+    """
+    l4 = TCP(sport=40000, dport=80, flags="PA") if proto == "tcp" \
+        else UDP(sport=40000, dport=53)
+    return bytes(Ether(src="00:0c:29:00:00:01", dst="00:0c:29:00:00:02") /
+                 IP(src="10.0.0.1", dst="10.0.0.2") / l4 / Raw(payload))
+
+
+def synthetic_template(proto="tcp", payload=b"A" * 64):
+    """Builds a `Template` of an Ethernet/IPv4/TCP or UDP packet.
+
+    Parameters
+    ----------
+    proto : :obj:`str`
+        'tcp' or 'udp'.
+    payload : :obj:`bytes`
+        Payload of the upper layer.
+
+    Returns
+    -------
+    :obj:`Template`
+        The `Template`, with the layers ETH, IP, TCP or UDP and RAW.
+
+    """
+    raw = synthetic_packet(proto, payload)
+    template = Template("Benchmark %s" % proto, raw=raw,
+                        description="Synthetic template of the benchmarks")
+    l4 = 54 if proto == "tcp" else 42
+    layers = OrderedDict([("ETH", TLayer("ETH", raw, slice(0, 14))),
+                          ("IP", TLayer("IP", raw, slice(14, 34))),
+                          (proto.upper(),
+                           TLayer(proto.upper(), raw, slice(34, l4))),
+                          ("RAW", TLayer("RAW", raw, slice(l4, len(raw))))])
+    fields = _IP_FIELDS + _L4_FIELDS[proto] + \
+        [("RAW", "load", l4, len(payload), Ftype.FT_BYTES, None)]
+    for lname, fname, start, size, ftype, mask in fields:
+        layer = layers[lname]
+        layer.addfield(TField(fname=fname, fslice=slice(start, start + size),
+                              fsize=size, pkt_raw=raw, trepr="", ttype=None,
+                              tmask=mask, layer=layer, ftype=ftype))
+    for layer in layers.values():
+        template.addlayer(layer)
+    return template
+
+
+def synthetic_pcap(path, count=1000, proto="tcp", payload=b"A" * 64):
+    """Writes a pcap file with packets of a synthetic connection whose
+    source port changes in every packet."""
+    raw = bytearray(synthetic_packet(proto, payload))
+    with PcapWriter(path) as w:
+        for n in range(count):
+            raw[34:36] = (1024 + n % 60000).to_bytes(2, "big")
+            w.write(n // 1000, n % 1000 * 1000, bytes(raw))
+
+
+def _bench_packet(proto, lname, fname, value=None):
+    """Reads or writes a field of a `Packet`."""
+    template = synthetic_template(proto)
+    pkt = Packet(template)
+    pkt.load(template.raw[14:])
+    layer = pkt[lname]
+    if value is None:
+        return lambda: layer[fname]
+    edits = pkt._edits
+
+    def bench():
+        layer[fname] = value
+        # The recorded modifications would grow without limit
+        edits.clear()
+    return bench
+
+
+def _bench_load():
+    template = synthetic_template()
+    pkt = Packet(template)
+    payload = template.raw[14:]
+    return lambda: pkt.load(payload)
+
+
+def _bench_codec(ftype, fraw, fmask, decode):
+    cv = Converter()
+    if decode:
+        return lambda: cv.get_frepr(ftype, fraw, len(fraw), fmask, "field")
+    field = cv.get_frepr(ftype, fraw, len(fraw), fmask, "field")
+    return lambda: cv.get_fraw(field, ftype, fraw, len(fraw), fmask,
+                               "field")
+
+
+def _bench_chksums(proto, full):
+    """Modifies a port and recalculates the checksums."""
+    template = synthetic_template(proto)
+    i = Interceptor(template, bypass_mark=None)
+    pkt = Packet(template)
+    payload = template.raw[14:]
+    layer = pkt[proto.upper()]
+
+    def bench():
+        pkt.load(payload)
+        layer["dstport"] = 8080
+        pkt._rewritten = full
+        i._rec_chksums(pkt)
+    return bench
+
+
+def _bench_modify():
+    """Runs the whole pipeline of the `Interceptor` on a packet."""
+    template = synthetic_template()
+
+    def redirect(packet):
+        packet["TCP"]["dstport"] = 8080
+        return packet
+    template.add_function("redirect", redirect)
+    i = Interceptor(template, bypass_mark=None)
+    payload = template.raw[14:]
+    return lambda: i.linux_modify(ReplayPacket(payload))
+
+
+def _bench_template_read(tmpdir):
+    path = os.path.join(tmpdir, "template.json")
+    synthetic_template().write(path)
+    return lambda: Template(from_path=path)
+
+
+def _bench_tgenerate(tmpdir, count=50):
+    """Generates the templates of a pcap with tshark."""
+    from polymorph.tgenerator import TGenerator
+    path = os.path.join(tmpdir, "tgenerate.pcap")
+    synthetic_pcap(path, count)
+
+    def bench():
+        for _ in TGenerator(path):
+            pass
+    return bench
+
+
+def _benchmarks(tmpdir):
+    """Returns the benchmarks of the form
+    {name: (function that builds the benchmark, operations per call)}."""
+    benchmarks = OrderedDict([
+        ("packet.load", (_bench_load, 1)),
+        ("packet.get.int", (lambda: _bench_packet(
+            "tcp", "TCP", "dstport"), 1)),
+        ("packet.get.bin", (lambda: _bench_packet(
+            "tcp", "IP", "hdr_len"), 1)),
+        ("packet.get.ipv4", (lambda: _bench_packet(
+            "tcp", "IP", "src"), 1)),
+        ("packet.get.bytes", (lambda: _bench_packet(
+            "tcp", "RAW", "load"), 1)),
+        ("packet.set.int", (lambda: _bench_packet(
+            "tcp", "TCP", "dstport", 8080), 1)),
+        ("packet.set.bin", (lambda: _bench_packet(
+            "tcp", "TCP", "flags.syn", 1), 1)),
+        ("packet.set.ipv4", (lambda: _bench_packet(
+            "tcp", "IP", "src", "10.0.0.9"), 1))])
+    for ftype, fraw, fmask in _CODEC_SAMPLES:
+        for decode in [True, False]:
+            name = "converter.%s.%s" % (ftype.name[3:].lower(),
+                                        "decode" if decode else "encode")
+            benchmarks[name] = (
+                lambda f=ftype, r=fraw, m=fmask, d=decode: _bench_codec(
+                    f, r, m, d), 1)
+    for proto in ["tcp", "udp"]:
+        for full in [False, True]:
+            name = "chksums.%s.%s" % (proto, "full" if full else
+                                      "incremental")
+            benchmarks[name] = (
+                lambda p=proto, f=full: _bench_chksums(p, f), 1)
+    benchmarks["interceptor.linux_modify"] = (_bench_modify, 1)
+    benchmarks["template.read"] = (lambda: _bench_template_read(tmpdir), 1)
+    # Templates are generated by tshark through pyshark
+    if shutil.which("tshark"):
+        try:
+            import pyshark  # noqa: F401
+            benchmarks["tgenerator.tgenerate"] = (
+                lambda: _bench_tgenerate(tmpdir), 50)
+        except ImportError:
+            pass
+    return benchmarks
+
+
+def _measure(bench, ops, repeat, min_time):
+    """Times a benchmark, returns the nanoseconds per operation of every
+    repetition."""
+    # Number of calls needed to reach the minimum time
+    number = 1
+    while True:
+        start = perf_counter_ns()
+        for _ in range(number):
+            bench()
+        elapsed = perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 or number >= 1 << 24:
+            break
+        number *= 2 if elapsed == 0 else max(
+            2, min(10, int(min_time * 1e9 / elapsed) + 1))
+    times = [elapsed]
+    for _ in range(repeat - 1):
+        start = perf_counter_ns()
+        for _ in range(number):
+            bench()
+        times.append(perf_counter_ns() - start)
+    return [t / (number * ops) for t in times]
+
+
+def run(pattern=None, repeat=5, min_time=0.2, verbose=True):
+    """Runs the benchmarks.
+
+    Parameters
+    ----------
+    pattern : :obj:`str`, optional
+        Only the benchmarks whose name contains this string are run.
+    repeat : int
+        Number of repetitions of every benchmark.
+    min_time : float
+        Minimum duration in seconds of every repetition.
+    verbose : bool
+        If True, the results are printed as they are obtained.
+
+    Returns
+    -------
+    :obj:`dict`
+        The results, of the form {"results": {name: {statistic: value}}}
+        and information about the environment.
+
+    """
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (build, ops) in _benchmarks(tmpdir).items():
+            if pattern and pattern not in name:
+                continue
+            times = _measure(build(), ops, repeat, min_time)
+            results[name] = OrderedDict([
+                ("best", min(times)),
+                ("median", statistics.median(times)),
+                ("repeat", len(times))])
+            if verbose:
+                print("%-32s %12.1f ns/op" % (name, min(times)))
+    return OrderedDict([("format", FORMAT_VERSION),
+                        ("python", platform.python_version()),
+                        ("implementation", platform.python_implementation()),
+                        ("platform", platform.platform()),
+                        ("machine", platform.machine()),
+                        ("results", results)])
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Compares two sets of results.
+
+    Parameters
+    ----------
+    baseline : :obj:`dict`
+        Results used as reference.
+    current : :obj:`dict`
+        Results that are compared with the reference.
+    threshold : float
+        Relative slowdown above which a benchmark is a regression.
+
+    Returns
+    -------
+    :obj:`list` of :obj:`tuple`
+        Tuples (name, baseline ns, current ns, ratio, regression) of the
+        benchmarks present in both results.
+
+    """
+    rows = []
+    for name, base in baseline["results"].items():
+        if name not in current["results"]:
+            continue
+        cur = current["results"][name]
+        ratio = cur["best"] / base["best"] if base["best"] else 1.0
+        rows.append((name, base["best"], cur["best"], ratio,
+                     ratio > 1 + threshold))
+    return rows
+
+
+def show_comparison(rows):
+    """Pretty print of the result of `compare`."""
+    t = Texttable(max_width=0)
+    t.set_cols_dtype(["t"] * 5)
+    t.add_rows([["Benchmark", "Baseline (ns)", "Current (ns)", "Ratio",
+                 "Regression"]] +
+               [[name, "%.1f" % base, "%.1f" % cur, "%.2f" % ratio,
+                 "YES" if regression else ""]
+                for name, base, cur, ratio, regression in rows])
+    print(t.draw(), "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m polymorph.benchmark",
+        description="Benchmarks of the hot path of polymorph.")
+    commands = parser.add_subparsers(dest="command")
+    prun = commands.add_parser("run", help="runs the benchmarks")
+    prun.add_argument("-o", "--output", help="JSON file for the results")
+    prun.add_argument("-k", "--pattern",
+                      help="only run the benchmarks that contain it")
+    prun.add_argument("-r", "--repeat", type=int, default=5)
+    prun.add_argument("-t", "--min-time", type=float, default=0.2,
+                      help="minimum seconds per repetition")
+    pcmp = commands.add_parser("compare",
+                               help="compares the results with a baseline")
+    pcmp.add_argument("baseline")
+    pcmp.add_argument("current")
+    pcmp.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                      help="relative slowdown considered a regression")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = run(args.pattern, args.repeat, args.min_time)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+        return 0
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = compare(baseline, current, args.threshold)
+        show_comparison(rows)
+        regressions = [r[0] for r in rows if r[4]]
+        if regressions:
+            print("[!] %d regressions: %s" % (len(regressions),
+                                              ", ".join(regressions)))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,31 +35,23 @@ class Converter(object):
     def raw2bin(self, fraw, mask, fsize, order='big'):
         """Convert a set of bytes to Ftype.FT_BIN format.
         """
-        num_bin = format(int.from_bytes(fraw, byteorder=order),
-                         "0" + str(8*fsize) + "b")
-        mask_bin = format(mask, "0" + str(8*fsize) + "b")
-        trail_zeros = len(mask_bin) - len(mask_bin.rstrip('0'))
-        return (int(num_bin, 2) & int(mask_bin, 2)) >> trail_zeros
+        if not mask:
+            return 0
+        trail_zeros = (mask & -mask).bit_length() - 1
+        return (int.from_bytes(fraw, byteorder=order) & mask) >> trail_zeros
 
     def raw2maskbin(self, fraw, prev_mask, fsize, order='big'):
         """Converts a set of bytes to Ftype.FT_BIN format for a field
         whose mask is defined by the previous field."""
-        prev_mask_bin = format(prev_mask, "0" + str(8*fsize) + "b")
-        inv_mask = int("1"*(8*fsize), 2)
-        new_mask = int(prev_mask_bin, 2) ^ inv_mask
+        new_mask = prev_mask ^ ((1 << 8*fsize) - 1)
         return (self.raw2bin(fraw, new_mask, fsize, order), new_mask)
 
     def bin2raw(self, field, fraw, mask, fsize, order='big'):
         """Convert Ftype.FT_BIN to a set of bytes.
         """
-        mask_bin = format(mask, "0" + str(8*fsize) + "b")
-        trail_zeros = len(mask_bin) - len(mask_bin.rstrip('0'))
-        field_bin_inv = format(field << trail_zeros, "0" + str(8*fsize) + "b")
-        ones = [i for i, item in enumerate(list(mask_bin)) if item == '1']
-        old_val = format(int.from_bytes(fraw, byteorder=order),
-                         "0" + str(8*fsize) + "b")
-        new_val = int(
-            old_val[:ones[0]] + field_bin_inv[ones[0]:ones[-1]] + old_val[ones[-1]:], 2)
+        trail_zeros = (mask & -mask).bit_length() - 1
+        old_val = int.from_bytes(fraw, byteorder=order)
+        new_val = (old_val & ~mask) | ((field << trail_zeros) & mask)
         return new_val.to_bytes(fsize, byteorder=order)
 
     def raw2hex(self, fraw):
@@ -154,58 +146,86 @@ class Converter(object):
 
     def get_frepr(self, ftype, fraw, fsize, fmask, fname):
         """Returns the representation of a field from its value in bytes."""
-        if ftype in [Ftype.FT_INT_BE]:
-            return self.raw2intbe(fraw)
-        elif ftype in [Ftype.FT_INT_LE]:
-            return self.raw2intle(fraw)
-        elif ftype in [Ftype.FT_STRING]:
-            return self.raw2string(fraw)
-        elif ftype in [Ftype.FT_BYTES]:
-            return fraw
-        elif ftype in [Ftype.FT_BIN_BE]:
-            return self.raw2bin(fraw, fmask, fsize, order='big')
-        elif ftype in [Ftype.FT_BIN_LE]:
-            return self.raw2bin(fraw, fmask, fsize, order='little')
-        elif ftype in [Ftype.FT_HEX]:
-            return self.raw2hex(fraw)
-        elif ftype in [Ftype.FT_ETHER]:
-            return self.raw2ether(fraw)
-        elif ftype in [Ftype.FT_IPv4]:
-            return self.raw2ipv4(fraw)
-        elif ftype in [Ftype.FT_IPv6]:
-            return self.raw2ipv6(fraw)
-        elif ftype in [Ftype.FT_ABSOLUTE_TIME]:
-            return self.raw2absolute(fraw, fsize, fname)
-        elif ftype in [Ftype.FT_RELATIVE_TIME]:
-            return self.raw2relative(fraw)
-        elif ftype in [Ftype.FT_EUI64]:
-            return self.raw2eui64(fraw)
+        codec = _CODECS.get(ftype)
+        if codec:
+            return codec[0](self, fraw, fsize, fmask, fname)
 
     def get_fraw(self, field, ftype, fraw, fsize, fmask, fname):
         """Returns the field value in bytes from its representation."""
-        if ftype in [Ftype.FT_INT_BE]:
-            return self.intbe2raw(field, fsize)
-        elif ftype in [Ftype.FT_INT_LE]:
-            return self.intle2raw(field, fsize)
-        elif ftype in [Ftype.FT_STRING]:
-            return self.string2raw(field)
-        elif ftype in [Ftype.FT_BYTES]:
-            return field
-        elif ftype in [Ftype.FT_BIN_BE]:
-            return self.bin2raw(field, fraw, fmask, fsize, order='big')
-        elif ftype in [Ftype.FT_BIN_LE]:
-            return self.bin2raw(field, fraw, fmask, fsize, order='little')
-        elif ftype in [Ftype.FT_HEX]:
-            return self.hex2raw(field, fsize)
-        elif ftype in [Ftype.FT_ETHER]:
-            return self.ether2raw(field)
-        elif ftype in [Ftype.FT_IPv4]:
-            return self.ipv42raw(field)
-        elif ftype in [Ftype.FT_IPv6]:
-            return self.ipv62raw(field)
-        elif ftype in [Ftype.FT_ABSOLUTE_TIME]:
-            return self.absolute2raw(field, fraw, fsize, fname)
-        elif ftype in [Ftype.FT_RELATIVE_TIME]:
-            return self.relative2raw(field, fsize)
-        elif ftype in [Ftype.FT_EUI64]:
-            return self.eui642raw(field)
+        codec = _CODECS.get(ftype)
+        if codec:
+            return codec[1](self, field, fraw, fsize, fmask, fname)
+
+    @staticmethod
+    def register_codec(ftype, decoder, encoder):
+        """Registers the functions that convert a type of field.
+
+        Parameters
+        ----------
+        ftype : :obj:`Ftype`
+            Type of the field.
+        decoder : :obj:`function`
+            Function of the form decoder(cv, fraw, fsize, fmask, fname) that
+            returns the representation of a field from its value in bytes.
+        encoder : :obj:`function`
+            Function of the form encoder(cv, field, fraw, fsize, fmask, fname)
+            that returns the value in bytes of a field from its
+            representation.
+
+        """
+        _CODECS[ftype] = (decoder, encoder)
+
+
+# Functions that convert each type of field, of the form
+# {ftype: (decoder, encoder)}
+_CODECS = {
+    Ftype.FT_INT_BE: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2intbe(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.intbe2raw(
+            field, fsize)),
+    Ftype.FT_INT_LE: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2intle(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.intle2raw(
+            field, fsize)),
+    Ftype.FT_STRING: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2string(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.string2raw(field)),
+    Ftype.FT_BYTES: (
+        lambda cv, fraw, fsize, fmask, fname: fraw,
+        lambda cv, field, fraw, fsize, fmask, fname: field),
+    Ftype.FT_BIN_BE: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2bin(
+            fraw, fmask, fsize, order='big'),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.bin2raw(
+            field, fraw, fmask, fsize, order='big')),
+    Ftype.FT_BIN_LE: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2bin(
+            fraw, fmask, fsize, order='little'),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.bin2raw(
+            field, fraw, fmask, fsize, order='little')),
+    Ftype.FT_HEX: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2hex(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.hex2raw(
+            field, fsize)),
+    Ftype.FT_ETHER: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2ether(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.ether2raw(field)),
+    Ftype.FT_IPv4: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2ipv4(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.ipv42raw(field)),
+    Ftype.FT_IPv6: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2ipv6(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.ipv62raw(field)),
+    Ftype.FT_ABSOLUTE_TIME: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2absolute(
+            fraw, fsize, fname),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.absolute2raw(
+            field, fraw, fsize, fname)),
+    Ftype.FT_RELATIVE_TIME: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2relative(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.relative2raw(
+            field, fsize)),
+    Ftype.FT_EUI64: (
+        lambda cv, fraw, fsize, fmask, fname: cv.raw2eui64(fraw),
+        lambda cv, field, fraw, fsize, fmask, fname: cv.eui642raw(field)),
+}
@@ -0,0 +1,278 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import struct
+from polymorph.interceptor import Interceptor, PACKETS, BYTES
+from polymorph.packet import Packet, header_offsets
+from polymorph.matcher import compile_conditions
+from polymorph.rules import compile_rules
+
+# Protocol numbers of the upper layers of the templates
+LAYER_PROTOS = [("TCP", 6), ("UDP", 17), ("ICMP", 1), ("ICMPV6", 58)]
+
+# Maximum number of ports of an iptables multiport match
+MULTIPORT_MAX = 15
+
+
+class TemplateIndex(object):
+    """Decision index that selects the `Template` that applies to a packet
+    from its IP version, its upper protocol and its ports. The lookup is a
+    few dictionary accesses, whatever the number of templates."""
+
+    def __init__(self, templates):
+        """Initialization method of the `TemplateIndex` class.
+
+        Parameters
+        ----------
+        templates : :obj:`list` of :obj:`Template`
+            The templates indexed. When several templates apply to the same
+            packets, the first one is selected.
+
+        """
+        # {(version, proto): {port: index}}
+        self._by_port = {}
+        # {(version, proto): index} for the templates without ports
+        self._by_proto = {}
+        # {version: index} for the templates without upper layer
+        self._by_version = {}
+        # Index of the first template without IP layer
+        self._default = None
+        self.keys = [self._key(t) for t in templates]
+        for index, (version, proto, ports) in enumerate(self.keys):
+            if version is None:
+                if self._default is None:
+                    self._default = index
+            elif proto is None:
+                self._by_version.setdefault(version, index)
+            elif ports is None:
+                self._by_proto.setdefault((version, proto), index)
+            else:
+                table = self._by_port.setdefault((version, proto), {})
+                for port in ports:
+                    table.setdefault(port, index)
+
+    @staticmethod
+    def _key(template):
+        """Obtains the IP version, the upper protocol and the service ports
+        of the packets to which a `Template` applies. The values that the
+        `Template` does not determine are None."""
+        raw = template.raw
+        names = template.layernames()
+        if "IP" in names:
+            version, ip = 4, template["IP"].slice.start
+        elif "IPV6" in names:
+            version, ip = 6, template["IPV6"].slice.start
+        else:
+            return None, None, None
+        for lname, proto in LAYER_PROTOS:
+            if lname in names:
+                if lname in ["TCP", "UDP"]:
+                    start = template[lname].slice.start
+                    ports = struct.unpack("!HH", raw[start:start + 4])
+                    return version, proto, Interceptor._service_ports(ports)
+                return version, proto, None
+        offsets = header_offsets(raw, ip)
+        proto = offsets[3] if offsets else None
+        return version, proto, None
+
+    def lookup(self, buf, ip=0):
+        """Selects the `Template` that applies to a packet.
+
+        Parameters
+        ----------
+        buf : :obj:`bytes`
+            Bytes of the packet.
+        ip : int
+            Position of the IP header.
+
+        Returns
+        -------
+        int
+            Index of the `Template`, or None if no `Template` applies.
+
+        """
+        offsets = header_offsets(buf, ip)
+        if offsets is None:
+            return self._default
+        version = buf[ip] >> 4
+        _, l4, _, proto = offsets
+        if proto is not None:
+            ports = self._by_port.get((version, proto))
+            if ports and len(buf) >= l4 + 4:
+                # The destination port is checked before the source port
+                index = ports.get(buf[l4 + 2] << 8 | buf[l4 + 3])
+                if index is None:
+                    index = ports.get(buf[l4] << 8 | buf[l4 + 1])
+                if index is not None:
+                    return index
+            index = self._by_proto.get((version, proto))
+            if index is not None:
+                return index
+        index = self._by_version.get(version)
+        return self._default if index is None else index
+
+    def matches(self):
+        """Builds the iptables matches of the packets to which any of the
+        templates applies.
+
+        Returns
+        -------
+        :obj:`tuple` of :obj:`list` of :obj:`str`
+            Matches for iptables and ip6tables, one per upper protocol of
+            the templates. The matches of a version of IP are None when no
+            `Template` applies to it.
+
+        """
+        if self._default is not None:
+            return [""], [""]
+        matches = []
+        for version in (4, 6):
+            keys = [k for k in self.keys if k[0] == version]
+            protos = set(k[1] for k in keys)
+            if not keys:
+                matches.append(None)
+                continue
+            if None in protos:
+                matches.append([""])
+                continue
+            version_matches = []
+            for proto in sorted(protos):
+                match = "-p %d " % proto
+                ports = set()
+                proto_keys = [k for k in keys if k[1] == proto]
+                for k in proto_keys:
+                    ports.update(k[2] or [])
+                if all(k[2] for k in proto_keys) and \
+                        len(ports) <= MULTIPORT_MAX:
+                    match += "-m multiport --ports %s " % ",".join(
+                        str(p) for p in sorted(ports))
+                version_matches.append(match)
+            matches.append(version_matches)
+        return tuple(matches)
+
+
+class DispatchInterceptor(Interceptor):
+    """Interceptor that loads several templates and executes on every packet
+    the functions of the `Template` that applies to it, selected through a
+    `TemplateIndex`. The packets to which no `Template` applies are
+    forwarded without changes."""
+
+    def __init__(self, templates, iptables_rule=None, ip6tables_rule=None,
+                 match_template=True, copy_range=None, **kwargs):
+        """Initialization method of the `DispatchInterceptor` class.
+
+        Parameters
+        ----------
+        templates : :obj:`list` of :obj:`Template`
+            The templates whose functions will be executed.
+        iptables_rule : :obj:`str`, optional
+            Iptables rule for intercepting packets. By default the packets
+            of the protocols and ports of all the templates.
+        ip6tables_rule : :obj:`str`, optional
+            Iptables rule for intercepting packets for ipv6.
+        match_template : bool
+            If False, the default rules intercept all the forwarded packets.
+        copy_range : int, :obj:`str`, optional
+            As in the `Interceptor`. If 'auto', the highest value of all
+            the templates is used.
+        **kwargs
+            Other options of the `Interceptor`. The bpf match is not
+            supported.
+
+        """
+        if not templates:
+            raise ValueError("at least one template is required")
+        if kwargs.get("bpf"):
+            raise ValueError("the bpf match is not supported with several "
+                             "templates")
+        self._templates = list(templates)
+        self._index_table = TemplateIndex(self._templates)
+        if copy_range == "auto":
+            ranges = [Interceptor.template_copy_range(t)
+                      for t in self._templates]
+            copy_range = None if None in ranges else max(ranges)
+        super().__init__(self._templates[0], iptables_rule=iptables_rule,
+                         ip6tables_rule=ip6tables_rule, match_template=False,
+                         copy_range=copy_range, **kwargs)
+        target = Interceptor.nfqueue_target(
+            self._queues, self._queue_num, kwargs.get("queue_bypass", False),
+            cpu_fanout=not kwargs.get("tcp_seq", False))
+        match4, match6 = self._index_table.matches() \
+            if match_template else ([""], [""])
+        # One rule per upper protocol of the templates
+        self._rules = []
+        for cmd, rule, matches in [("iptables", iptables_rule, match4),
+                                   ("ip6tables", ip6tables_rule, match6)]:
+            if not rule and matches is not None:
+                rules = ["%s -A FORWARD %s-j NFQUEUE %s" % (cmd, m, target)
+                         for m in matches]
+                rule = rules[0]
+                self._rules += rules
+            elif rule:
+                self._rules.append(rule)
+            setattr(self, cmd + "_rule", rule)
+
+    def _queue_rules(self):
+        """Builds the rules that send the packets to the queues."""
+        return list(self._rules)
+
+    def _load_functions(self):
+        """Deserializes the custom functions of every `Template`, building
+        the routes selected by the index."""
+        self._routes = []
+        for template in self._templates:
+            names = template.function_names()
+            functions = [template.get_function(n) for n in names]
+            rules = compile_rules(template)
+            if rules:
+                names, functions = ["<rules>"] + names, [rules] + functions
+            if self._stats:
+                functions = [self._stats.wrap("%s:%s" % (template.name, n), f)
+                             for n, f in zip(names, functions)]
+            self._routes.append((Packet(template), functions,
+                                 compile_conditions(template)))
+        return []
+
+    def linux_modify(self, packet):
+        """This is the callback method that will be called when a packet
+        is intercepted. The functions of the `Template` that applies to the
+        packet are executed.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+
+        """
+        payload = packet.get_payload()
+        index = self._index_table.lookup(payload)
+        if index is None:
+            self._counters[PACKETS] += 1
+            self._counters[BYTES] += len(payload)
+            packet.accept()
+            return
+        self.packet, self._functions, self._match = self._routes[index]
+        self._linux_run(packet, payload)
+
+    def windows_modify(self, packet, w, pydivert):
+        """This is the callback method that will be called when a packet
+        is intercepted. The functions of the `Template` that applies to the
+        packet are executed.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+        w : pointer
+            windiver pointer.
+
+        """
+        index = self._index_table.lookup(packet.raw.tobytes())
+        if index is None:
+            self._counters[PACKETS] += 1
+            self._counters[BYTES] += len(packet.raw)
+            w.send(packet)
+            return
+        self.packet, self._functions, self._match = self._routes[index]
+        super().windows_modify(packet, w, pydivert)
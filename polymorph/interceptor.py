@@ -2,14 +2,25 @@
 # Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
 # For more information about the project: https://github.com/shramos/polymorph
 
-from polymorph.packet import Packet
+from polymorph.packet import Packet, ETHER_HEADROOM, ANCHOR_L4, \
+    ANCHOR_PAYLOAD, header_offsets, template_anchors
+from polymorph.timerwheel import TimerWheel
+from polymorph.stats import InterceptorStats
+from polymorph.matcher import compile_conditions, bpf_bytecode
+from polymorph.rules import compile_rules
+from polymorph.tcpseq import SeqTable
 import platform
 import subprocess
+import multiprocessing
+import select
+import os
+import signal
+import time
 from scapy.all import IP, IPv6
 import struct
-import socket
-import ipaddress
 import array
+from texttable import Texttable
+from collections import OrderedDict
 
 
 class Interceptor(object):
@@ -17,9 +28,11 @@ class Interceptor(object):
     interpreting these packets, interpreting the custom functions of the
     template and forwarding the modified packet to the target machine."""
 
-    def __init__(self, template,
-                 iptables_rule="iptables -A FORWARD -j NFQUEUE --queue-num 1",
-                 ip6tables_rule="ip6tables -A FORWARD -j NFQUEUE --queue-num 1"):
+    def __init__(self, template, iptables_rule=None, ip6tables_rule=None,
+                 queues=1, queue_num=1, bypass_mark=None,
+                 match_template=True, copy_range=None, max_len=None,
+                 sock_len=None, queue_bypass=False, stats=False, bpf=False,
+                 tcp_seq=False):
         """Initialization method of the `Interceptor` class.
 
         Parameters
@@ -27,29 +40,452 @@ class Interceptor(object):
         template : :obj:`Template`
             A `Template` objet that will be parsed to obtain the custom functions
             and other values.
-        iptables_rule : :obj:`str`
-            Iptables rule for intercepting packets.
-        ip6tables_rule : :obj:`str`
+        iptables_rule : :obj:`str`, optional
+            Iptables rule for intercepting packets. By default all the
+            forwarded packets are sent to the queues of the `Interceptor`.
+        ip6tables_rule : :obj:`str`, optional
             Iptables rule for intercepting packets for ipv6.
+        queues : int
+            Number of nfqueue queues. When it is greater than 1, the packets
+            are balanced between the queues and each queue is served by its
+            own worker process (only on Linux).
+        queue_num : int
+            Number of the first nfqueue queue.
+        bypass_mark : int, optional
+            Mark used to stop intercepting the connections of the packets
+            that have the `bypass` flag activated, for example
+            `BYPASS_MARK`. Its rules need the CONNMARK target and the
+            connmark match. If None, the flag is ignored and these rules
+            are not set (only on Linux).
+        match_template : bool
+            If True, the default rules only intercept the packets of the
+            protocol and ports of the `Template`, otherwise all the
+            forwarded packets are intercepted.
+        copy_range : int, :obj:`str`, optional
+            Maximum number of bytes of each packet copied from the kernel.
+            If 'auto', it is calculated from the highest byte touched by the
+            fields of the `Template`. If None, the whole packet is copied.
+            Modified packets that were truncated are requeued to obtain
+            their whole content (only on Linux).
+        max_len : int, optional
+            Maximum number of packets waiting in the kernel for each queue.
+        sock_len : int, optional
+            Size in bytes of the receive buffer of the netlink socket.
+        queue_bypass : bool
+            If True, the packets are accepted instead of being dropped when
+            there is no process bound to the queue (--queue-bypass). The
+            packets that arrive when the queue is full are still dropped,
+            `max_len` and `sock_len` make room for the bursts.
+        stats : bool
+            If True, the latency and the outcome of every function of the
+            `Template` are recorded. They are shown on exit and when the
+            process receives SIGUSR1 (only on Linux).
+        bpf : bool
+            If True, the conditions of the `Template` are also added to the
+            default rules as a bpf match when they can be translated, so
+            that the packets that do not meet them are not queued.
+        tcp_seq : bool
+            If True, the sequence numbers of the TCP connections whose
+            packets change their length are translated in both directions,
+            so that the modifications of length can be used on real
+            connections. Not compatible with `copy_range`. Each queue keeps
+            its own table, so with several queues the packets are balanced
+            by the hash of their addresses instead of by CPU. The kernel
+            hash is symmetric in the current versions of Linux, which keeps
+            both directions of a connection in the same queue, but this is
+            not a documented guarantee.
 
         """
+        self._template = template
+        self._stats = InterceptorStats() if stats else None
+        # Counters of the intercepted packets, indexed by the constants of
+        # `COUNTERS`. With several queues each worker writes its own row of
+        # a shared array
+        self._counters = array.array("Q", bytes(8 * len(COUNTERS)))
+        self._shared_counters = None
+        self.max_len = max_len
+        self.sock_len = sock_len
+        if copy_range == "auto":
+            copy_range = Interceptor.template_copy_range(template)
+        if copy_range and queues > 16:
+            raise ValueError("copy_range supports a maximum of 16 queues")
+        if copy_range and tcp_seq:
+            raise ValueError("tcp_seq needs the whole packets, it can not "
+                             "be used with copy_range")
+        self.copy_range = copy_range
+        # Displacements of the sequence numbers of the TCP connections,
+        # each queue keeps its own table
+        self._seqs = SeqTable() if tcp_seq else None
+        # Modified packets that wait to be reassembled, indexed by the
+        # slot encoded in their mark
+        self._pending = {}
+        self._slot = 0
+        self._index = 0
+        # Packets whose verdict has been deferred by the functions
+        self._timers = TimerWheel()
+        self.bypass_mark = bypass_mark
+        self._queues = queues
+        self._queue_num = queue_num
+        target = Interceptor.nfqueue_target(queues, queue_num, queue_bypass,
+                                            cpu_fanout=not tcp_seq)
+        match4, match6 = Interceptor.template_match(template, bpf) \
+            if match_template else ("", "")
+        # A rule is not set if the template does not apply to its IP version
+        if not iptables_rule and match4 is not None:
+            iptables_rule = "iptables -A FORWARD %s-j NFQUEUE %s" % (
+                match4, target)
+        if not ip6tables_rule and match6 is not None:
+            ip6tables_rule = "ip6tables -A FORWARD %s-j NFQUEUE %s" % (
+                match6, target)
         self.iptables_rule = iptables_rule
         self.ip6tables_rule = ip6tables_rule
         self.packet = Packet(template)
-        self._functions = [template.get_function(func_name)
-                           for func_name in template.function_names()]
+        self._match = compile_conditions(template)
+        self._functions = self._load_functions()
+
+    def _load_functions(self):
+        """Deserializes the custom functions of the `Template`. The rules of
+        the `Template` are compiled into a function that runs first."""
+        names = self._template.function_names()
+        functions = [self._template.get_function(func_name)
+                     for func_name in names]
+        rules = compile_rules(self._template)
+        if rules:
+            names, functions = ["<rules>"] + names, [rules] + functions
+        if self._stats:
+            functions = [self._stats.wrap(name, f) for name, f in zip(
+                names, functions)]
+        return functions
+
+    def counters(self):
+        """Returns the counters of the packets intercepted by all the queues.
+
+        Returns
+        -------
+        :obj:`dict`
+            Dictionary of the form {name: value}, with the names of
+            `COUNTERS`.
+
+        """
+        values = list(self._counters)
+        if self._shared_counters is not None:
+            shared = self._shared_counters
+            values = [sum(shared[i::len(COUNTERS)])
+                      for i in range(len(COUNTERS))]
+        return OrderedDict(zip(COUNTERS, values))
+
+    def show_stats(self, *args):
+        """Pretty print of the latencies and outcomes of the functions of
+        the `Template`. It can be used as a signal handler."""
+        if self._stats:
+            if self._queues > 1:
+                print("[*] Queue %d" % (self._queue_num + self._index))
+            self._stats.show()
+
+    @staticmethod
+    def nfqueue_target(queues=1, queue_num=1, queue_bypass=False,
+                       cpu_fanout=True):
+        """Builds the options of the iptables NFQUEUE target.
+
+        Parameters
+        ----------
+        queues : int
+            Number of queues among which the packets are balanced.
+        queue_num : int
+            Number of the first queue.
+        queue_bypass : bool
+            If True, the packets are accepted when there is no process
+            bound to the queue. It does not apply when the queue is full.
+        cpu_fanout : bool
+            If True, the queue of a packet is chosen by the CPU that
+            received it, otherwise by the hash of its addresses, which
+            keeps the packets of a connection in the same queue.
+
+        Returns
+        -------
+        :obj:`str`
+            Options of the NFQUEUE target.
+
+        """
+        if queues > 1:
+            target = "--queue-balance %d:%d" % (queue_num,
+                                                queue_num + queues - 1)
+            if cpu_fanout:
+                target += " --queue-cpu-fanout"
+        else:
+            target = "--queue-num %d" % queue_num
+        if queue_bypass:
+            target += " --queue-bypass"
+        return target
+
+    @staticmethod
+    def queue_stats(path="/proc/net/netfilter/nfnetlink_queue"):
+        """Reads the counters of the nfqueue queues from the kernel.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            Path of the nfnetlink_queue file of procfs.
+
+        Returns
+        -------
+        :obj:`dict`
+            Counters of each queue of the form {queue_num: {name: value}}.
+
+        """
+        stats = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    values = [int(v) for v in line.split()]
+                    stats[values[0]] = dict(zip(QUEUE_STATS, values[1:]))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def show_queue_stats(self):
+        """Pretty print of the kernel counters of the queues of the
+        `Interceptor`."""
+        stats = Interceptor.queue_stats()
+        queues = range(self._queue_num, self._queue_num + self._queues)
+        t = Texttable()
+        rows = [["Queue", "Waiting", "Queue dropped", "User dropped",
+                 "Packet id"]]
+        for q in queues:
+            if q in stats:
+                rows.append([q, stats[q]["queue_total"],
+                             stats[q]["queue_dropped"],
+                             stats[q]["user_dropped"],
+                             stats[q]["id_sequence"]])
+        if len(rows) > 1:
+            t.add_rows(rows)
+            print(t.draw(), "\n")
+
+    @staticmethod
+    def template_match(template, bpf=False):
+        """Builds the iptables matches of the packets to which a `Template`
+        can be applied, from the protocol and ports of its layers.
+
+        Parameters
+        ----------
+        template : :obj:`Template`
+            The `Template` whose packets will be matched.
+        bpf : bool
+            If True, the conditions of the `Template` are added as a bpf
+            match when they can be translated.
+
+        Returns
+        -------
+        :obj:`tuple` of :obj:`str`
+            Matches for iptables and ip6tables. A match is None when the
+            `Template` does not apply to that version of IP.
+
+        """
+        raw = template.raw
+        names = template.layernames()
+        if "IP" in names:
+            matches = [None, None]
+            ip, version = template["IP"].slice.start, 0
+        elif "IPV6" in names:
+            matches = [None, None]
+            ip, version = template["IPV6"].slice.start, 1
+        else:
+            # Templates without IP layer apply to every packet
+            return "", ""
+        match = ""
+        for lname, proto in [("TCP", "tcp"), ("UDP", "udp"),
+                             ("ICMP", "icmp"), ("ICMPV6", "ipv6-icmp")]:
+            if lname in names:
+                match = "-p %s " % proto
+                if lname in ["TCP", "UDP"]:
+                    start = template[lname].slice.start
+                    ports = struct.unpack("!HH", raw[start:start + 4])
+                    match += "-m multiport --ports %s " % ",".join(
+                        str(p) for p in Interceptor._service_ports(ports))
+                break
+        else:
+            if version == 0:
+                match = "-p %d " % raw[ip + 9]
+        bytecode = bpf_bytecode(template) if bpf else None
+        if bytecode:
+            match += '-m bpf --bytecode "%s" ' % bytecode
+        matches[version] = match
+        return tuple(matches)
+
+    @staticmethod
+    def template_copy_range(template):
+        """Calculates the number of bytes of the packets that must be copied
+        from the kernel to access all the fields of a `Template`.
+
+        Parameters
+        ----------
+        template : :obj:`Template`
+            The `Template` whose fields will be accessed.
+
+        Returns
+        -------
+        int
+            Number of bytes without the Ethernet layer, or None if the
+            position of some field is calculated at run time. The layers
+            located after the IP header leave room for the longest IPv4
+            and TCP options.
+
+        """
+        anchors, _ = template_anchors(template)
+        stop = 0
+        for layer in template.layers:
+            if layer.get_structs():
+                return None
+            margin = HEADER_OPTIONS_MARGIN if anchors[layer.name] in (
+                ANCHOR_L4, ANCHOR_PAYLOAD) else 0
+            for field in layer.fields:
+                stop = max(stop, field.slice.stop + margin)
+        return max(stop - ETHER_HEADROOM, 0) if stop else None
+
+    @staticmethod
+    def _service_ports(ports):
+        """Discards the ephemeral ports of a connection, unless all of them
+        are ephemeral."""
+        # Lower bound of the ephemeral ports used by Linux
+        service = sorted(set(p for p in ports if p < 32768))
+        return service if service else sorted(set(ports))
+
+    def _queue_rules(self):
+        """Builds the rules that send the packets to the queues."""
+        return [r for r in [self.iptables_rule, self.ip6tables_rule] if r]
 
     def set_iptables_rules(self):
-        subprocess.check_output(
-            self.iptables_rule, shell=True, stderr=subprocess.STDOUT)
-        subprocess.check_output(self.ip6tables_rule,
-                                shell=True, stderr=subprocess.STDOUT)
+        rules = self._queue_rules()
+        if self.bypass_mark is not None:
+            rules += self._bypass_rules("-A", "-I")
+        if self.copy_range:
+            rules += self._reassembly_rules()
+        try:
+            for rule in rules:
+                subprocess.check_output(
+                    rule, shell=True, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            # The rules already set are removed
+            self.clean_iptables()
+            raise
 
     def clean_iptables(self):
         subprocess.check_output(
             "iptables -F", shell=True, stderr=subprocess.STDOUT)
         subprocess.check_output(
             "ip6tables -F", shell=True, stderr=subprocess.STDOUT)
+        if self.bypass_mark is not None:
+            # The filter table is already flushed
+            for rule in self._bypass_rules("-D", None):
+                try:
+                    subprocess.check_output(
+                        rule, shell=True, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError:
+                    pass
+
+    def _bypass_rules(self, mangle_op, filter_op):
+        """Builds the rules that stop queueing the connections marked by
+        the `Interceptor`. The mark of the accepted packets is saved in
+        their connection, and the packets of marked connections are accepted
+        before reaching the NFQUEUE rule.
+
+        Parameters
+        ----------
+        mangle_op : :obj:`str`
+            Iptables command for the rule of the mangle table.
+        filter_op : :obj:`str`
+            Iptables command for the rule of the filter table, if None
+            this rule is not built.
+
+        """
+        rules = []
+        for cmd, rule in [("iptables", self.iptables_rule),
+                          ("ip6tables", self.ip6tables_rule)]:
+            if not rule:
+                continue
+            rules.append(
+                "%s -t mangle %s POSTROUTING -m mark --mark %#x "
+                "-j CONNMARK --set-mark %#x" % (cmd, mangle_op,
+                                               self.bypass_mark,
+                                               self.bypass_mark))
+            if filter_op:
+                rules.append("%s %s %s -m connmark --mark %#x -j ACCEPT" % (
+                    cmd, filter_op, Interceptor._rule_chain(rule),
+                    self.bypass_mark))
+        return rules
+
+    def _reassembly_rules(self):
+        """Builds the rules that send the requeued packets of every queue to
+        the queue that copies them completely."""
+        rules = []
+        for cmd, rule in [("iptables", self.iptables_rule),
+                          ("ip6tables", self.ip6tables_rule)]:
+            if not rule:
+                continue
+            for index in range(self._queues):
+                rules.append(
+                    "%s -I %s -m mark --mark %#x/%#x -j NFQUEUE "
+                    "--queue-num %d" % (
+                        cmd, Interceptor._rule_chain(rule),
+                        REASSEMBLY_MARK | index << 12, REASSEMBLY_MASK,
+                        self._reassembly_queue(index)))
+        return rules
+
+    def _reassembly_queue(self, index):
+        """Number of the queue that reassembles the packets of a queue."""
+        return self._queue_num + self._queues + index
+
+    @staticmethod
+    def _rule_chain(rule):
+        """Returns the chain of an iptables rule."""
+        tokens = rule.split()
+        for opt in ["-A", "--append", "-I", "--insert"]:
+            if opt in tokens and tokens.index(opt) + 1 < len(tokens):
+                return tokens[tokens.index(opt) + 1]
+        return "FORWARD"
+
+    def _accept(self, packet, pkt):
+        """Accepts a nfqueue packet, marking it if its connection does not
+        have to be intercepted anymore."""
+        if pkt.bypass and self.bypass_mark is not None:
+            packet.set_mark(self.bypass_mark)
+        if pkt._hold:
+            self._defer(packet, *pkt._hold)
+            return
+        packet.accept()
+
+    def _defer(self, packet, delay, condition, timeout):
+        """Holds a nfqueue packet whose verdict will be issued later. The
+        held packets count towards the maximum length of the queue.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object.
+        delay : float
+            Milliseconds until the packet is forwarded.
+        condition : :obj:`function`
+            Function that returns True when the packet must be forwarded.
+        timeout : float
+            Maximum number of milliseconds that the packet is held waiting
+            for the condition.
+
+        """
+        # The payload is kept after the callback returns
+        packet.retain()
+        deadline = time.monotonic() + timeout / 1000 if timeout else None
+        self._timers.add(delay / 1000, (packet, condition, deadline))
+
+    def _release(self):
+        """Issues the verdict of the held packets whose time has come."""
+        now = time.monotonic()
+        for packet, condition, deadline in self._timers.advance(now):
+            if condition and not condition() and \
+                    (deadline is None or now < deadline):
+                self._timers.add(self._timers.tick,
+                                 (packet, condition, deadline))
+            else:
+                packet.accept()
 
     def linux_modify(self, packet):
         """This is the callback method that will be called when a packet
@@ -61,21 +497,47 @@ class Interceptor(object):
         packet : :obj:`Packet`
             Netfilterqueue packet object. The packet that is intercepted.
 
+        """
+        self._linux_run(packet, packet.get_payload())
+
+    def _linux_run(self, packet, payload):
+        """Executes the custom functions of the `Template` on the content of
+        a nfqueue packet and issues its verdict.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object.
+        payload : :obj:`bytes`
+            Content of the packet copied from the kernel.
+
         """
         # Initialization of the Packet with the new raw bytes
-        self.packet.raw = packet.get_payload()
+        caplen = len(payload)
+        self.packet.load(payload)
+        counters = self._counters
+        counters[PACKETS] += 1
+        counters[BYTES] += _ip_length(self.packet._buf) \
+            if self.copy_range else caplen
+        # The packets that do not meet the conditions of the `Template` are
+        # forwarded without executing its functions
+        if self._match and not self._match(self.packet._buf,
+                                           self.packet._shifts):
+            self._linux_forward(packet, self.packet, caplen,
+                                rec_chksums=False)
+            return
         # Executing the cutom functions
         for function in self._functions:
             pkt = function(self.packet)
             # If the function returns None, it is not held and the
             # packet must be forwarded
             if not pkt:
-                if self.packet:
-                    packet.set_payload(self.packet.raw)
-                packet.accept()
+                self._linux_forward(packet, self.packet, caplen,
+                                    rec_chksums=False)
                 return
             # if the drop flag is activated, the network packet is dropped
             if pkt.drop:
+                counters[DROPPED] += 1
                 packet.drop()
                 return
             # If the function returns the packet, we assign it to the
@@ -83,10 +545,94 @@ class Interceptor(object):
             self.packet = pkt
         # If all the functions are met, we assign the payload of the modified
         # packet to the nfqueue packet and forward it
+        self._linux_forward(packet, self.packet, caplen, rec_chksums=True)
+
+    def _linux_forward(self, packet, pkt, caplen, rec_chksums):
+        """Forwards a nfqueue packet with the content of the `Packet`.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object.
+        pkt : :obj:`Packet`
+            The `Packet` processed by the functions of the `Template`.
+        caplen : int
+            Number of bytes of the packet copied from the kernel.
+        rec_chksums : bool
+            True if the checksums must be recalculated.
+
+        """
+        # The sequence numbers are translated before forwarding, also in the
+        # packets that the functions have not modified
+        if self._seqs is not None and self._seqs.rewrite(pkt, caplen):
+            rec_chksums = True
+        # Packets that have not been modified are forwarded as they are
+        if not pkt.modified:
+            self._accept(packet, pkt)
+            return
+        self._counters[MODIFIED] += 1
+        # Truncated packets can not be forwarded with a new payload, they
+        # are requeued to a queue that copies the whole packet
+        if self.copy_range and caplen < _ip_length(pkt._buf):
+            slot = self._slot
+            self._slot = (self._slot + 1) & 0xfff
+            self._pending[slot] = (
+                pkt, pkt.raw, caplen, rec_chksums and pkt.rec_chksums,
+                self.bypass_mark if pkt.bypass and
+                self.bypass_mark is not None else packet.get_mark())
+            packet.set_mark(REASSEMBLY_MARK | self._index << 12 | slot)
+            packet.repeat()
+            return
+        if self._stats:
+            self._timed_forward(packet, pkt, rec_chksums)
+            return
         # Before sending the packet, we recalculate the chksums fields
-        if self.packet.rec_chksums:
-            self.packet = self._rec_chksums(self.packet)
-        packet.set_payload(self.packet.raw)
+        if rec_chksums and pkt.rec_chksums:
+            pkt = self._rec_chksums(pkt)
+        packet.set_payload(pkt.raw)
+        self._accept(packet, pkt)
+
+    def _timed_forward(self, packet, pkt, rec_chksums):
+        """Forwards a modified nfqueue packet recording the latency of the
+        checksums and of the copy of the payload."""
+        if rec_chksums and pkt.rec_chksums:
+            start = time.perf_counter_ns()
+            pkt = self._rec_chksums(pkt)
+            self._stats.histogram("<chksums>").record(
+                time.perf_counter_ns() - start)
+        start = time.perf_counter_ns()
+        packet.set_payload(pkt.raw)
+        self._stats.histogram("<set_payload>").record(
+            time.perf_counter_ns() - start)
+        self._accept(packet, pkt)
+
+    def linux_reassemble(self, packet):
+        """This is the callback method of the queues that receive the whole
+        content of the truncated packets that have been modified. The
+        modified bytes are joined with the rest of the packet.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Netfilterqueue packet object. The packet that is intercepted.
+
+        """
+        pending = self._pending.pop(packet.get_mark() & 0xfff, None)
+        if not pending:
+            packet.accept()
+            return
+        pkt, head, caplen, rec_chksums, mark = pending
+        pkt.load(head + packet.get_payload()[caplen:])
+        # The lengths of the headers were calculated on the truncated
+        # packet if the functions changed its length
+        if len(head) != caplen:
+            pkt._fix_lengths()
+        # The checksums cover the bytes that were not copied
+        if rec_chksums:
+            pkt._rewritten = True
+            pkt = self._rec_chksums(pkt)
+        packet.set_payload(pkt.raw)
+        packet.set_mark(mark)
         packet.accept()
 
     def windows_modify(self, packet, w, pydivert):
@@ -103,25 +649,56 @@ class Interceptor(object):
 
         """
         # Initialization of the Packet with the new raw bytes
-        self.packet.raw = packet.raw.tobytes()
+        self.packet.load(packet.raw.tobytes())
+        counters = self._counters
+        counters[PACKETS] += 1
+        counters[BYTES] += len(self.packet)
+        if self._match and not self._match(self.packet._buf,
+                                           self.packet._shifts):
+            self._windows_forward(packet, w, pydivert, rec_chksums=False)
+            return
         # Executing the custom functions
         for function in self._functions:
             pkt = function(self.packet)
             # If the function returns None, it is not held and the
             # packet must be forwarded
             if not pkt:
-                w.send(packet)
+                self._windows_forward(packet, w, pydivert, rec_chksums=False)
                 return
             # if the drop flag is activated, the network packet is dropped
             if pkt.drop:
+                counters[DROPPED] += 1
                 return
             # If the function returns the packet, we assign it to the
             # actual packet
             self.packet = pkt
+        self._windows_forward(packet, w, pydivert, rec_chksums=True)
+
+    def _windows_forward(self, packet, w, pydivert, rec_chksums):
+        """Forwards a pydivert packet with the content of the `Packet`.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Pydivert packet object.
+        w : pointer
+            windiver pointer.
+        rec_chksums : bool
+            True if the checksums must be recalculated.
+
+        """
+        if self._seqs is not None and \
+                self._seqs.rewrite(self.packet, len(packet.raw)):
+            rec_chksums = True
+        # Packets that have not been modified are forwarded as they are
+        if not self.packet.modified:
+            w.send(packet)
+            return
+        self._counters[MODIFIED] += 1
         # If all the functions are met, we assign the payload of the modified
         # packet to the pydivert packet and forward it
         # Before sending the packet, we recalculate the chksums fields
-        if self.packet.rec_chksums:
+        if rec_chksums and self.packet.rec_chksums:
             self.packet = self._rec_chksums(self.packet)
         packet = pydivert.Packet(
             self.packet.raw, packet.interface, packet.direction)
@@ -143,128 +720,303 @@ class Interceptor(object):
                 w.close()
         # For Linux platforms
         elif platform.system() == "Linux":
-            from netfilterqueue import NetfilterQueue
-            nfqueue = NetfilterQueue()
+            if self._queues > 1:
+                self._intercept_multiqueue()
+                return
             # The iptables rule queue number by default is 1
-            nfqueue.bind(1, self.linux_modify)
+            nfqueues = self._bind(self._queue_num)
+            if self._stats:
+                signal.signal(signal.SIGUSR1, self.show_stats)
             try:
                 self.set_iptables_rules()
                 print("[*] Waiting for packets...\n\n(Press Ctrl-C to exit)\n")
-                nfqueue.run()
+                self._run(nfqueues)
             except KeyboardInterrupt:
+                self.show_queue_stats()
+                self.show_stats()
                 self.clean_iptables()
         else:
             print("Sorry. Platform not supported!\n")
 
+    def _intercept_multiqueue(self):
+        """Starts one worker process per nfqueue queue and waits until the
+        user stops the interception."""
+        ctx = multiprocessing.get_context("fork")
+        self._shared_counters = ctx.RawArray(
+            "Q", len(COUNTERS) * self._queues)
+        stop = ctx.Event()
+        ready = ctx.Semaphore(0)
+        workers = [ctx.Process(target=self._queue_worker,
+                               args=(queue_num, stop, ready),
+                               name="polymorph-nfqueue-%d" % queue_num,
+                               daemon=True)
+                   for queue_num in range(self._queue_num,
+                                          self._queue_num + self._queues)]
+        if self._stats:
+            # The workers inherit the signal ignored until they install
+            # their own handler, so that it does not kill them while they
+            # start
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        for w in workers:
+            w.start()
+        if self._stats:
+            # The signal is forwarded to the workers, that own the stats
+            signal.signal(signal.SIGUSR1, lambda *args: [
+                os.kill(w.pid, signal.SIGUSR1) for w in workers])
+        # The rules are only cleaned if they were set, the cleaning flushes
+        # the chains
+        rules_set = False
+        try:
+            # The rules are set once every queue has a listener
+            for w in workers:
+                if not ready.acquire(timeout=10):
+                    print("[!] The nfqueue workers could not be started\n")
+                    return
+            self.set_iptables_rules()
+            rules_set = True
+            print("[*] Waiting for packets on %d queues...\n\n"
+                  "(Press Ctrl-C to exit)\n" % self._queues)
+            for w in workers:
+                w.join()
+        except KeyboardInterrupt:
+            self.show_queue_stats()
+        finally:
+            if rules_set:
+                self.clean_iptables()
+            stop.set()
+            for w in workers:
+                w.join(timeout=3)
+                if w.is_alive():
+                    w.terminate()
+
+    def _queue_worker(self, queue_num, stop, ready):
+        """Serves a single nfqueue queue until the stop event is set.
+
+        Parameters
+        ----------
+        queue_num : int
+            Number of the queue served by the worker.
+        stop : :obj:`multiprocessing.Event`
+            Event set by the parent process to stop the worker.
+        ready : :obj:`multiprocessing.Semaphore`
+            Semaphore released when the queue is bound.
+
+        """
+        # The parent process is the one that handles Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Each worker loads its own copy of the template and its functions
+        self.packet = Packet(self._template)
+        # The counters of the worker are a row of the shared array
+        row = 8 * len(COUNTERS) * (queue_num - self._queue_num)
+        self._counters = memoryview(self._shared_counters).cast("B")[
+            row:row + 8 * len(COUNTERS)].cast("Q")
+        if self._stats:
+            self._stats = InterceptorStats()
+            signal.signal(signal.SIGUSR1, self.show_stats)
+        self._functions = self._load_functions()
+        nfqueues = self._bind(queue_num)
+        ready.release()
+        self._run(nfqueues, stop)
+        self.show_stats()
+
+    def _bind(self, queue_num):
+        """Binds the nfqueue queues served by the current process.
+
+        Parameters
+        ----------
+        queue_num : int
+            Number of the queue.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`NetfilterQueue`
+            The queue and, if the copy range is limited, the queue that
+            reassembles its truncated packets.
+
+        """
+        from netfilterqueue import NetfilterQueue
+        self._index = queue_num - self._queue_num
+        opts = {}
+        if self.max_len:
+            opts["max_len"] = self.max_len
+        if self.sock_len:
+            opts["sock_len"] = self.sock_len
+        nfqueue = NetfilterQueue()
+        if not self.copy_range:
+            nfqueue.bind(queue_num, self.linux_modify, **opts)
+            return [nfqueue]
+        nfqueue.bind(queue_num, self.linux_modify, range=self.copy_range,
+                     **opts)
+        reassembly = NetfilterQueue()
+        reassembly.bind(self._reassembly_queue(self._index),
+                        self.linux_reassemble, **opts)
+        return [nfqueue, reassembly]
+
+    def _run(self, nfqueues, stop=None):
+        """Serves some nfqueue queues until the stop event is set.
+
+        Parameters
+        ----------
+        nfqueues : :obj:`list` of :obj:`NetfilterQueue`
+            Queues served by the current process.
+        stop : :obj:`multiprocessing.Event`, optional
+            Event set by the parent process to stop the worker.
+
+        """
+        fds = {nfqueue.get_fd(): nfqueue for nfqueue in nfqueues}
+        try:
+            while stop is None or not stop.is_set():
+                # The wheel of held packets is advanced on every tick
+                readable, _, _ = select.select(
+                    list(fds), [], [],
+                    self._timers.tick if len(self._timers) else 0.5)
+                for fd in readable:
+                    fds[fd].run(block=False)
+                if len(self._timers):
+                    self._release()
+        finally:
+            for nfqueue in nfqueues:
+                nfqueue.unbind()
+
     def _rec_chksums(self, packet):
         """Auxiliary function that makes it easy to recalculate the control fields
-        of some common layers."""
-
-        def chksum(packet):
-            if len(packet) % 2 != 0:
-                packet += b'\0'
-            res = sum(array.array("H", packet))
-            res = (res >> 16) + (res & 0xffff)
-            res += res >> 16
-            ck = (~res) & 0xffff
-            return struct.pack("H", ck).hex()
-
-        pkt_layers = list(packet._layers)
-
-        # Calculation of checksums for different layers on IPv4
-        if "IP" in pkt_layers and (packet["IP"]["version"] == 4 or packet["IP"]["version"][:3] == '0x4'):
-
-            # Handling the IPv4 checksum
-            packet["IP"]["checksum"] = '0x0000'
-            lstart = packet['IP'].slice.start - 14
-            lend = lstart + 20
-            ck = chksum(packet.raw[lstart:lend])
-            packet["IP"]["checksum"] = ck
-
-            # Handling TCP over IPv4
-            if "TCP" in pkt_layers and packet["IP"]["proto"] == 6:
-                # We build a false IP header
-                fake_hdr = struct.pack(
-                    '!4s4sHH',
-                    socket.inet_aton(packet["IP"]["src"]),
-                    socket.inet_aton(packet["IP"]["addr"]),
-                    6,
-                    len(packet["TCP"]))
-                packet["TCP"]["checksum"] = '0x0000'
-                ck = chksum(
-                    fake_hdr + packet.raw[packet['TCP'].slice.start - 14:])
-                packet["TCP"]["checksum"] = ck
-                return packet
-
-            # Handling ICMP over IPv4
-            elif 'ICMP' in pkt_layers and packet["IP"]["proto"] == 1:
-                packet["ICMP"]["checksum"] = '0x0000'
-                ck = chksum(packet.raw[packet['ICMP'].slice.start - 14:])
-                packet["ICMP"]["checksum"] = ck
-                return packet
-
-            # Handling UDP over IPv4
-            elif 'UDP' in pkt_layers and packet["IP"]["proto"] == 17:
-                # We build a false IP header
-                fake_hdr = struct.pack(
-                    '!4s4sHH',
-                    socket.inet_aton(packet["IP"]["src"]),
-                    socket.inet_aton(packet["IP"]["addr"]),
-                    17,
-                    len(packet["UDP"]))
-                packet["UDP"]["checksum"] = '0x0000'
-                ck = chksum(
-                    fake_hdr + packet.raw[packet['UDP'].slice.start - 14:])
-                packet["UDP"]["checksum"] = ck
-                return packet
-
-        # Calculation of checksums for different layers on IPv6
-        elif 'IPV6' in pkt_layers and packet["IPV6"]["version"] == 6:
-
-            # Handling TCP over IPv6
-            if "TCP" in pkt_layers and packet["IPV6"]["nxt"] == 6:
-                # We build a false IPV6 fake header
-                fake_hdr = struct.pack(
-                    '!16s16sHH',
-                    ipaddress.IPv6Address(packet["IPV6"]["src"]).packed,
-                    ipaddress.IPv6Address(packet["IPV6"]["addr"]).packed,
-                    6,
-                    len(packet["TCP"]))
-                packet["TCP"]["checksum"] = '0x0000'
-                ck = chksum(
-                    fake_hdr + packet.raw[packet['TCP'].slice.start - 14:])
-                packet["TCP"]["checksum"] = ck
-                return packet
-
-            # Handling ICMPV6 over IPv6
-            elif 'ICMPV6' in pkt_layers and packet["IPV6"]["nxt"] == 58:
-                # We build a false IPV6 header
-                fake_hdr = struct.pack(
-                    '!16s16sHH',
-                    ipaddress.IPv6Address(packet["IPV6"]["src"]).packed,
-                    ipaddress.IPv6Address(packet["IPV6"]["addr"]).packed,
-                    58,
-                    len(packet["ICMPV6"]))
-                packet["ICMPV6"]["checksum"] = '0x0000'
-                ck = chksum(
-                    fake_hdr + packet.raw[packet['ICMPV6'].slice.start - 14:])
-                packet["ICMPV6"]["checksum"] = ck
-                return packet
-
-            # Handling UDP over IPv6
-            elif 'UDP' in pkt_layers and packet["IPV6"]["nxt"] == 17:
-                # We build a false IPV6 header
-                fake_hdr = struct.pack(
-                    '!16s16sHH',
-                    ipaddress.IPv6Address(packet["IPV6"]["src"]).packed,
-                    ipaddress.IPv6Address(packet["IPV6"]["addr"]).packed,
-                    17,
-                    len(packet["UDP"]))
-                packet["UDP"]["checksum"] = '0x0000'
-                ck = chksum(
-                    fake_hdr + packet.raw[packet['UDP'].slice.start - 14:])
-                packet["UDP"]["checksum"] = ck
-                return packet
-
-        # If no condition is met we return the original package
+        of some common layers.
+
+        The checksums are updated incrementally (RFC 1624) from the
+        modifications recorded by the `Packet`, they are only recalculated
+        from scratch when the length of the packet has changed."""
+        layers = packet._layers
+        buf = packet._buf
+
+        # Checksum of the IPv4 header and pseudo header of the upper layer
+        if "IP" in layers and buf[packet["IP"].slice.start] >> 4 == 4:
+            ip = packet["IP"].slice.start
+            ihl = (buf[ip] & 0x0f) * 4
+            self._update_chksum(packet, ip + 10, [(ip, ip + ihl)])
+            proto = buf[ip + 9]
+            addrs = (ip + 12, ip + 20)
+        elif "IPV6" in layers and buf[packet["IPV6"].slice.start] >> 4 == 6:
+            ip = packet["IPV6"].slice.start
+            # The extension headers are skipped to find the upper layer
+            proto = header_offsets(buf, ip)[3]
+            addrs = (ip + 8, ip + 40)
+        else:
+            # If no condition is met we return the original package
+            return packet
+
+        # Checksum of the upper layer
+        if proto not in L4_CHKSUMS or L4_CHKSUMS[proto][0] not in layers:
+            return packet
+        lname, offset = L4_CHKSUMS[proto]
+        l4 = packet[lname].slice.start
+        if proto == 1:
+            # ICMP over IPv4 does not use pseudo header
+            self._update_chksum(packet, l4 + offset, [(l4, len(buf))])
+        else:
+            pseudo = struct.pack("!HH", proto, len(buf) - l4)
+            self._update_chksum(packet, l4 + offset,
+                                [addrs, (l4, len(buf))], pseudo,
+                                udp=proto == 17)
         return packet
+
+    @staticmethod
+    def _update_chksum(packet, offset, regions, pseudo=b'', udp=False):
+        """Updates the checksum located at a given offset of the packet
+        buffer.
+
+        Parameters
+        ----------
+        packet : :obj:`Packet`
+            Packet whose checksum will be updated.
+        offset : int
+            Position of the checksum in the buffer.
+        regions : :obj:`list` of :obj:`tuple`
+            Ranges (start, stop) of the buffer covered by the checksum.
+        pseudo : :obj:`bytes`
+            Words of the pseudo header that are not part of the buffer.
+        udp : bool
+            True if the checksum belongs to an UDP datagram.
+
+        """
+        buf = packet._buf
+        full = packet._rewritten
+        edits = []
+        for start, old, new in packet._edits:
+            # Modifications of the checksum itself can not be tracked
+            if start <= offset + 1 and offset < start + len(old):
+                full = True
+                break
+            for lo, hi in regions:
+                lo, hi = max(start, lo), min(start + len(old), hi)
+                if lo < hi:
+                    edits.append((old[lo - start:hi - start],
+                                  new[lo - start:hi - start]))
+
+        if full:
+            buf[offset:offset + 2] = b'\x00\x00'
+            res = _sum16(pseudo)
+            for lo, hi in regions:
+                res += _sum16(buf[lo:hi])
+        elif edits:
+            ck = struct.unpack_from("H", buf, offset)[0]
+            # An UDP checksum of zero means that it is not used
+            if udp and ck == 0:
+                return
+            # HC' = ~(~HC + ~m + m')
+            res = ~ck & 0xffff
+            for old, new in edits:
+                res += _sum16(new) + (~_sum16(old) & 0xffff)
+        else:
+            return
+        res = (res >> 16) + (res & 0xffff)
+        res = (res >> 16) + (res & 0xffff)
+        ck = (~res) & 0xffff
+        if udp and ck == 0:
+            ck = 0xffff
+        struct.pack_into("H", buf, offset, ck)
+
+
+def _ip_length(buf):
+    """Length of an IP packet according to its header."""
+    version = buf[ETHER_HEADROOM] >> 4
+    if version == 4:
+        return struct.unpack_from("!H", buf, ETHER_HEADROOM + 2)[0]
+    elif version == 6:
+        return struct.unpack_from("!H", buf, ETHER_HEADROOM + 4)[0] + 40
+    return len(buf) - ETHER_HEADROOM
+
+
+def _sum16(data):
+    """Ones' complement sum of the 16-bit words of some data."""
+    if len(data) % 2 != 0:
+        data = bytes(data) + b'\0'
+    res = sum(array.array("H", data))
+    res = (res >> 16) + (res & 0xffff)
+    return (res >> 16) + (res & 0xffff)
+
+
+# Counters of the packets intercepted by the `Interceptor`
+COUNTERS = ["packets", "bytes", "modified", "dropped"]
+PACKETS, BYTES, MODIFIED, DROPPED = range(len(COUNTERS))
+
+# Maximum growth of the IPv4 and TCP headers due to their options
+HEADER_OPTIONS_MARGIN = 80
+
+# Columns of /proc/net/netfilter/nfnetlink_queue after the queue number
+QUEUE_STATS = ["peer_portid", "queue_total", "copy_mode", "copy_range",
+               "queue_dropped", "user_dropped", "id_sequence"]
+
+# Mark suggested to stop intercepting the connections, see `bypass_mark`
+BYPASS_MARK = 0x504d
+
+# Mark of the modified packets that are requeued to be reassembled, the bits
+# 12 to 15 identify the queue and the lower bits the pending packet
+REASSEMBLY_MARK = 0x504d0000
+REASSEMBLY_MASK = 0xfffff000
+
+# Upper layers whose checksum is recalculated, by IP protocol number, with
+# the position of the checksum inside the layer
+L4_CHKSUMS = {6: ("TCP", 16),
+              17: ("UDP", 6),
+              1: ("ICMP", 2),
+              58: ("ICMPV6", 2)}
@@ -0,0 +1,318 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+from polymorph.converter import Converter
+from polymorph.ftype import Ftype
+from polymorph.packet import ANCHOR_IP, ANCHOR_L4, template_anchors
+
+# Operators of the conditions of a `Template`. The first five are applied
+# to a field or to the bytes at an offset of a layer, 'contains' searches
+# some bytes from an offset of a layer to the end of the packet
+OPERATORS = ["eq", "ne", "in", "range", "mask", "contains"]
+
+# Types of field whose conditions are evaluated on their integer value
+INTEGER_TYPES = (Ftype.FT_INT_BE, Ftype.FT_INT_LE, Ftype.FT_BIN_BE,
+                 Ftype.FT_BIN_LE)
+
+# Opcodes of the classic BPF instructions used by `bpf_bytecode`
+BPF_LD_W, BPF_LD_H, BPF_LD_B = 0x20, 0x28, 0x30
+# Added to an absolute load it becomes a load relative to the X register
+BPF_IND = 0x20
+BPF_LDX_MSH = 0xb1
+BPF_AND = 0x54
+BPF_JEQ, BPF_JGT, BPF_JGE = 0x15, 0x25, 0x35
+BPF_RET = 0x06
+# Longest forward jump of a classic BPF conditional instruction
+BPF_MAX_JUMP = 255
+# Maximum number of instructions of a program of the iptables bpf match
+# (XT_BPF_MAX_NUM_INSTR)
+BPF_MAX_INSNS = 64
+
+
+class _Operand(object):
+    """Bytes of the packet on which a condition is evaluated."""
+
+    def __init__(self, template, anchors, condition):
+        layer = template.getlayer(condition["layer"])
+        if layer is None:
+            raise ValueError("The layer %s is not in the template" %
+                             condition["layer"])
+        self.anchor = anchors[layer.name]
+        self.field = None
+        self.mask = None
+        self.order = "big"
+        if condition.get("field"):
+            field = layer.getfield(condition["field"])
+            if field is None:
+                raise ValueError("The field %s is not in the layer %s" % (
+                    condition["field"], layer.name))
+            if field.name in layer.get_structs():
+                raise ValueError("The position of the field %s is "
+                                 "calculated at run time" % field.name)
+            self.field = field
+            self.start, self.stop = field.slice.start, field.slice.stop
+            if field.type in INTEGER_TYPES:
+                if field.type in (Ftype.FT_INT_LE, Ftype.FT_BIN_LE):
+                    self.order = "little"
+                if field.type in (Ftype.FT_BIN_BE, Ftype.FT_BIN_LE):
+                    self.mask = field.mask
+        else:
+            self.start = layer.slice.start + condition.get("offset", 0)
+            self.stop = self.start
+        self.integer = self.field is not None and \
+            self.field.type in INTEGER_TYPES
+
+    def value(self, value):
+        """Converts the value of a condition to the bytes of the field."""
+        if self.integer:
+            return int(value)
+        if self.field is None or self.field.type == Ftype.FT_BYTES:
+            return bytes.fromhex(value)
+        return Converter().get_fraw(value, self.field.type,
+                                    bytes(self.field.size), self.field.size,
+                                    self.field.mask, self.field.name)
+
+
+def _conditions_operands(template, conditions):
+    """Resolves the operands and values of a list of conditions, checking
+    that they are well formed."""
+    anchors, _ = template_anchors(template)
+    resolved = []
+    for cond in conditions:
+        op = cond.get("op")
+        if op not in OPERATORS:
+            raise ValueError("Unknown operator %s" % op)
+        operand = _Operand(template, anchors, cond)
+        if op == "contains":
+            if operand.field is not None:
+                raise ValueError("'contains' is applied to an offset")
+            value = operand.value(cond["value"])
+        elif op == "mask":
+            mask = bytes.fromhex(cond["mask"])
+            value = bytes.fromhex(cond["value"])
+            if len(mask) != len(value):
+                raise ValueError("The mask and the value must have the "
+                                 "same length")
+            if operand.field is None:
+                operand.stop = operand.start + len(mask)
+            elif operand.stop - operand.start != len(mask):
+                raise ValueError("The mask must have the length of the "
+                                 "field")
+            value = (int.from_bytes(mask, "big"), int.from_bytes(value, "big"))
+        elif op == "range":
+            if not operand.integer:
+                raise ValueError("'range' is applied to integer fields")
+            value = (int(cond["value"][0]), int(cond["value"][1]))
+        elif op == "in":
+            value = [operand.value(v) for v in cond["value"]]
+        else:
+            value = operand.value(cond["value"])
+        if operand.field is None and op in ("eq", "ne", "in"):
+            sizes = set(len(v) for v in (value if op == "in" else [value]))
+            if len(sizes) != 1:
+                raise ValueError("The values must have the same length")
+            operand.stop = operand.start + sizes.pop()
+        resolved.append((op, operand, value))
+    return resolved
+
+
+def compile_conditions(template, conditions=None):
+    """Compiles the conditions of a `Template` into a single function that
+    is evaluated directly on the buffer of a `Packet`, before any of the
+    functions of the `Template`.
+
+    Parameters
+    ----------
+    template : :obj:`Template`
+        The `Template` whose layers and fields are referenced by the
+        conditions.
+    conditions : :obj:`list` of :obj:`dict`, optional
+        Conditions to compile, by default the ones of the `Template`.
+
+    Returns
+    -------
+    :obj:`function`
+        Function that receives the buffer and the displacements of the
+        layers of a `Packet` and returns True if all the conditions are met,
+        or None if there are no conditions.
+
+    """
+    if conditions is None:
+        conditions = template.conditions()
+    if not conditions:
+        return None
+    consts = {}
+    code = ["def match(buf, shifts):", "    n = len(buf)"]
+    resolved = _conditions_operands(template, conditions)
+    for a in sorted(set(operand.anchor for _, operand, _ in resolved)):
+        code.append("    s%d = shifts[%d]" % (a, a))
+    for i, (op, o, value) in enumerate(resolved):
+        name = "c%d" % i
+        raw = "buf[%d + s%d:%d + s%d]" % (o.start, o.anchor, o.stop, o.anchor)
+        if op == "contains":
+            consts[name] = value
+            test = "%s in buf[%d + s%d:]" % (name, o.start, o.anchor)
+        elif op == "mask":
+            test = "int.from_bytes(%s, 'big') & %d == %d" % (
+                raw, value[0], value[1])
+        else:
+            # Integer fields are compared with the value of the field,
+            # the rest with its bytes
+            if o.integer:
+                raw = "int.from_bytes(%s, '%s')" % (raw, o.order)
+                if o.mask:
+                    lsb = (o.mask & -o.mask).bit_length() - 1
+                    raw = "(%s & %d) >> %d" % (raw, o.mask, lsb)
+            if op == "eq":
+                consts[name] = value
+                test = "%s == %s" % (raw, name)
+            elif op == "ne":
+                consts[name] = value
+                test = "%s != %s" % (raw, name)
+            elif op == "in":
+                consts[name] = frozenset(value)
+                test = "%s in %s" % (raw if o.integer else
+                                     "bytes(%s)" % raw, name)
+            else:
+                test = "%d <= %s <= %d" % (value[0], raw, value[1])
+        code.append("    if n < %d + s%d or not (%s):" % (
+            o.stop, o.anchor, test))
+        code.append("        return False")
+    code.append("    return True")
+    namespace = dict(consts)
+    exec("\n".join(code), namespace)
+    return namespace["match"]
+
+
+def bpf_bytecode(template, conditions=None):
+    """Translates the conditions of a `Template` into a classic BPF
+    program, in the format of the iptables bpf match. The packets are
+    filtered in the kernel and the ones that do not meet the conditions are
+    never queued.
+
+    Parameters
+    ----------
+    template : :obj:`Template`
+        The `Template` whose layers and fields are referenced by the
+        conditions.
+    conditions : :obj:`list` of :obj:`dict`, optional
+        Conditions to translate, by default the ones of the `Template`.
+
+    Returns
+    -------
+    :obj:`str`
+        Bytecode for the --bytecode option of the bpf match, or None if
+        there are no conditions or they can not be translated: the
+        'contains' operator, conditions on the payload or on little endian
+        fields, in IPv6, conditions after the IP header and programs longer
+        than the bpf match accepts.
+
+    """
+    if conditions is None:
+        conditions = template.conditions()
+    _, tstarts = template_anchors(template)
+    if not conditions or tstarts is None:
+        return None
+    tip, tl4 = tstarts[0], tstarts[1]
+    ipv4 = template.raw[tip] >> 4 == 4
+    # Each check is a list of instructions (code, jump if true, jump if
+    # false, k) in which the jump 'fail' leads to the rejection
+    checks = []
+    l4 = False
+    for op, o, value in _conditions_operands(template, conditions):
+        if op == "contains" or o.order != "big":
+            return None
+        if o.anchor == ANCHOR_IP:
+            start = o.start - tip
+        elif o.anchor == ANCHOR_L4 and ipv4 and tl4 is not None:
+            start, l4 = o.start - tl4, True
+        else:
+            return None
+        # The bytes of the operand are loaded in words of up to 4 bytes
+        size = o.stop - o.start
+        if size not in (1, 2, 4) and (o.integer or op in ("in", "range")):
+            return None
+        mode = BPF_IND if o.anchor == ANCHOR_L4 else 0
+        if op == "mask" or not o.integer:
+            if op in ("in", "range"):
+                return None
+            if op == "mask":
+                mask, target = value
+            else:
+                mask, target = (1 << 8 * size) - 1, int.from_bytes(value,
+                                                                    "big")
+            words = []
+            pos = 0
+            while pos < size:
+                width = 4 if size - pos >= 4 else 2 if size - pos >= 2 else 1
+                shift = 8 * (size - pos - width)
+                full = (1 << 8 * width) - 1
+                words.append((start + pos, width, (mask >> shift) & full,
+                              (target >> shift) & full))
+                pos += width
+            check = []
+            for offset, width, wmask, wtarget in words:
+                if not wmask:
+                    continue
+                check.append((_bpf_load(width) + mode, 0, 0, offset))
+                if wmask != (1 << 8 * width) - 1:
+                    check.append((BPF_AND, 0, 0, wmask))
+                if op == "ne":
+                    check.append((BPF_JEQ, 0, "next", wtarget))
+                else:
+                    check.append((BPF_JEQ, 0, "fail", wtarget))
+            if op == "ne":
+                # The field is different if any of its words is different
+                check[-1] = check[-1][:1] + ("fail", 0, check[-1][3])
+            checks.append(check)
+            continue
+        check = [(_bpf_load(size) + mode, 0, 0, start)]
+        lsb = 0
+        if o.mask:
+            lsb = (o.mask & -o.mask).bit_length() - 1
+            check.append((BPF_AND, 0, 0, o.mask))
+        if op == "eq":
+            check.append((BPF_JEQ, 0, "fail", value << lsb))
+        elif op == "ne":
+            check.append((BPF_JEQ, "fail", 0, value << lsb))
+        elif op == "in":
+            for v in value[:-1]:
+                check.append((BPF_JEQ, "next", 0, v << lsb))
+            check.append((BPF_JEQ, 0, "fail", value[-1] << lsb))
+        else:
+            check.append((BPF_JGE, 0, "fail", value[0] << lsb))
+            check.append((BPF_JGT, "fail", 0, value[1] << lsb))
+        checks.append(check)
+    program = [(BPF_LDX_MSH, 0, 0, 0)] if l4 else []
+    for check in checks:
+        end = len(program) + len(check)
+        for code, jt, jf, k in check:
+            program.append((code, jt, jf, k, end))
+    # The accepted packets return a non zero value
+    fail = len(program) + 1
+    insns = []
+    for pc, insn in enumerate(program):
+        if len(insn) == 4:
+            insns.append(insn)
+            continue
+        code, jt, jf, k, end = insn
+        jumps = []
+        for jump in (jt, jf):
+            target = fail if jump == "fail" else end if jump == "next" \
+                else pc + 1
+            if target - pc - 1 > BPF_MAX_JUMP:
+                return None
+            jumps.append(target - pc - 1)
+        insns.append((code, jumps[0], jumps[1], k))
+    insns.append((BPF_RET, 0, 0, 0xffff))
+    insns.append((BPF_RET, 0, 0, 0))
+    if len(insns) > BPF_MAX_INSNS:
+        return None
+    return "%d,%s" % (len(insns), ",".join(
+        "%d %d %d %d" % insn for insn in insns))
+
+
+def _bpf_load(width):
+    """Opcode of the absolute load of a word of some bytes."""
+    return {4: BPF_LD_W, 2: BPF_LD_H, 1: BPF_LD_B}[width]
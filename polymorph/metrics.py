@@ -0,0 +1,196 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from polymorph.interceptor import Interceptor
+from polymorph.stats import OUTCOMES
+
+# Address used by default by the `MetricsExporter`
+DEFAULT_ADDRESS = "127.0.0.1:9450"
+
+# Quantiles of the latencies of the functions that are exported
+QUANTILES = [("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"),
+             ("0.999", "p999")]
+
+
+class MetricsExporter(object):
+    """Exposes the counters of a running `Interceptor` and of an
+    `ARPpoisoner` in the Prometheus text format. The metrics are built when
+    they are requested, the interception only updates counters."""
+
+    def __init__(self, interceptor=None, poisoner=None,
+                 address=DEFAULT_ADDRESS):
+        """Initialization method of the `MetricsExporter` class.
+
+        Parameters
+        ----------
+        interceptor : :obj:`Interceptor`, optional
+            The `Interceptor` whose counters will be exported.
+        poisoner : :obj:`ARPpoisoner`, optional
+            The ARP poisoner whose status will be exported.
+        address : :obj:`str`
+            Address of the endpoint, of the form 'host:port' or
+            'unix:/path/of/the/socket'. It is served over HTTP, the UNIX
+            socket can be queried with `curl --unix-socket`.
+
+        """
+        self._interceptor = interceptor
+        self._poisoner = poisoner
+        self._address = address
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        """:obj:`str`: Address of the endpoint."""
+        return self._address
+
+    def start(self):
+        """Starts serving the metrics from a background thread."""
+        if self._address.startswith("unix:"):
+            path = self._address[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = _UnixHTTPServer(path, _MetricsHandler)
+        else:
+            host, port = self._address.rsplit(":", 1)
+            self._server = ThreadingHTTPServer((host, int(port)),
+                                               _MetricsHandler)
+        self._server.exporter = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="polymorph-metrics",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving the metrics."""
+        if not self._server:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        if self._address.startswith("unix:"):
+            try:
+                os.unlink(self._address[len("unix:"):])
+            except OSError:
+                pass
+        self._server = None
+
+    def render(self):
+        """Builds the metrics in the Prometheus text format.
+
+        Returns
+        -------
+        :obj:`str`
+            The exposition of all the metrics.
+
+        """
+        lines = []
+        if self._interceptor:
+            self._interceptor_metrics(lines)
+        if self._poisoner:
+            self._poisoner_metrics(lines)
+        return "\n".join(lines) + "\n"
+
+    def _interceptor_metrics(self, lines):
+        """Adds the metrics of the `Interceptor` to a list of lines."""
+        i = self._interceptor
+        counters = i.counters()
+        for name, help in [("packets", "Packets intercepted."),
+                           ("bytes", "Bytes of the packets intercepted."),
+                           ("modified", "Packets modified."),
+                           ("dropped", "Packets dropped by the functions.")]:
+            _metric(lines, "polymorph_%s_total" % name, "counter", help,
+                    [("", counters[name])])
+        # Counters of the kernel for the queues of the `Interceptor`
+        stats = Interceptor.queue_stats()
+        queues = [q for q in range(i._queue_num, i._queue_num + i._queues)
+                  if q in stats]
+        for name, key, mtype, help in [
+                ("queue_waiting", "queue_total", "gauge",
+                 "Packets waiting in the queue."),
+                ("queue_dropped_total", "queue_dropped", "counter",
+                 "Packets dropped because the queue was full."),
+                ("queue_user_dropped_total", "user_dropped", "counter",
+                 "Packets dropped because the netlink socket was full.")]:
+            _metric(lines, "polymorph_" + name, mtype, help,
+                    [('{queue="%d"}' % q, stats[q][key]) for q in queues])
+        if not i._stats:
+            return
+        # Latencies of the functions, only available in the process that
+        # runs them
+        functions = i._stats.dict()
+        samples = []
+        for fname, s in functions.items():
+            label = _escape(fname)
+            for quantile, key in QUANTILES:
+                samples.append(('{function="%s",quantile="%s"}' % (
+                    label, quantile), s[key] / 1e9))
+            samples.append(('_sum{function="%s"}' % label,
+                            s["mean"] * s["count"] / 1e9))
+            samples.append(('_count{function="%s"}' % label, s["count"]))
+        _metric(lines, "polymorph_function_latency_seconds", "summary",
+                "Latency of the functions of the template.", samples)
+        samples = []
+        for fname, s in functions.items():
+            for outcome in OUTCOMES:
+                if outcome in s:
+                    samples.append(('{function="%s",outcome="%s"}' % (
+                        _escape(fname), outcome), s[outcome]))
+        _metric(lines, "polymorph_function_outcomes_total", "counter",
+                "Outcomes of the functions of the template.", samples)
+
+    def _poisoner_metrics(self, lines):
+        """Adds the metrics of the `ARPpoisoner` to a list of lines."""
+        p = self._poisoner
+        _metric(lines, "polymorph_arp_poisoning", "gauge",
+                "1 if the ARP poisoner is sending packets.",
+                [("", int(bool(p.send)))])
+        _metric(lines, "polymorph_arp_resolved_targets", "gauge",
+                "Targets whose MAC address has been resolved.",
+                [("", len(p.arp_cache))])
+        for index, (name, help) in enumerate([
+                ("rounds", "Poisoning rounds."),
+                ("sent", "ARP packets sent."),
+                ("errors", "Errors sending ARP packets."),
+                ("unresolved", "Targets skipped because their MAC address "
+                               "could not be resolved.")]):
+            _metric(lines, "polymorph_arp_%s_total" % name, "counter", help,
+                    [("", p.counters[index])])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Answers every GET request with the metrics of the exporter."""
+
+    def do_GET(self):
+        body = self.server.exporter.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The requests are not printed in the console of polymorph
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    """HTTP server listening on a UNIX socket."""
+    daemon_threads = True
+
+
+def _metric(lines, name, mtype, help, samples):
+    """Adds a metric and its samples to a list of lines."""
+    lines.append("# HELP %s %s" % (name, help))
+    lines.append("# TYPE %s %s" % (name, mtype))
+    for suffix, value in samples:
+        lines.append("%s%s %s" % (name, suffix, value))
+
+
+def _escape(value):
+    """Escapes the value of a label."""
+    return value.replace("\\", "\\\\").replace('"', '\\"')
@@ -2,10 +2,41 @@
 # Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
 # For more information about the project: https://github.com/shramos/polymorph
 
-from collections import OrderedDict
+from struct import Struct
 from polymorph.converter import Converter
-
-raw = None
+from polymorph.ftype import Ftype
+
+# Bytes reserved at the beginning of the buffer for the Ethernet layer that
+# nfqueue.get_payload() does not include. The slices of the `Template` are
+# relative to the beginning of the Ethernet layer.
+ETHER_HEADROOM = 14
+
+# Structs used to access the integer and binary fields, by type and size
+_INT_STRUCTS = {(Ftype.FT_INT_BE, 1): Struct("!B"),
+                (Ftype.FT_INT_BE, 2): Struct("!H"),
+                (Ftype.FT_INT_BE, 4): Struct("!I"),
+                (Ftype.FT_INT_BE, 8): Struct("!Q"),
+                (Ftype.FT_INT_LE, 1): Struct("<B"),
+                (Ftype.FT_INT_LE, 2): Struct("<H"),
+                (Ftype.FT_INT_LE, 4): Struct("<I"),
+                (Ftype.FT_INT_LE, 8): Struct("<Q"),
+                (Ftype.FT_BIN_BE, 1): Struct("!B"),
+                (Ftype.FT_BIN_BE, 2): Struct("!H"),
+                (Ftype.FT_BIN_BE, 4): Struct("!I"),
+                (Ftype.FT_BIN_LE, 1): Struct("<B"),
+                (Ftype.FT_BIN_LE, 2): Struct("<H"),
+                (Ftype.FT_BIN_LE, 4): Struct("<I")}
+
+# Headers that determine the position of the layers of a packet. The layers
+# of the `Template` are displaced by the difference between the position of
+# their header in the packet and in the `Template`
+ANCHOR_IP, ANCHOR_L4, ANCHOR_PAYLOAD, ANCHOR_NONE = range(4)
+
+# Layers located right after the IP header and its extensions
+L4_LAYERS = ("TCP", "UDP", "ICMP", "ICMPV6")
+
+# IPv6 extension headers that are skipped to find the upper layer
+_IPV6_EXTENSIONS = (0, 43, 44, 51, 60, 135)
 
 
 class Packet(object):
@@ -22,30 +53,250 @@ class Packet(object):
             layers.
 
         """
-        self._layers = {l.name: PacketLayer(l)
+        # Mutable buffer with the packet content preceded by the headroom
+        # of the Ethernet layer, it is reused between packets
+        self._buf = bytearray(ETHER_HEADROOM)
+        # Modifications made since the packet was loaded, in the form
+        # (start, old bytes, new bytes) aligned to 16-bit words, used to
+        # update the checksums incrementally
+        self._edits = []
+        # True when the length of the packet changed or the buffer was
+        # replaced, the checksums must be recalculated from scratch
+        self._rewritten = False
+        # Counter that changes whenever the positions calculated by the
+        # `Struct` of the layers may have changed, and the ranges of the
+        # buffer on which those positions depend
+        self._generation = 0
+        self._watched = []
+        # Displacement of the layers anchored to each header with respect to
+        # the `Template`, recalculated for every packet
+        self._shifts = [0, 0, 0, 0]
+        # Ranges of the buffer with the header fields from which the
+        # displacements are calculated (lengths, protocols and fragments)
+        self._layout = ()
+        self._anchors, self._tstarts = template_anchors(template)
+        self._layers = {l.name: PacketLayer(l, self)
                         for l in template.layers}
+        # Automata of the dictionaries of patterns of the `Template`, shared
+        # by all its packets
+        self._dictionaries = {n: template.automaton(n)
+                              for n in template.dictionary_names()}
         self.drop = False
         self.rec_chksums = True
+        # If activated, the packet is accepted and the rest of the packets
+        # of its connection are no longer intercepted
+        self.bypass = False
+        # Delay, release condition and timeout of the verdict of the packet
+        self._hold = None
 
     def __getitem__(self, item):
         return self._layers[item]
 
     def __len__(self):
-        return len(self.raw)
+        return len(self._buf) - ETHER_HEADROOM
 
     @property
     def raw(self):
         """:obj:`bytes`: Packet bytes."""
-        global raw
         # The payload is returned without the Ethernet layer
-        return raw[14:]
+        return bytes(self._buf[ETHER_HEADROOM:])
 
     @raw.setter
     def raw(self, value):
-        global raw
-        # Padding for Ether layer that nfqueue.get_payload() ignores
-        # TODO: Do this in a better way
-        raw = b'\x00' * 14 + value
+        # The headroom of the Ethernet layer is preserved and the new
+        # content is copied over the existing buffer
+        self._buf[ETHER_HEADROOM:] = value
+        self._rewritten = True
+        self._generation += 1
+        self._locate()
+
+    @property
+    def modified(self):
+        """bool: True if the packet has been modified since it was
+        loaded."""
+        return self._rewritten or bool(self._edits)
+
+    def load(self, payload):
+        """Loads the content of a new intercepted packet, discarding the
+        modifications recorded for the previous one.
+
+        Parameters
+        ----------
+        payload : :obj:`bytes`
+            The packet in bytes without the ethernet layer.
+
+        """
+        self._buf[ETHER_HEADROOM:] = payload
+        self._edits.clear()
+        self._rewritten = False
+        self._generation += 1
+        self._locate()
+        self.bypass = False
+        self._hold = None
+
+    def _locate(self):
+        """Recalculates the displacement of the layers from the length
+        fields of the headers of the packet."""
+        if self._tstarts is None:
+            return
+        shifts = self._shifts
+        buf = self._buf
+        offsets = header_offsets(buf, ETHER_HEADROOM)
+        if offsets is None:
+            self._layout = ((ETHER_HEADROOM, ETHER_HEADROOM + 1),)
+            shifts[ANCHOR_IP] = shifts[ANCHOR_L4] = shifts[ANCHOR_PAYLOAD] = 0
+            return
+        ip, l4, payload, proto = offsets
+        if buf[ip] >> 4 == 4:
+            layout = [(ip, ip + 1), (ip + 6, ip + 8), (ip + 9, ip + 10)]
+        else:
+            # The extension headers are walked through their next header
+            # and length fields
+            layout = [(ip, ip + 1), (ip + 6, ip + 7),
+                      (ip + 40, len(buf) if l4 is None else l4)]
+        if proto == 6:
+            layout.append((l4 + 12, l4 + 13))
+        self._layout = layout
+        tip, tl4, tpayload, _ = self._tstarts
+        # If a header is not found, the layers keep the displacement of the
+        # previous header
+        shifts[ANCHOR_IP] = ip - tip
+        shifts[ANCHOR_L4] = l4 - tl4 if l4 is not None and \
+            tl4 is not None else shifts[ANCHOR_IP]
+        shifts[ANCHOR_PAYLOAD] = payload - tpayload if payload is not None \
+            and tpayload is not None else shifts[ANCHOR_L4]
+
+    def hold(self, ms):
+        """Delays the forwarding of the packet without blocking the
+        interception of the rest of the packets.
+
+        Parameters
+        ----------
+        ms : float
+            Milliseconds that the packet will be held.
+
+        """
+        self._hold = (ms, None, None)
+
+    def hold_until(self, condition, timeout=None):
+        """Holds the packet until a condition is met, without blocking the
+        interception of the rest of the packets.
+
+        Parameters
+        ----------
+        condition : :obj:`function`
+            Function without parameters that returns True when the packet
+            must be forwarded. It is checked periodically.
+        timeout : float, optional
+            Maximum number of milliseconds that the packet will be held.
+
+        """
+        self._hold = (0, condition, timeout)
+
+    def write(self, start, stop, value):
+        """Writes a value between two positions of the buffer, recording the
+        modification so that the checksums can be updated incrementally.
+
+        Parameters
+        ----------
+        start: int
+            First index in the buffer (including the Ethernet layer).
+        stop: int
+            Last index in the buffer (including the Ethernet layer).
+        value: :obj:`bytes`
+            Value to write in the buffer.
+
+        """
+        buf = self._buf
+        if stop - start != len(value):
+            buf[start:stop] = value
+            self._rewritten = True
+            self._generation += 1
+            self._locate()
+            return
+        for lo, hi, anchor in self._watched:
+            shift = self._shifts[anchor]
+            if start < hi + shift and lo + shift < stop:
+                self._generation += 1
+                break
+        # The modified bytes are extended to whole 16-bit words
+        wstart = start & ~1
+        wstop = stop + (stop & 1)
+        old = bytes(buf[wstart:wstop])
+        buf[start:stop] = value
+        self._edits.append((wstart, old, bytes(buf[wstart:wstop])))
+        # The headers may have moved if their lengths or protocols changed
+        for lo, hi in self._layout:
+            if start < hi and lo < stop:
+                self._generation += 1
+                self._locate()
+                break
+
+    def replace_all(self, patterns, start=None):
+        """Replaces a whole dictionary of patterns in a single pass over the
+        packet. When the length of the packet changes, the length fields of
+        the IP and UDP headers are updated.
+
+        Parameters
+        ----------
+        patterns : :obj:`str`, :obj:`AhoCorasick`
+            Name of a dictionary of the `Template`, or an automaton built
+            from a dictionary of the form {pattern: replacement}.
+        start : int, optional
+            Index in the buffer (including the Ethernet layer) from which
+            the patterns are searched, by default the beginning of the
+            payload of the upper layer.
+
+        Returns
+        -------
+        int
+            Number of replacements.
+
+        """
+        if isinstance(patterns, str):
+            patterns = self._dictionaries[patterns]
+        buf = self._buf
+        if start is None:
+            offsets = header_offsets(buf, ETHER_HEADROOM)
+            if offsets is None or offsets[2] is None:
+                return 0
+            start = offsets[2]
+        data = bytes(buf)
+        matches = patterns.matches(data, start)
+        if not matches:
+            return 0
+        if all(e - s == len(r) for s, e, r in matches):
+            # The packet keeps its length, only the matches are written
+            for s, e, r in matches:
+                self.write(s, e, r)
+            return len(matches)
+        # The rest of the packet is spliced at once
+        pieces = []
+        pos = start
+        for s, e, r in matches:
+            pieces.append(data[pos:s])
+            pieces.append(r)
+            pos = e
+        pieces.append(data[pos:])
+        self.write(start, len(buf), b"".join(pieces))
+        self._fix_lengths()
+        return len(matches)
+
+    def _fix_lengths(self):
+        """Updates the length fields of the IP header and of the UDP header
+        after the length of the packet has changed."""
+        buf = self._buf
+        offsets = header_offsets(buf, ETHER_HEADROOM)
+        if offsets is None:
+            return
+        ip, l4, _, proto = offsets
+        if buf[ip] >> 4 == 4:
+            self.write(ip + 2, ip + 4, (len(buf) - ip).to_bytes(2, "big"))
+        else:
+            self.write(ip + 4, ip + 6,
+                       (len(buf) - ip - 40).to_bytes(2, "big"))
+        if proto == 17 and l4 is not None:
+            self.write(l4 + 4, l4 + 6, (len(buf) - l4).to_bytes(2, "big"))
 
     def get_payload(self):
         """Returns the payload of the packet in bytes."""
@@ -94,89 +345,243 @@ class Packet(object):
         if index1 >= index2 and type(value) is not bytes:
             raise ValueError
         else:
-            payload = b'\x00' * 14 + self.raw
-            payload = payload[:index1] + value + payload[index2:]
-            self.raw = payload[14:]
+            self.write(index1, index2, value)
 
 
 class PacketLayer(object):
     """This class encapsulates de Template layers, so the user can access the
     content of the intercepted packet in an easy an intuitive way."""
 
-    def __init__(self, tlayer):
+    def __init__(self, tlayer, packet):
         """Initialization method of the class.
 
         Parameters
         ----------
         tlayer : :obj:`TLayer`
-ampl            A template layer for accessing the raw intercepted packet.
+            A template layer for accessing the raw intercepted packet.
+        packet : :obj:`Packet`
+            The packet that owns the buffer in which the layer is located.
 
         """
         self._tlayer = tlayer
+        self._pkt = packet
+        self._anchor = packet._anchors[tlayer.name]
         self._struct = tlayer.get_structs()
         self._fields = {f.name: (f.slice, f.type, f.mask, f.size)
                         for f in tlayer.fields}
         self._cv = Converter()
+        # Specialized accessors for every field, built once per layer
+        self._getters = {}
+        self._setters = {}
+        for fname in self._fields:
+            if fname in self._struct:
+                getter, setter = self._struct_accessors(fname)
+            else:
+                getter, setter = self._compile_accessors(fname)
+            self._getters[fname] = getter
+            self._setters[fname] = setter
 
     def __getitem__(self, item):
-        global raw
-        fslice, ftype, fmask, fsize = self._fields[item]
-        if item in self._struct:
-            fstruct = self._struct[item]
-            fraw = fstruct.parse(raw)[item]
-        else:
-            fraw = raw[fslice]
         # Return the field with the appropriate interpretation
-        return self._cv.get_frepr(ftype, fraw, fsize, fmask, item)
+        return self._getters[item]()
 
     def __setitem__(self, key, value):
-        global raw
-        fslice, ftype, fmask, fsize = self._fields[key]
-        if key in self._struct:
-            fstruct = self._struct[key]
-            fraw = fstruct.parse(raw)
-            start_byte = PacketLayer._get_start_byte(fstruct, fraw, key)
-            fsize = len(fraw[key])
-            stop_byte = start_byte + fsize
-        else:
-            start_byte = fslice.start
-            stop_byte = fslice.stop
-            fraw = raw[fslice]
-        # obtain the bytes from the representation of the field
-        fraw = self._cv.get_fraw(value, ftype, fraw, fsize, fmask, key)
-        # add the new value to the packet content
-        raw = raw[:start_byte] + fraw + raw[stop_byte:]
+        self._setters[key](value)
 
     def __len__(self):
-        global raw
-        return len(raw) - self._tlayer.slice.start
-
-    @staticmethod
-    def _getflens(st, praw):
-        d = OrderedDict()
-        for s in st.subcons:
-            try:
-                d[s.name] = s.sizeof()
-            except:
-                d[s.name] = None
-        for f in praw:
-            try:
-                if not d[f]:
-                    d[f] = len(praw[f])
-            except KeyError:
-                pass
-        return d
-
-    @staticmethod
-    def _get_start_byte(fstruct, fraw, field):
-        flens = PacketLayer._getflens(fstruct, fraw)
-        st_byte = 0
-        for f in flens:
-            if f == field:
-                break
-            st_byte += flens[f]
-        return st_byte
+        return len(self._pkt._buf) - self.slice.start
+
+    def _compile_accessors(self, fname):
+        """Builds the getter and setter of a field with a fixed position,
+        with its type, offset, mask and byte order resolved in advance."""
+        fslice, ftype, fmask, fsize = self._fields[fname]
+        buf = self._pkt._buf
+        write = self._pkt.write
+        # The position of the field is displaced like its layer
+        shifts, a = self._pkt._shifts, self._anchor
+        start, stop = fslice.start, fslice.stop
+        st = _INT_STRUCTS.get((ftype, fsize))
+
+        # Integers that can be read with a single unpack
+        if st and ftype in (Ftype.FT_INT_BE, Ftype.FT_INT_LE):
+            unpack_from, pack = st.unpack_from, st.pack
+
+            def getter():
+                return unpack_from(buf, start + shifts[a])[0]
+
+            def setter(value):
+                shift = shifts[a]
+                write(start + shift, stop + shift, pack(value))
+
+        # Binary fields, the mask is applied with integer operations
+        elif st and fmask and ftype in (Ftype.FT_BIN_BE, Ftype.FT_BIN_LE):
+            unpack_from, pack = st.unpack_from, st.pack
+            lsb = (fmask & -fmask).bit_length() - 1
+            keep = ~fmask & ((1 << 8 * fsize) - 1)
+
+            def getter():
+                return (unpack_from(buf, start + shifts[a])[0] & fmask) >> lsb
+
+            def setter(value):
+                shift = shifts[a]
+                old = unpack_from(buf, start + shift)[0]
+                write(start + shift, stop + shift, pack(
+                    (old & keep) | ((value << lsb) & fmask)))
+
+        # The rest of types are interpreted by the `Converter`
+        else:
+            get_frepr, get_fraw = self._cv.get_frepr, self._cv.get_fraw
+
+            def getter():
+                shift = shifts[a]
+                return get_frepr(ftype, bytes(buf[start + shift:stop + shift]),
+                                 fsize, fmask, fname)
+
+            def setter(value):
+                shift = shifts[a]
+                fraw = get_fraw(value, ftype,
+                                bytes(buf[start + shift:stop + shift]),
+                                fsize, fmask, fname)
+                # the buffer is only reallocated when the length of the
+                # field changes
+                write(start + shift, stop + shift, fraw)
+
+        return getter, setter
+
+    def _struct_accessors(self, fname):
+        """Builds the getter and setter of a field whose position is
+        calculated at run time by a `Struct`."""
+        fslice, ftype, fmask, fsize = self._fields[fname]
+        parser = self._tlayer.get_struct_parser(fname)
+        pkt = self._pkt
+        buf = pkt._buf
+        shifts, a = pkt._shifts, self._anchor
+        get_frepr, get_fraw = self._cv.get_frepr, self._cv.get_fraw
+        # The position of the field only changes when the packet changes
+        # its length or the fields on which it depends are modified
+        for dep in self._tlayer.get_struct_deps(fname):
+            pkt._watched.append((dep.slice.start, dep.slice.stop, a))
+        cache = [-1, 0, 0]
+
+        def bounds():
+            if cache[0] != pkt._generation:
+                cache[:] = (pkt._generation,) + parser(buf, shifts[a])
+            return cache[1], cache[2]
+
+        def getter():
+            start, stop = bounds()
+            return get_frepr(ftype, bytes(buf[start:stop]),
+                             stop - start, fmask, fname)
+
+        def setter(value):
+            start, stop = bounds()
+            # obtain the bytes from the representation of the field
+            fraw = get_fraw(value, ftype, bytes(buf[start:stop]),
+                            stop - start, fmask, fname)
+            pkt.write(start, stop, fraw)
+
+        return getter, setter
 
     @property
     def slice(self):
-        return self._tlayer.slice
+        """:obj:`slice`: Position of the layer in the current packet. The
+        slice of the `Template` displaced by the difference between the
+        position of the header of the layer in the packet and in the
+        `Template`."""
+        shift = self._pkt._shifts[self._anchor]
+        s = self._tlayer.slice
+        return slice(s.start + shift, s.stop + shift)
+
+
+def template_anchors(template):
+    """Assigns every layer of a `Template` to the header that determines its
+    position: the IP header, the upper layer (TCP, UDP, ICMP) or its
+    payload. The layers before the IP header are not displaced.
+
+    Parameters
+    ----------
+    template : :obj:`Template`
+        The `Template` whose layers will be located.
+
+    Returns
+    -------
+    :obj:`tuple`
+        A dictionary {layer name: anchor} and the positions of the headers
+        in the `Template` as returned by `header_offsets`, or None if the
+        layers can not be located.
+
+    """
+    names = [l.name for l in template.layers]
+    ipname = next((n for n in names if n in ("IP", "IPV6")), None)
+    tstarts = None
+    if ipname and template.raw:
+        tstarts = header_offsets(template.raw, template[ipname].slice.start)
+    if tstarts is None:
+        return {n: ANCHOR_NONE for n in names}, None
+    anchors = {}
+    anchor = ANCHOR_NONE
+    for name in names:
+        if name == ipname:
+            anchor = ANCHOR_IP
+        elif anchor == ANCHOR_IP and name in L4_LAYERS:
+            anchor = ANCHOR_L4
+        elif anchor == ANCHOR_L4:
+            anchor = ANCHOR_PAYLOAD
+        anchors[name] = anchor
+    return anchors, tstarts
+
+
+def header_offsets(buf, ip):
+    """Walks the headers of an IP packet using their length fields.
+
+    Parameters
+    ----------
+    buf : :obj:`bytes`
+        Bytes of the packet.
+    ip : int
+        Position of the IP header.
+
+    Returns
+    -------
+    :obj:`tuple`
+        Positions of the IP header, of the upper layer and of its payload,
+        and the protocol number of the upper layer. The last three are None
+        if they can not be found, for example in fragments. None if the
+        packet is not IP.
+
+    """
+    n = len(buf)
+    if n < ip + 20:
+        return None
+    version = buf[ip] >> 4
+    if version == 4:
+        l4 = ip + (buf[ip] & 0x0f) * 4
+        proto = buf[ip + 9]
+        # The fragments that are not the first one have no upper layer
+        if (buf[ip + 6] & 0x1f) or buf[ip + 7]:
+            return ip, None, None, None
+    elif version == 6:
+        l4 = ip + 40
+        proto = buf[ip + 6]
+        while proto in _IPV6_EXTENSIONS:
+            if n < l4 + 8:
+                return ip, None, None, None
+            if proto == 44:
+                if (buf[l4 + 2] << 8 | buf[l4 + 3]) & 0xfff8:
+                    return ip, None, None, None
+                size = 8
+            elif proto == 51:
+                size = (buf[l4 + 1] + 2) * 4
+            else:
+                size = (buf[l4 + 1] + 1) * 8
+            proto = buf[l4]
+            l4 += size
+    else:
+        return None
+    if proto == 6:
+        if n < l4 + 13:
+            return ip, l4, None, proto
+        return ip, l4, l4 + (buf[l4 + 12] >> 4) * 4, proto
+    if proto in (17, 1, 58):
+        return ip, l4, l4 + 8, proto
+    return ip, l4, None, proto
@@ -0,0 +1,226 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import struct
+
+# Magic numbers of the pcap files with timestamps in microseconds and in
+# nanoseconds
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+
+# Link types of the pcap files whose IP layer can be located
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# Ethertypes of IPv4 and IPv6 and of the 802.1Q and 802.1ad tags
+ETHERTYPES_IP = (0x0800, 0x86dd)
+ETHERTYPES_VLAN = (0x8100, 0x88a8)
+
+
+class PcapReader(object):
+    """Reads the packets of a pcap file one by one, so that files of any
+    size can be processed in constant memory."""
+
+    def __init__(self, path):
+        """Initialization method of the `PcapReader` class.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            Path of the pcap file. The pcapng format is not supported.
+
+        """
+        self._f = open(path, "rb")
+        header = self._f.read(24)
+        if len(header) < 24:
+            self._f.close()
+            raise ValueError("%s is not a pcap file" % path)
+        for endian in "<>":
+            magic = struct.unpack(endian + "I", header[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                break
+        else:
+            self._f.close()
+            raise ValueError("%s is not a pcap file" % path)
+        self.nanoseconds = magic == PCAP_MAGIC_NS
+        _, _, _, _, self.snaplen, self.linktype = struct.unpack(
+            endian + "HHiIII", header[4:])
+        self._record = struct.Struct(endian + "IIII")
+
+    def __iter__(self):
+        """Iterates over the records of the file.
+
+        Yields
+        ------
+        :obj:`tuple`
+            Tuples (seconds, fraction, data) where fraction is in
+            microseconds or nanoseconds depending on `nanoseconds`.
+
+        """
+        read = self._f.read
+        unpack = self._record.unpack
+        while True:
+            header = read(16)
+            if len(header) < 16:
+                return
+            sec, frac, caplen, _ = unpack(header)
+            data = read(caplen)
+            if len(data) < caplen:
+                return
+            yield sec, frac, data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+
+class PcapWriter(object):
+    """Writes packets to a pcap file through a large buffer."""
+
+    def __init__(self, path, linktype=LINKTYPE_ETHERNET, snaplen=262144,
+                 nanoseconds=False, buffering=1 << 20):
+        """Initialization method of the `PcapWriter` class.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            Path of the pcap file.
+        linktype : int
+            Link type of the packets.
+        snaplen : int
+            Maximum length of the packets.
+        nanoseconds : bool
+            True if the fraction of the timestamps is in nanoseconds.
+        buffering : int
+            Size in bytes of the write buffer.
+
+        """
+        self._f = open(path, "wb", buffering=buffering)
+        self._f.write(struct.pack(
+            "<IHHiIII", PCAP_MAGIC_NS if nanoseconds else PCAP_MAGIC,
+            2, 4, 0, 0, snaplen, linktype))
+        self._record = struct.Struct("<IIII")
+
+    def write(self, sec, frac, data, wirelen=None):
+        """Writes a packet.
+
+        Parameters
+        ----------
+        sec : int
+            Seconds of the timestamp.
+        frac : int
+            Fraction of the timestamp.
+        data : :obj:`bytes`
+            Bytes of the packet.
+        wirelen : int, optional
+            Original length of the packet, by default the length of the
+            data.
+
+        """
+        self._f.write(self._record.pack(
+            sec, frac, len(data), len(data) if wirelen is None else wirelen))
+        self._f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+
+def ip_offset(linktype, data):
+    """Locates the IP layer of a packet.
+
+    Parameters
+    ----------
+    linktype : int
+        Link type of the pcap file.
+    data : :obj:`bytes`
+        Bytes of the packet.
+
+    Returns
+    -------
+    int
+        Position of the IP layer, or None if the packet does not carry
+        IPv4 or IPv6.
+
+    """
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        offset = 0
+    elif linktype == LINKTYPE_ETHERNET:
+        offset = 14
+        if len(data) < offset:
+            return None
+        ethertype = struct.unpack_from("!H", data, 12)[0]
+        # The VLAN tags are skipped
+        while ethertype in ETHERTYPES_VLAN and len(data) >= offset + 4:
+            ethertype = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+        if ethertype not in ETHERTYPES_IP:
+            return None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset = 16
+        if len(data) < offset or \
+                struct.unpack_from("!H", data, 14)[0] not in ETHERTYPES_IP:
+            return None
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        offset = 20
+        if len(data) < offset or \
+                struct.unpack_from("!H", data, 0)[0] not in ETHERTYPES_IP:
+            return None
+    elif linktype == LINKTYPE_NULL:
+        offset = 4
+    else:
+        return None
+    if len(data) <= offset or data[offset] >> 4 not in (4, 6):
+        return None
+    return offset
+
+
+def ip_end(data, offset):
+    """Locates the end of the IP datagram of a packet, so that the padding
+    and the trailers of the link layer are not taken as part of it.
+
+    Parameters
+    ----------
+    data : :obj:`bytes`
+        Bytes of the packet.
+    offset : int
+        Position of the IP layer, see `ip_offset`.
+
+    Returns
+    -------
+    int
+        Position after the last byte of the IP datagram. The end of the
+        data if the lengths of the IP header are not usable (truncated
+        packets, jumbograms or lengths left to the offloading).
+
+    """
+    if data[offset] >> 4 == 4:
+        if len(data) < offset + 4:
+            return len(data)
+        length = struct.unpack_from("!H", data, offset + 2)[0]
+        if length < 20:
+            return len(data)
+    else:
+        if len(data) < offset + 6:
+            return len(data)
+        length = struct.unpack_from("!H", data, offset + 4)[0]
+        if not length:
+            return len(data)
+        length += 40
+    return min(offset + length, len(data))
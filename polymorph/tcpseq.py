@@ -0,0 +1,196 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import struct
+import time
+from collections import OrderedDict
+from polymorph.packet import ETHER_HEADROOM, header_offsets
+
+# Sequence numbers are compared modulo 2**32
+SEQ_MASK = 0xffffffff
+SEQ_HALF = 0x80000000
+
+# Option of the TCP header that carries the SACK blocks
+TCPOPT_SACK = 5
+
+
+class _Flow(object):
+    """Displacements of the sequence numbers of one direction of a TCP
+    connection. Every mark (end, offset) indicates that the original bytes
+    from `end` onwards are displaced `offset` bytes."""
+    __slots__ = ("marks", "base", "last")
+
+    def __init__(self):
+        self.marks = []
+        self.base = 0
+        self.last = 0
+
+    def offset(self, seq):
+        """Displacement of an original sequence number."""
+        for end, offset in reversed(self.marks):
+            if (seq - end) & SEQ_MASK < SEQ_HALF:
+                return offset
+        return self.base
+
+    def inverse(self, ack):
+        """Displacement of a modified sequence number, used to translate the
+        acknowledgments of the other endpoint."""
+        for end, offset in reversed(self.marks):
+            if (ack - end - offset) & SEQ_MASK < SEQ_HALF:
+                return offset
+        return self.base
+
+
+class SeqTable(object):
+    """Table of the displacements of the sequence numbers of the TCP
+    connections whose packets have changed their length. The sequence
+    numbers of the following packets in the same direction and the
+    acknowledgments and SACK blocks of the packets in the opposite
+    direction are translated, so that the endpoints stay synchronized. The
+    least recently used connections are evicted when the table is full or
+    when they have been idle for too long."""
+
+    def __init__(self, max_flows=65536, timeout=300, max_marks=64):
+        """Initialization method of the `SeqTable` class.
+
+        Parameters
+        ----------
+        max_flows : int
+            Maximum number of directions of connections in the table.
+        timeout : float
+            Seconds after which an idle connection is evicted.
+        max_marks : int
+            Maximum number of modifications remembered per direction, the
+            oldest ones are merged. Retransmissions of segments older than
+            the merged modifications are not translated exactly.
+
+        """
+        self.max_flows = max_flows
+        self.timeout = timeout
+        self.max_marks = max_marks
+        self._flows = OrderedDict()
+
+    def __len__(self):
+        return len(self._flows)
+
+    def rewrite(self, pkt, length):
+        """Translates the sequence numbers of a TCP packet and records the
+        change of its length. When the length of any packet changes, the
+        length fields of its IP and UDP headers are also updated.
+
+        Parameters
+        ----------
+        pkt : :obj:`Packet`
+            The `Packet` that will be forwarded.
+        length : int
+            Original length of the packet, without the Ethernet layer.
+
+        Returns
+        -------
+        bool
+            True if the packet has been modified.
+
+        """
+        buf = pkt._buf
+        delta = len(buf) - ETHER_HEADROOM - length
+        flows = self._flows
+        if not delta and not flows:
+            return False
+        offsets = header_offsets(buf, ETHER_HEADROOM)
+        if offsets is None or offsets[3] != 6 or offsets[2] is None or \
+                len(buf) < offsets[1] + 20:
+            if delta:
+                pkt._fix_lengths()
+            return bool(delta)
+        ip, l4, payload, _ = offsets
+        # The directions of the connection are identified by the
+        # addresses and ports of the packet
+        if buf[ip] >> 4 == 4:
+            src, dst = bytes(buf[ip + 12:ip + 16]), bytes(buf[ip + 16:ip + 20])
+        else:
+            src, dst = bytes(buf[ip + 8:ip + 24]), bytes(buf[ip + 24:ip + 40])
+        sport, dport = bytes(buf[l4:l4 + 2]), bytes(buf[l4 + 2:l4 + 4])
+        key, rkey = src + sport + dst + dport, dst + dport + src + sport
+        fwd, rev = flows.get(key), flows.get(rkey)
+        if not delta and fwd is None and rev is None:
+            self._expire(time.monotonic())
+            return False
+        now = time.monotonic()
+        seq, ack = struct.unpack_from("!II", buf, l4 + 4)
+        modified = False
+        if fwd is not None:
+            shift = fwd.offset(seq)
+            if shift:
+                pkt.write(l4 + 4, l4 + 8, struct.pack(
+                    "!I", (seq + shift) & SEQ_MASK))
+                modified = True
+            fwd.last = now
+            flows.move_to_end(key)
+        # The acknowledgments refer to the sequence numbers of the other
+        # direction, as modified by the interceptor
+        if rev is not None and buf[l4 + 13] & 0x10:
+            shift = rev.inverse(ack)
+            if shift:
+                pkt.write(l4 + 8, l4 + 12, struct.pack(
+                    "!I", (ack - shift) & SEQ_MASK))
+                modified = True
+            modified = self._rewrite_sack(pkt, l4, payload, rev) or modified
+            rev.last = now
+            flows.move_to_end(rkey)
+        if delta:
+            if fwd is None:
+                fwd = flows[key] = _Flow()
+                fwd.last = now
+                if len(flows) > self.max_flows:
+                    flows.popitem(last=False)
+            # The displacement applies from the end of the original segment
+            end = (seq + len(buf) - payload - delta) & SEQ_MASK
+            marks = fwd.marks
+            # The retransmissions of modified segments are not counted
+            # twice
+            if not marks or (end - marks[-1][0]) & SEQ_MASK < SEQ_HALF and \
+                    end != marks[-1][0]:
+                marks.append((end, fwd.offset(seq) + delta))
+                if len(marks) > self.max_marks:
+                    fwd.base = marks.pop(0)[1]
+            pkt._fix_lengths()
+            modified = True
+        self._expire(now)
+        return modified
+
+    @staticmethod
+    def _rewrite_sack(pkt, l4, payload, rev):
+        """Translates the edges of the SACK blocks of a TCP header."""
+        buf = pkt._buf
+        modified = False
+        pos = l4 + 20
+        while pos < payload:
+            kind = buf[pos]
+            if kind == 0:
+                break
+            if kind == 1:
+                pos += 1
+                continue
+            if pos + 1 >= payload or buf[pos + 1] < 2:
+                break
+            size = buf[pos + 1]
+            if kind == TCPOPT_SACK:
+                for edge in range(pos + 2, min(pos + size, payload) - 3, 4):
+                    value = struct.unpack_from("!I", buf, edge)[0]
+                    shift = rev.inverse(value)
+                    if shift:
+                        pkt.write(edge, edge + 4, struct.pack(
+                            "!I", (value - shift) & SEQ_MASK))
+                        modified = True
+            pos += size
+        return modified
+
+    def _expire(self, now):
+        """Evicts the connections that have been idle for too long."""
+        flows = self._flows
+        while flows:
+            flow = next(iter(flows.values()))
+            if now - flow.last <= self.timeout:
+                break
+            flows.popitem(last=False)
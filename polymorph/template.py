@@ -16,6 +16,9 @@ from os import listdir
 from os.path import isfile, join
 from polymorph.ftype import Ftype
 from texttable import Texttable
+from polymorph.matcher import compile_conditions
+from polymorph.rules import compile_rules
+from polymorph.ahocorasick import AhoCorasick
 
 
 class Template:
@@ -44,6 +47,15 @@ class Template:
 
         """
         self._functions = OrderedDict()
+        # Declarative conditions that the packets must meet before the
+        # functions are executed
+        self._conditions = []
+        # Declarative rules that modify the packets without user functions
+        self._rules = []
+        # Dictionaries of byte patterns and their replacements, and the
+        # automata built from them
+        self._dictionaries = OrderedDict()
+        self._automata = {}
         self._timestamp = str(datetime.now())
         self._version = version
         self._description = description
@@ -217,6 +229,69 @@ class Template:
         self._functions = OrderedDict(
             (k, self._functions[k]) for k in ordered_keys)
 
+    def conditions(self):
+        """Returns the conditions that the packets must meet before the
+        functions are executed.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`dict`
+            List with the conditions in the order in which they are checked.
+
+        """
+        return list(self._conditions)
+
+    def add_condition(self, layer, op, value, field=None, offset=0,
+                      mask=None):
+        """Adds a condition that the packets must meet before the functions
+        are executed. The conditions are compiled into a single matcher when
+        intercepting, the packets that do not meet them are forwarded without
+        executing any function.
+
+        Parameters
+        ----------
+        layer : :obj:`str`
+            Name of the layer.
+        op : :obj:`str`
+            Operator, one of 'eq', 'ne', 'in', 'range', 'mask' or
+            'contains'.
+        value : :obj:
+            Representation of the value of the field, list of values for
+            'in', [lower, upper] for 'range' and bytes in hexadecimal for
+            'mask', 'contains' and the conditions on an offset.
+        field : :obj:`str`, optional
+            Name of the field. If None, the condition applies to the bytes
+            at an offset of the layer.
+        offset : int
+            Offset from the beginning of the layer, for the conditions that
+            do not apply to a field.
+        mask : :obj:`str`, optional
+            Mask in hexadecimal for the 'mask' operator.
+
+        """
+        condition = OrderedDict([("layer", layer), ("op", op),
+                                 ("value", value)])
+        if field:
+            condition["field"] = field
+        else:
+            condition["offset"] = offset
+        if mask is not None:
+            condition["mask"] = mask
+        # The condition is checked before adding it
+        compile_conditions(self, [condition])
+        self._conditions.append(condition)
+
+    def del_condition(self, cnum):
+        """Deletes a condition.
+
+        Parameters
+        ----------
+        cnum : int
+            Order number of the condition to be deleted.
+
+        """
+        del self._conditions[cnum]
+
     def layernames(self):
         """Returns the names of the `TLayer` of which the `Template` is formed.
 
@@ -386,6 +461,192 @@ class Template:
             print(t.draw())
         print("")
 
+    def rules(self):
+        """Returns the rules that modify the packets before the functions are
+        executed.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`dict`
+            List with the rules in the order in which they are applied.
+
+        """
+        return list(self._rules)
+
+    def add_rule(self, action, layer=None, value=None, field=None, offset=0,
+                 old=None, count=0, conditions=None):
+        """Adds a rule that modifies the packets. The rules are compiled when
+        intercepting and applied directly on the packet buffer before the
+        functions of the `Template`, without executing user code.
+
+        Parameters
+        ----------
+        action : :obj:`str`
+            'set' writes a value on a field or offset, 'add' adds a value to
+            an integer field, 'replace' and 'regex' replace some bytes or a
+            regular expression from an offset to the end of the packet and
+            'replace_all' replaces the patterns of a dictionary of the
+            `Template` and 'drop' drops the packet.
+        layer : :obj:`str`, optional
+            Name of the layer. For 'replace_all', if None the patterns are
+            replaced in the payload of the upper layer.
+        value : :obj:, optional
+            Representation of the value of the field, bytes in hexadecimal
+            for the offsets and 'replace', text for 'regex' and name of the
+            dictionary for 'replace_all'.
+        field : :obj:`str`, optional
+            Name of the field. If None, the rule applies to an offset of the
+            layer.
+        offset : int
+            Offset from the beginning of the layer.
+        old : :obj:`str`, optional
+            Bytes in hexadecimal replaced by 'replace', or regular
+            expression replaced by 'regex'.
+        count : int
+            Maximum number of replacements, 0 for all of them.
+        conditions : :obj:`list` of :obj:`dict`, optional
+            Conditions, in the format of `add_condition`, that the packet
+            must meet for the rule to be applied.
+
+        """
+        rule = OrderedDict([("action", action)])
+        if layer:
+            rule["layer"] = layer
+            if field:
+                rule["field"] = field
+            else:
+                rule["offset"] = offset
+        if value is not None:
+            rule["value"] = value
+        if old is not None:
+            rule["old"] = old
+        if count:
+            rule["count"] = count
+        if conditions:
+            rule["if"] = conditions
+        # The rule is checked before adding it
+        compile_rules(self, [rule])
+        self._rules.append(rule)
+
+    def del_rule(self, rnum):
+        """Deletes a rule.
+
+        Parameters
+        ----------
+        rnum : int
+            Order number of the rule to be deleted.
+
+        """
+        del self._rules[rnum]
+
+    def show_rules(self):
+        """Pretty print of the rules of the `Template`."""
+        t = Texttable()
+        rows = [["Order", "Action", "Layer", "Field/Offset", "Value", "If"]]
+        for idx, r in enumerate(self._rules):
+            value = r.get("value", "")
+            if "old" in r:
+                value = "%s -> %s" % (r["old"], value)
+            conds = " and ".join("%s.%s %s %s" % (
+                c["layer"], c.get("field", c.get("offset")), c["op"],
+                c["value"]) for c in r.get("if", []))
+            rows.append([idx, r["action"], r.get("layer", ""),
+                         r.get("field", r.get("offset", "")), str(value),
+                         conds])
+        t.add_rows(rows)
+        print(t.draw())
+        print("")
+
+    def dictionary_names(self):
+        """Returns the names of the dictionaries of patterns.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`str`
+            List with the names of the dictionaries.
+
+        """
+        return list(self._dictionaries)
+
+    def get_dictionary(self, name):
+        """Returns a dictionary of patterns.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the dictionary.
+
+        Returns
+        -------
+        :obj:`dict`
+            Dictionary of the form {pattern: replacement} in bytes.
+
+        """
+        return {bytes.fromhex(p): bytes.fromhex(r)
+                for p, r in self._dictionaries[name].items()}
+
+    def add_dictionary(self, name, patterns):
+        """Adds a dictionary of patterns that can be replaced in the packets
+        in a single pass with `Packet.replace_all`.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name to identify the dictionary in the `Template`.
+        patterns : :obj:`dict`
+            Dictionary of the form {pattern: replacement} in bytes.
+
+        """
+        # The automaton is built to check the patterns
+        automaton = AhoCorasick(patterns)
+        self._dictionaries[name] = OrderedDict(
+            (bytes(p).hex(), bytes(r).hex()) for p, r in patterns.items())
+        self._automata[name] = automaton
+
+    def del_dictionary(self, name):
+        """Deletes a dictionary of patterns.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the dictionary.
+
+        """
+        del self._dictionaries[name]
+        self._automata.pop(name, None)
+
+    def automaton(self, name):
+        """Returns the automaton that replaces the patterns of a dictionary,
+        it is built only once.
+
+        Parameters
+        ----------
+        name : :obj:`str`
+            Name of the dictionary.
+
+        Returns
+        -------
+        :obj:`AhoCorasick`
+
+        """
+        if name not in self._automata:
+            self._automata[name] = AhoCorasick(self.get_dictionary(name))
+        return self._automata[name]
+
+    def show_conditions(self):
+        """Pretty print of the conditions of the `Template`."""
+        t = Texttable()
+        rows = [["Order", "Layer", "Field/Offset", "Operator", "Value"]]
+        for idx, c in enumerate(self._conditions):
+            value = c["value"]
+            if c["op"] == "mask":
+                value = "%s/%s" % (value, c["mask"])
+            rows.append([idx, c["layer"], c.get("field", c.get("offset")),
+                         c["op"], str(value)])
+        t.add_rows(rows)
+        print(t.draw())
+        print("")
+
     def show_all_funcs(self, verbose=False):
         """Pretty print of the functions that are on disk.
 
@@ -423,6 +684,9 @@ class Template:
                             ("Version", self._version),
                             ("Timestamp", self._timestamp),
                             ("Functions", self._functions),
+                            ("Conditions", self._conditions),
+                            ("Rules", self._rules),
+                            ("Dictionaries", self._dictionaries),
                             ("layers", [l.dict()
                                         for l in self._layers.values()]),
                             ("raw", self._raw.hex())])
@@ -445,6 +709,10 @@ class Template:
         self._description = template['Description']
         self._raw = bytes.fromhex(template['raw'])
         self._functions = template['Functions']
+        self._conditions = template.get('Conditions', [])
+        self._rules = template.get('Rules', [])
+        self._dictionaries = template.get('Dictionaries', OrderedDict())
+        self._automata = {}
         # Reading and loading the layers
         for layer in template['layers']:
             l = TLayer(layer['name'], pkt_raw=self._raw,
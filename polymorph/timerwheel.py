@@ -0,0 +1,94 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import time
+
+
+class TimerWheel(object):
+    """Hashed timing wheel that keeps a large number of timers with a
+    constant cost per insertion and per tick."""
+
+    def __init__(self, tick=0.001, slots=1024):
+        """Initialization method of the `TimerWheel` class.
+
+        Parameters
+        ----------
+        tick : float
+            Resolution of the timers in seconds.
+        slots : int
+            Number of slots of the wheel. Timers longer than a turn of the
+            wheel wait for several turns in their slot.
+
+        """
+        self._tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._pos = 0
+        self._time = time.monotonic()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def tick(self):
+        """float: Resolution of the timers in seconds."""
+        return self._tick
+
+    def add(self, delay, item):
+        """Adds a timer to the wheel.
+
+        Parameters
+        ----------
+        delay : float
+            Seconds until the timer expires.
+        item : :obj:`object`
+            Item returned when the timer expires.
+
+        """
+        if not self._count:
+            # The wheel does not advance while it is empty
+            self._time = time.monotonic()
+        ticks = max(1, int(-(-delay // self._tick)))
+        slot = (self._pos + ticks) % len(self._slots)
+        self._slots[slot].append([(ticks - 1) // len(self._slots), item])
+        self._count += 1
+
+    def advance(self, now=None):
+        """Advances the wheel until the current time.
+
+        Parameters
+        ----------
+        now : float, optional
+            Current time as returned by `time.monotonic`.
+
+        Returns
+        -------
+        :obj:`list`
+            Items of the timers that have expired.
+
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        if not self._count:
+            self._time = now
+            return expired
+        nslots = len(self._slots)
+        while self._time + self._tick <= now and self._count:
+            self._time += self._tick
+            self._pos = (self._pos + 1) % nslots
+            slot = self._slots[self._pos]
+            if not slot:
+                continue
+            waiting = []
+            for timer in slot:
+                if timer[0]:
+                    timer[0] -= 1
+                    waiting.append(timer)
+                else:
+                    expired.append(timer[1])
+            self._slots[self._pos] = waiting
+            self._count -= len(slot) - len(waiting)
+        if not self._count:
+            self._time = now
+        return expired
@@ -8,6 +8,7 @@ from termcolor import colored
 from construct import *
 from texttable import Texttable
 from polymorph.converter import Converter
+from polymorph.ftype import Ftype
 
 
 class TLayer(object):
@@ -36,6 +37,7 @@ class TLayer(object):
         self._lslice = lslice
         self._structs = OrderedDict()
         self._saved_structs = OrderedDict()
+        self._struct_parsers = OrderedDict()
         # This constants will help constructing the structs
         self._nums = {'1': {'Ftype.FT_INT_BE': Int8ub,
                             'Ftype.FT_INT_LE': Int8ul},
@@ -117,6 +119,8 @@ class TLayer(object):
         # Construction of the structure
         st = self.create_struct(main_field, dep_fields, start_byte, expression)
         self._structs[fname] = st
+        self._struct_parsers[fname] = self.compile_struct(
+            main_field, dep_fields, start_byte, expression)
 
     def test_struct(self, fname):
         """Tests de result of the Struct for a particula `TField`.
@@ -144,6 +148,7 @@ class TLayer(object):
         """
         if tfieldname in self._structs:
             del self._structs[tfieldname]
+            del self._struct_parsers[tfieldname]
 
     def get_struct(self, tfieldname):
         """Returns the `Struct` for a particula `TField`.
@@ -161,6 +166,44 @@ class TLayer(object):
         if tfieldname in self._structs:
             return self._structs[tfieldname]
 
+    def get_struct_parser(self, tfieldname):
+        """Returns the compiled parser of the `Struct` of a particular
+        `TField`.
+
+        Parameters
+        ----------
+        tfieldname: :obj:`str`
+            Name of the `TField`.
+
+        Returns
+        -------
+        :obj:`function`
+            Function that receives the raw bytes of the packet and returns
+            the start and stop bytes of the field.
+
+        """
+        if tfieldname in self._struct_parsers:
+            return self._struct_parsers[tfieldname]
+
+    def get_struct_deps(self, tfieldname):
+        """Returns the `TField` on which the `Struct` of a particular `TField`
+        depends.
+
+        Parameters
+        ----------
+        tfieldname: :obj:`str`
+            Name of the `TField`.
+
+        Returns
+        -------
+        :obj:`list` of :obj:`TField`
+
+        """
+        if tfieldname in self._saved_structs:
+            return [self.getfield(f)
+                    for f in self._saved_structs[tfieldname]["fdeps"]]
+        return []
+
     def show_structs(self, tfname):
         """Pretty Print of the Structs of a `TField`.
 
@@ -274,6 +317,50 @@ class TLayer(object):
             Bytes(eval(expression.replace(".", "_").replace("this_", "this.")))
         return st
 
+    def compile_struct(self, tfield, fdeps, start_byte, expression):
+        """This function compiles the expressions of a `Struct` into a
+        function that calculates the position of the field directly from the
+        raw bytes of the packet, without parsing the whole `Struct`.
+
+        Parameters
+        ----------
+        tfield : :obj:`TField`
+            Field for which the new value will be calculated.
+        fdeps: :obj:`list` of :obj:`TField`
+            List of fields on which the previous field depends.
+        start_byte: :obj:`str`
+            Byte in which the value of the main field begins. Fields must be
+            preceded by 'this'.
+        expression: :obj:`str`
+            Expression with which the length of the field will be calculated
+            dynamically. Fields must be preceded by 'this'.
+
+        Returns
+        -------
+        :obj:`function`
+            Function that receives the raw bytes of the packet and the
+            displacement of the layer with respect to the template, and
+            returns the start and stop bytes of the field.
+
+        """
+        # The dependent fields are read as integers at their position,
+        # displaced like the layer, and bound to local variables named like
+        # in the expressions
+        code = ["def parser(raw, shift=0):"]
+        for field in fdeps:
+            order = "little" if field.type == Ftype.FT_INT_LE else "big"
+            code.append(
+                "    this_%s = int.from_bytes(raw[%d + shift:%d + shift], "
+                "'%s')" % (field.name.replace(".", "_"), field.slice.start,
+                           field.slice.stop, order))
+        code.append("    start = (%s) + shift" % start_byte.replace(".", "_"))
+        code.append("    return start, start + (%s)" %
+                    expression.replace(".", "_"))
+        namespace = {}
+        exec(compile("\n".join(code), "<struct %s>" % tfield.name, "exec"),
+             namespace)
+        return namespace["parser"]
+
     def addfield(self, field):
         """Adds a `TField` to the actual `TLayer`.
 
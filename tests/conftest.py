@@ -0,0 +1,81 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import pytest
+from scapy.all import Ether, IP, TCP, UDP, Raw
+from polymorph.template import Template
+from polymorph.tlayer import TLayer
+from polymorph.tfield import TField
+from polymorph.ftype import Ftype
+
+# Fields of the layers of the test templates (name, start, size, type, mask)
+IP_FIELDS = [("version", 14, 1, Ftype.FT_BIN_BE, 0xf0),
+             ("hdr_len", 14, 1, Ftype.FT_BIN_BE, 0x0f),
+             ("len", 16, 2, Ftype.FT_INT_BE, None),
+             ("ttl", 22, 1, Ftype.FT_INT_BE, None),
+             ("proto", 23, 1, Ftype.FT_INT_BE, None),
+             ("checksum", 24, 2, Ftype.FT_HEX, None),
+             ("src", 26, 4, Ftype.FT_IPv4, None),
+             ("dst", 30, 4, Ftype.FT_IPv4, None)]
+TCP_FIELDS = [("srcport", 34, 2, Ftype.FT_INT_BE, None),
+              ("dstport", 36, 2, Ftype.FT_INT_BE, None),
+              ("seq", 38, 4, Ftype.FT_INT_BE, None),
+              ("ack", 42, 4, Ftype.FT_INT_BE, None),
+              ("checksum", 50, 2, Ftype.FT_HEX, None)]
+UDP_FIELDS = [("srcport", 34, 2, Ftype.FT_INT_BE, None),
+              ("dstport", 36, 2, Ftype.FT_INT_BE, None),
+              ("length", 38, 2, Ftype.FT_INT_BE, None),
+              ("checksum", 40, 2, Ftype.FT_HEX, None)]
+
+
+def _layer(name, raw, start, stop, fields):
+    layer = TLayer(name, raw, slice(start, stop))
+    for fname, fstart, size, ftype, mask in fields:
+        layer.addfield(TField(fname=fname, fslice=slice(fstart, fstart + size),
+                              fsize=size, pkt_raw=raw, trepr="", ttype=None,
+                              tmask=mask, layer=layer, ftype=ftype))
+    return layer
+
+
+def build_template(proto="tcp", payload=b"hello world"):
+    """Builds a `Template` of an Ethernet/IPv4/TCP or UDP/Raw packet."""
+    upper = TCP(sport=40000, dport=80, flags="PA") if proto == "tcp" else \
+        UDP(sport=40000, dport=53)
+    raw = bytes(Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / upper /
+                Raw(payload))
+    template = Template("test", raw=raw)
+    template.addlayer(_layer("ETH", raw, 0, 14, []))
+    template.addlayer(_layer("IP", raw, 14, 34, IP_FIELDS))
+    if proto == "tcp":
+        template.addlayer(_layer("TCP", raw, 34, 54, TCP_FIELDS))
+        start = 54
+    else:
+        template.addlayer(_layer("UDP", raw, 34, 42, UDP_FIELDS))
+        start = 42
+    template.addlayer(_layer("RAW", raw, start, len(raw),
+                             [("load", start, len(payload), Ftype.FT_BYTES,
+                               None)]))
+    return template
+
+
+def valid(raw):
+    """Checks the lengths and checksums of an IP packet against scapy."""
+    ref = IP(raw)
+    del ref.len
+    del ref.chksum
+    if ref.payload.name in ("TCP", "UDP"):
+        del ref.payload.chksum
+    if ref.payload.name == "UDP":
+        del ref.payload.len
+    return bytes(ref) == raw
+
+
+@pytest.fixture
+def tcp_template():
+    return build_template("tcp")
+
+
+@pytest.fixture
+def udp_template():
+    return build_template("udp", b"abc")
@@ -0,0 +1,50 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+import pytest
+from polymorph.ahocorasick import AhoCorasick
+
+
+def _naive(patterns, data, start=0):
+    """Leftmost and then longest matches, without overlapping."""
+    matches = []
+    i = start
+    while i < len(data):
+        found = [p for p in patterns if data.startswith(p, i)]
+        if found:
+            stop = i + max(len(p) for p in found)
+            matches.append((i, stop))
+            i = stop
+        else:
+            i += 1
+    return matches
+
+
+def test_finditer_against_naive():
+    rnd = random.Random(2)
+    for _ in range(300):
+        # A small alphabet makes the patterns overlap
+        patterns = {bytes(rnd.choice(b"abc")
+                          for _ in range(rnd.randrange(1, 6))): b"x"
+                    for _ in range(rnd.randrange(1, 8))}
+        data = bytes(rnd.choice(b"abcd") for _ in range(rnd.randrange(60)))
+        start = rnd.randrange(len(data) + 1)
+        automaton = AhoCorasick(patterns)
+        assert list(automaton.finditer(data, start)) == \
+            _naive(patterns, data, start)
+
+
+def test_replace_and_matches():
+    automaton = AhoCorasick({b"he": b"1", b"hers": b"2", b"she": b"3",
+                             b"his": b""})
+    data = b"ushers his hershe"
+    assert automaton.matches(data) == [(1, 4, b"3"), (7, 10, b""),
+                                       (11, 15, b"2"), (15, 17, b"1")]
+    assert automaton.replace(data) == (b"u3rs  21", 4)
+    assert automaton.replace(bytearray(data), 11) == (b"ushers his 21", 2)
+    assert automaton.replace(b"nothing") == (b"nothing", 0)
+    assert len(automaton) == 4
+    with pytest.raises(ValueError):
+        AhoCorasick({b"": b"x"})
@@ -0,0 +1,81 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import asyncio
+from scapy.all import IP, TCP, Raw
+from polymorph.asyncinterceptor import AsyncInterceptor
+from polymorph.replay import ReplayPacket
+from tests.conftest import valid
+
+
+def _packet(payload):
+    return bytes(IP(src="10.0.0.1", dst="10.0.0.2") /
+                 TCP(sport=40000, dport=80, flags="PA") / Raw(payload))
+
+
+def _queued(raw, mark=0):
+    packet = ReplayPacket(raw)
+    packet.set_mark(mark)
+    return packet
+
+
+def test_pending_packets_are_not_recycled(tcp_template):
+    loop = asyncio.new_event_loop()
+    release = asyncio.Event()
+
+    async def mark(packet):
+        await release.wait()
+        packet.write(packet._shifts[0] + 22, packet._shifts[0] + 23, b"\x07")
+        return packet
+
+    try:
+        i = AsyncInterceptor(tcp_template, copy_range=48)
+        i._loop = loop
+        i._functions, i._coroutines = [mark], [True]
+        full = _packet(b"A" * 100)
+        truncated = _queued(full[:48])
+        i.linux_modify(truncated)
+        loop.call_soon(release.set)
+        loop.run_until_complete(asyncio.gather(*i._tasks))
+        assert truncated.verdict == "repeat"
+        # A packet waits in a coroutine while the truncated one is
+        # reassembled, their buffers must be different
+        release.clear()
+        other = _queued(_packet(b"C" * 10))
+        i.linux_modify(other)
+        loop.run_until_complete(asyncio.sleep(0))
+        requeued = _queued(full, truncated.get_mark())
+        i.linux_reassemble(requeued)
+        loop.call_soon(release.set)
+        loop.run_until_complete(asyncio.gather(*i._tasks))
+        for packet, payload in [(requeued, b"A" * 100),
+                                (other, b"C" * 10)]:
+            result = IP(packet.get_payload())
+            assert result.ttl == 7
+            assert bytes(result[TCP].payload) == payload
+            assert valid(packet.get_payload())
+        assert not i._reassembling and len(i._free) == 2
+    finally:
+        loop.close()
+
+
+def test_failing_coroutine_accepts_the_packet(tcp_template, capsys):
+    loop = asyncio.new_event_loop()
+
+    async def fail(packet):
+        raise ValueError("broken function")
+
+    try:
+        i = AsyncInterceptor(tcp_template)
+        i._loop = loop
+        i._functions, i._coroutines = [fail], [True]
+        packet = _queued(_packet(b"data"))
+        i.linux_modify(packet)
+        assert packet.verdict == "hold"
+        loop.run_until_complete(asyncio.gather(*i._tasks))
+        assert packet.verdict == "accept"
+        assert "broken function" in capsys.readouterr().out
+        assert len(i._free) == 1
+    finally:
+        loop.close()
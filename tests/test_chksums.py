@@ -0,0 +1,44 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+import pytest
+from scapy.all import IP, TCP, UDP, Raw
+from polymorph.interceptor import Interceptor
+from polymorph.packet import Packet, ETHER_HEADROOM
+from tests.conftest import valid
+
+# Bytes of the lengths and of the headers that move the layers, they are
+# not modified
+LAYOUT = {"tcp": {0, 2, 3, 6, 7, 9, 32}, "udp": {0, 2, 3, 6, 7, 9, 24, 25}}
+
+
+@pytest.mark.parametrize("proto", ["tcp", "udp"])
+def test_incremental_chksums_match_full_recompute(proto, tcp_template,
+                                                  udp_template):
+    template = tcp_template if proto == "tcp" else udp_template
+    upper = TCP if proto == "tcp" else UDP
+    interceptor = Interceptor(template)
+    rnd = random.Random(1)
+    incremental, full = Packet(template), Packet(template)
+    for _ in range(200):
+        raw = bytes(IP(src="10.0.0.1", dst="10.0.0.2", ttl=rnd.randrange(256))
+                    / upper(sport=rnd.randrange(65536), dport=80)
+                    / Raw(bytes(rnd.randrange(256)
+                                for _ in range(rnd.randrange(1, 60)))))
+        incremental.load(raw)
+        for _ in range(rnd.randrange(1, 5)):
+            start = rnd.randrange(len(raw))
+            stop = min(len(raw), start + rnd.randrange(1, 5))
+            if LAYOUT[proto] & set(range(start, stop)):
+                continue
+            incremental.write(ETHER_HEADROOM + start, ETHER_HEADROOM + stop,
+                              bytes(rnd.randrange(256)
+                                    for _ in range(stop - start)))
+        full.load(incremental.raw)
+        full._rewritten = True
+        interceptor._rec_chksums(incremental)
+        interceptor._rec_chksums(full)
+        assert incremental.raw == full.raw
+        assert valid(bytes(full.raw))
@@ -0,0 +1,75 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+import pytest
+from polymorph.converter import Converter, _CODECS
+from polymorph.ftype import Ftype
+
+
+def _ref_raw2bin(fraw, mask, order):
+    """Former implementation of raw2bin with binary strings."""
+    size = len(fraw)
+    num_bin = format(int.from_bytes(fraw, order), "0%db" % (8 * size))
+    mask_bin = format(mask, "0%db" % (8 * size))
+    trail_zeros = len(mask_bin) - len(mask_bin.rstrip("0"))
+    return (int(num_bin, 2) & int(mask_bin, 2)) >> trail_zeros
+
+
+@pytest.mark.parametrize("order", ["big", "little"])
+def test_bin_fields(order):
+    cv = Converter()
+    rnd = random.Random(5)
+    for _ in range(500):
+        size = rnd.choice([1, 2, 4])
+        lsb = rnd.randrange(8 * size)
+        width = rnd.randrange(1, 8 * size - lsb + 1)
+        mask = ((1 << width) - 1) << lsb
+        fraw = bytes(rnd.randrange(256) for _ in range(size))
+        assert cv.raw2bin(fraw, mask, size, order) == \
+            _ref_raw2bin(fraw, mask, order)
+        value = rnd.randrange(1 << width)
+        new = cv.bin2raw(value, fraw, mask, size, order)
+        assert cv.raw2bin(new, mask, size, order) == value
+        # The bits outside the mask are kept
+        assert int.from_bytes(new, order) & ~mask == \
+            int.from_bytes(fraw, order) & ~mask
+        rest, rest_mask = cv.raw2maskbin(fraw, mask, size, order)
+        assert rest_mask == mask ^ ((1 << 8 * size) - 1)
+        assert rest == _ref_raw2bin(fraw, rest_mask, order)
+
+
+def test_single_bit_fields_can_be_changed():
+    cv = Converter()
+    assert cv.bin2raw(1, b"\x00", 0x01, 1) == b"\x01"
+    assert cv.bin2raw(0, b"\xff", 0x80, 1) == b"\x7f"
+
+
+@pytest.mark.parametrize("ftype, fraw", [
+    (Ftype.FT_INT_BE, b"\x01\x02"),
+    (Ftype.FT_INT_LE, b"\x01\x02"),
+    (Ftype.FT_HEX, b"\x00\xab"),
+    (Ftype.FT_BYTES, b"\x00\xab\xcd"),
+    (Ftype.FT_ETHER, b"\x02\x00\x00\x00\x00\x01"),
+    (Ftype.FT_IPv4, b"\x0a\x00\x00\x01"),
+    (Ftype.FT_IPv6, b"\xfe\x80" + bytes(13) + b"\x01"),
+])
+def test_codecs_round_trip(ftype, fraw):
+    cv = Converter()
+    frepr = cv.get_frepr(ftype, fraw, len(fraw), None, "f")
+    assert cv.get_fraw(frepr, ftype, fraw, len(fraw), None, "f") == fraw
+
+
+def test_register_codec():
+    cv = Converter()
+    ftype = "FT_TEST"
+    Converter.register_codec(
+        ftype, lambda cv, fraw, fsize, fmask, fname: fraw[::-1],
+        lambda cv, field, fraw, fsize, fmask, fname: field[::-1])
+    try:
+        assert cv.get_frepr(ftype, b"ab", 2, None, "f") == b"ba"
+        assert cv.get_fraw(b"ba", ftype, b"ab", 2, None, "f") == b"ab"
+    finally:
+        del _CODECS[ftype]
+    assert cv.get_frepr(ftype, b"ab", 2, None, "f") is None
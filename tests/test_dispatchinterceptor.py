@@ -0,0 +1,108 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import pytest
+from scapy.all import Ether, IP, IPv6, TCP, UDP, ICMP, GRE, Raw, \
+    IPv6ExtHdrFragment
+from polymorph.template import Template
+from polymorph.dispatchinterceptor import DispatchInterceptor, TemplateIndex
+from tests.conftest import build_template, _layer
+
+
+def _template(pkt):
+    """Builds a `Template` with the layers of a scapy packet, without
+    fields."""
+    raw = bytes(pkt)
+    template = Template("test", raw=raw)
+    names = {"Ethernet": "ETH", "IP": "IP", "IPv6": "IPV6", "TCP": "TCP",
+             "UDP": "UDP", "ICMP": "ICMP"}
+    layer = pkt
+    while layer and layer.name in names:
+        start = len(raw) - len(layer)
+        stop = len(raw) - len(layer.payload)
+        template.addlayer(_layer(names[layer.name], raw, start, stop, []))
+        layer = layer.payload
+    return template
+
+
+def test_lookup():
+    index = TemplateIndex([
+        _template(Ether() / IP() / TCP(sport=40000, dport=80)),
+        _template(Ether() / IP() / TCP(sport=443, dport=50000)),
+        _template(Ether() / IP() / TCP(sport=80, dport=8080)),
+        _template(Ether() / IP() / UDP(sport=53, dport=53)),
+        # Template without an UDP layer
+        _template(Ether() / IP(proto=17) / Raw(b"x" * 8)),
+        _template(Ether() / IP() / ICMP()),
+        _template(Ether() / IP() / GRE()),
+        _template(Ether() / IPv6() / TCP(sport=40000, dport=22)),
+        # Fragments apply to all the packets of their version
+        _template(Ether() / IPv6() / IPv6ExtHdrFragment(offset=2) /
+                  Raw(b"x")),
+    ])
+    assert index.lookup(bytes(IP() / TCP(sport=1234, dport=80))) == 0
+    assert index.lookup(bytes(IP() / TCP(sport=80, dport=1234))) == 0
+    assert index.lookup(bytes(IP() / TCP(sport=443, dport=1234))) == 1
+    # The destination port is checked before the source port
+    assert index.lookup(bytes(IP() / TCP(sport=80, dport=8080))) == 2
+    assert index.lookup(bytes(IP() / TCP(sport=8080, dport=80))) == 0
+    assert index.lookup(bytes(IP() / UDP(sport=1234, dport=53))) == 3
+    # The templates without ports apply to the rest of the protocol
+    assert index.lookup(bytes(IP() / UDP(sport=1234, dport=5353))) == 4
+    assert index.lookup(bytes(IP() / ICMP())) == 5
+    assert index.lookup(bytes(IP() / GRE())) == 6
+    # No template of the protocol nor of the version
+    assert index.lookup(bytes(IP() / TCP(sport=1234, dport=25))) is None
+    assert index.lookup(bytes(IPv6() / TCP(dport=22))) == 7
+    assert index.lookup(bytes(IPv6() / UDP(dport=22))) == 8
+    # The position of the IP header
+    assert index.lookup(bytes(Ether() / IP() / ICMP()), 14) == 5
+    assert index.lookup(b"\x00" * 10) is None
+
+
+def test_lookup_default():
+    index = TemplateIndex([_template(Ether() / IP() / UDP(dport=53)),
+                           _template(Ether(type=0x88cc) / Raw(b"x" * 46)),
+                           _template(Ether() / IP() / ICMP())])
+    assert index.lookup(bytes(IP() / UDP(dport=53))) == 0
+    assert index.lookup(bytes(IP() / ICMP())) == 2
+    assert index.lookup(bytes(IP() / TCP())) == 1
+    assert index.lookup(b"\x00" * 10) == 1
+    assert index.matches() == ([""], [""])
+
+
+def test_matches():
+    index = TemplateIndex([
+        _template(Ether() / IP() / TCP(sport=40000, dport=80)),
+        _template(Ether() / IP() / TCP(sport=443, dport=50000)),
+        _template(Ether() / IP() / ICMP()),
+        _template(Ether() / IPv6() / UDP(sport=40000, dport=53)),
+        _template(Ether() / IPv6(nh=17) / Raw(b"x" * 8)),
+    ])
+    assert index.matches() == (
+        ["-p 1 ", "-p 6 -m multiport --ports 80,443 "], ["-p 17 "])
+    many = TemplateIndex([_template(Ether() / IP() / TCP(dport=p))
+                          for p in range(1, 2 + 15)])
+    assert many.matches() == (["-p 6 "], None)
+    versions = TemplateIndex([_template(Ether() / IP(frag=2) / Raw(b"x"))])
+    assert versions.matches() == ([""], None)
+
+
+def test_matches_one_rule_per_protocol():
+    templates = [build_template("tcp"), build_template("udp")]
+    match4, match6 = TemplateIndex(templates).matches()
+    assert match4 == ["-p 6 -m multiport --ports 80 ",
+                      "-p 17 -m multiport --ports 53 "]
+    assert match6 is None
+    i = DispatchInterceptor(templates)
+    rules = i._queue_rules()
+    assert len(rules) == 2
+    assert rules[0].startswith("iptables -A FORWARD -p 6 ")
+    assert rules[1].startswith("iptables -A FORWARD -p 17 ")
+    assert i.iptables_rule == rules[0] and i.ip6tables_rule is None
+
+
+def test_bpf_is_rejected():
+    with pytest.raises(ValueError):
+        DispatchInterceptor([build_template("tcp")], bpf=True)
@@ -0,0 +1,119 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import pytest
+from scapy.all import IP, TCP, UDP, Raw
+from polymorph.interceptor import Interceptor, BYPASS_MARK
+from polymorph.replay import ReplayPacket
+from tests.conftest import valid
+
+
+def test_tcp_seq_balances_by_flow(tcp_template):
+    i = Interceptor(tcp_template, queues=4, tcp_seq=True)
+    assert "--queue-balance 1:4" in i.iptables_rule
+    assert "--queue-cpu-fanout" not in i.iptables_rule
+    i = Interceptor(tcp_template, queues=4)
+    assert "--queue-cpu-fanout" in i.iptables_rule
+
+
+def test_workers_start_with_sigusr1_ignored(tcp_template, monkeypatch):
+    import multiprocessing
+    import signal
+    i = Interceptor(tcp_template, queues=2, stats=True)
+    dispositions = []
+
+    class Process(object):
+        pid = 0
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def start(self):
+            dispositions.append(signal.getsignal(signal.SIGUSR1))
+
+        def join(self, timeout=None):
+            pass
+
+        def is_alive(self):
+            return False
+
+    ctx = multiprocessing.get_context("fork")
+    monkeypatch.setattr(ctx, "Process", Process)
+    monkeypatch.setattr(ctx, "Semaphore", lambda value: type(
+        "Ready", (), {"acquire": lambda self, timeout=None: False,
+                      "release": lambda self: None})())
+    cleaned = []
+    monkeypatch.setattr(i, "clean_iptables", lambda: cleaned.append(True))
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        i._intercept_multiqueue()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert dispositions == [signal.SIG_IGN, signal.SIG_IGN]
+    # The workers did not start, the rules were never set
+    assert not cleaned
+
+
+def test_bypass_rules_are_opt_in(tcp_template):
+    i = Interceptor(tcp_template)
+    assert i.bypass_mark is None
+    i = Interceptor(tcp_template, bypass_mark=BYPASS_MARK)
+    rules = i._bypass_rules("-A", "-I")
+    assert any("CONNMARK --set-mark %#x" % BYPASS_MARK in r for r in rules)
+    assert any("-m connmark --mark %#x -j ACCEPT" % BYPASS_MARK in r
+               for r in rules)
+
+
+def test_failed_rules_are_cleaned(tcp_template, monkeypatch):
+    import subprocess
+    i = Interceptor(tcp_template, bypass_mark=BYPASS_MARK)
+    commands = []
+
+    def check_output(rule, **kwargs):
+        commands.append(rule)
+        if "connmark" in rule:
+            raise subprocess.CalledProcessError(1, rule)
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    with pytest.raises(subprocess.CalledProcessError):
+        i.set_iptables_rules()
+    assert "iptables -F" in commands
+
+
+def test_reassembled_packets_fix_lengths(udp_template):
+    udp_template.add_rule("replace", "RAW", "4142434445", old="616263")
+    i = Interceptor(udp_template, copy_range=40)
+    full = bytes(IP(src="10.0.0.1", dst="10.0.0.2") /
+                 UDP(sport=40000, dport=53) / Raw(b"abc" + b"x" * 100))
+    truncated = ReplayPacket(full[:40])
+    i.linux_modify(truncated)
+    assert truncated.verdict == "repeat"
+    requeued = ReplayPacket(full)
+    requeued.set_mark(truncated.get_mark())
+    i.linux_reassemble(requeued)
+    result = IP(requeued.get_payload())
+    assert result.len == len(full) + 2
+    assert result[UDP].len == len(full) + 2 - 20
+    assert valid(requeued.get_payload())
+
+
+def test_untouched_packets_are_forwarded_as_they_are(tcp_template):
+    i = Interceptor(tcp_template)
+    i._functions = [lambda packet: packet]
+    raw = bytes(IP(src="10.0.0.1", dst="10.0.0.2") /
+                TCP(sport=40000, dport=80) / Raw(b"data"))
+    packet = ReplayPacket(raw)
+    i.linux_modify(packet)
+    # The payload was not replaced nor its checksums recalculated
+    assert packet.verdict == "accept" and packet.get_payload() is raw
+    assert i.counters()["modified"] == 0
+
+    def ttl(packet):
+        packet["IP"]["ttl"] = 1
+        return packet
+    i._functions = [ttl]
+    packet = ReplayPacket(raw)
+    i.linux_modify(packet)
+    assert packet.verdict == "accept" and IP(packet.get_payload()).ttl == 1
+    assert valid(packet.get_payload())
+    assert i.counters()["modified"] == 1
@@ -0,0 +1,132 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+import pytest
+from scapy.all import IP, TCP, Raw, IPOption_NOP
+from polymorph.matcher import compile_conditions, bpf_bytecode, \
+    BPF_MAX_INSNS, BPF_LDX_MSH, BPF_AND, BPF_JEQ, BPF_JGT, BPF_JGE, BPF_RET
+from polymorph.packet import Packet
+from polymorph.interceptor import Interceptor
+
+
+def test_bpf_bytecode(tcp_template):
+    tcp_template.add_condition("TCP", "eq", 80, field="dstport")
+    code = bpf_bytecode(tcp_template)
+    assert code is not None
+    assert int(code.split(",")[0]) <= BPF_MAX_INSNS
+
+
+def test_bpf_bytecode_too_long(tcp_template):
+    # Every value of 'in' is a jump, the program exceeds the instructions
+    # accepted by the bpf match
+    tcp_template.add_condition("TCP", "in", list(range(1, 70)),
+                               field="dstport")
+    assert bpf_bytecode(tcp_template) is None
+    match4, _ = Interceptor.template_match(tcp_template, bpf=True)
+    assert "bpf" not in match4
+
+
+def _run_bpf(bytecode, raw):
+    """Interprets a classic BPF program of the bpf match on an IP packet."""
+    insns = [tuple(int(v) for v in insn.split())
+             for insn in bytecode.split(",")[1:]]
+    a = x = pc = 0
+    while True:
+        code, jt, jf, k = insns[pc]
+        pc += 1
+        if code & 0x07 == 0:
+            # Absolute or indirect load
+            size = {0x00: 4, 0x08: 2, 0x10: 1}[code & 0x18]
+            offset = k + (x if code & 0xe0 == 0x40 else 0)
+            if offset + size > len(raw):
+                return 0
+            a = int.from_bytes(raw[offset:offset + size], "big")
+        elif code == BPF_LDX_MSH:
+            x = 4 * (raw[k] & 0x0f)
+        elif code == BPF_AND:
+            a &= k
+        elif code == BPF_JEQ:
+            pc += jt if a == k else jf
+        elif code == BPF_JGT:
+            pc += jt if a > k else jf
+        elif code == BPF_JGE:
+            pc += jt if a >= k else jf
+        elif code == BPF_RET:
+            return k
+
+
+def _random_packets(rnd, payloads=(b"hello world",)):
+    for _ in range(400):
+        pkt = IP(src=rnd.choice(["10.0.0.1", "10.0.0.2", "11.0.0.1"]),
+                 ttl=rnd.choice([10, 32, 64, 128, 200]),
+                 options=[IPOption_NOP()] * rnd.choice([0, 4, 8])) / \
+            TCP(dport=rnd.choice([80, 81, 8080]),
+                options=[("NOP", None)] * rnd.choice([0, 4])) / \
+            Raw(rnd.choice(payloads))
+        # The parsed packet has the values of the lengths
+        yield IP(bytes(pkt))
+
+
+def test_conditions_against_reference(tcp_template):
+    tcp_template.add_condition("IP", "eq", "10.0.0.1", field="src")
+    tcp_template.add_condition("TCP", "in", [80, 8080], field="dstport")
+    tcp_template.add_condition("IP", "range", [32, 128], field="ttl")
+    tcp_template.add_condition("IP", "ne", 7, field="hdr_len")
+    match = compile_conditions(tcp_template)
+    code = bpf_bytecode(tcp_template)
+    pkt = Packet(tcp_template)
+    hits = 0
+    for ref in _random_packets(random.Random(3)):
+        raw = bytes(ref)
+        pkt.load(raw)
+        expected = ref.src == "10.0.0.1" and ref[TCP].dport in (80, 8080) \
+            and 32 <= ref.ttl <= 128 and ref.ihl != 7
+        assert match(pkt._buf, pkt._shifts) == expected
+        assert bool(_run_bpf(code, raw)) == expected
+        hits += expected
+    assert hits
+
+
+def test_mask_and_offset_conditions(tcp_template):
+    tcp_template.add_condition("IP", "mask", "0a000000", field="src",
+                               mask="ff000000")
+    tcp_template.add_condition("IP", "ne", "0a000002", offset=12)
+    match = compile_conditions(tcp_template)
+    code = bpf_bytecode(tcp_template)
+    pkt = Packet(tcp_template)
+    for ref in _random_packets(random.Random(5)):
+        raw = bytes(ref)
+        pkt.load(raw)
+        expected = ref.src == "10.0.0.1"
+        assert match(pkt._buf, pkt._shifts) == expected
+        assert bool(_run_bpf(code, raw)) == expected
+
+
+def test_payload_conditions(tcp_template):
+    tcp_template.add_condition("RAW", "eq", b"GET".hex(), offset=0)
+    tcp_template.add_condition("RAW", "contains", b"HTTP/".hex(), offset=4)
+    match = compile_conditions(tcp_template)
+    # The conditions on the payload are not translated to BPF
+    assert bpf_bytecode(tcp_template) is None
+    pkt = Packet(tcp_template)
+    payloads = [b"GET / HTTP/1.1", b"POST / HTTP/1.1", b"GET HTTP/1.1",
+                b"GET", b""]
+    for ref in _random_packets(random.Random(7), payloads):
+        pkt.load(bytes(ref))
+        load = ref[Raw].load if Raw in ref else b""
+        expected = load.startswith(b"GET") and b"HTTP/" in load[4:]
+        assert match(pkt._buf, pkt._shifts) == expected
+
+
+def test_invalid_conditions(tcp_template):
+    assert compile_conditions(tcp_template) is None
+    for condition in [
+            dict(layer="IP", op="range", value=[1, 2], field="src"),
+            dict(layer="XX", op="eq", value=1, field="src"),
+            dict(layer="IP", op="foo", value=1, field="src"),
+            dict(layer="IP", op="in", value=["00", "0000"]),
+            dict(layer="IP", op="mask", value="00", mask="ff", field="src")]:
+        with pytest.raises(ValueError):
+            compile_conditions(tcp_template, [condition])
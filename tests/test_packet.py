@@ -0,0 +1,67 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import pytest
+from scapy.all import IP, TCP, UDP, ICMP, Raw, IPOption_NOP, IPv6, \
+    IPv6ExtHdrHopByHop, IPv6ExtHdrRouting, IPv6ExtHdrDestOpt, \
+    IPv6ExtHdrFragment, AH, ICMPv6EchoRequest
+from polymorph.packet import Packet, ANCHOR_L4, ANCHOR_PAYLOAD, \
+    header_offsets
+
+
+def test_write_header_length_relocates_layers(tcp_template):
+    pkt = Packet(tcp_template)
+    pkt.load(bytes(IP(options=[IPOption_NOP()] * 4) /
+                   TCP(sport=1234, dport=80, options=[("NOP", None)] * 4) /
+                   Raw(b"data")))
+    assert pkt["TCP"]["dstport"] == 80
+    assert pkt._shifts[ANCHOR_L4] == 4
+    assert pkt._shifts[ANCHOR_PAYLOAD] == 8
+    # The TCP options become part of the payload
+    l4 = 14 + 24
+    pkt.write(l4 + 12, l4 + 13, b"\x50")
+    assert pkt._shifts[ANCHOR_PAYLOAD] == 4
+    # The IP options become part of the upper layer
+    pkt.write(14, 15, b"\x45")
+    assert pkt._shifts[ANCHOR_L4] == 0
+    assert pkt["TCP"]["srcport"] == 0x0101
+    # The rest of the header fields do not move the layers
+    pkt.write(14 + 8, 14 + 9, b"\x01")
+    assert pkt._shifts[ANCHOR_L4] == 0
+
+
+def _offsets(pkt, l4_cls):
+    raw = bytes(pkt)
+    l4 = len(raw) - len(pkt[l4_cls])
+    return raw, l4, l4 + len(pkt[l4_cls]) - len(pkt[l4_cls].payload)
+
+
+@pytest.mark.parametrize("pkt, l4_cls, proto", [
+    (IP(options=[IPOption_NOP()] * 8) /
+     TCP(options=[("MSS", 1460), ("NOP", None)] * 2) / Raw(b"data"),
+     TCP, 6),
+    (IP() / UDP() / Raw(b"data"), UDP, 17),
+    (IP() / ICMP() / Raw(b"data"), ICMP, 1),
+    (IPv6() / IPv6ExtHdrHopByHop() / IPv6ExtHdrRouting() /
+     IPv6ExtHdrDestOpt() / TCP() / Raw(b"data"), TCP, 6),
+    (IPv6() / IPv6ExtHdrFragment(offset=0) / UDP() / Raw(b"data"), UDP, 17),
+    (IPv6() / AH(nh=58, payloadlen=1) / ICMPv6EchoRequest() / Raw(b"data"),
+     ICMPv6EchoRequest, 58),
+])
+def test_header_offsets(pkt, l4_cls, proto):
+    raw, l4, payload = _offsets(pkt, l4_cls)
+    assert header_offsets(b"\x00" * 14 + raw, 14) == \
+        (14, 14 + l4, 14 + payload, proto)
+
+
+def test_header_offsets_without_upper_layer():
+    frag = bytes(IP(flags="MF", frag=8) / Raw(b"x" * 16))
+    assert header_offsets(frag, 0) == (0, None, None, None)
+    frag6 = bytes(IPv6() / IPv6ExtHdrFragment(offset=2) / Raw(b"x" * 16))
+    assert header_offsets(frag6, 0) == (0, None, None, None)
+    # The headers of other protocols are not walked
+    assert header_offsets(bytes(IP(proto=47) / Raw(b"x" * 8)), 0) == \
+        (0, 20, None, 47)
+    assert header_offsets(bytes(IP())[:19], 0) is None
+    assert header_offsets(b"\x00" * 40, 0) is None
@@ -0,0 +1,48 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+from scapy.all import Ether, IP, TCP, Raw
+from polymorph.pcap import PcapReader, PcapWriter, LINKTYPE_ETHERNET
+from polymorph.replay import Replayer, PcapRewriter
+from tests.conftest import valid
+
+
+def _padded_pcap(path):
+    """Writes a pcap with a short TCP frame padded to 60 bytes."""
+    frame = bytes(Ether() / IP(src="10.0.0.1", dst="10.0.0.2") /
+                  TCP(sport=40000, dport=80, flags="PA") / Raw(b"hello"))
+    assert len(frame) == 59
+    with PcapWriter(path, LINKTYPE_ETHERNET) as writer:
+        writer.write(0, 0, frame + b"\x00")
+
+
+def _read(path):
+    with PcapReader(path) as reader:
+        return [data for _, _, data in reader]
+
+
+def _check(frame):
+    pkt = IP(frame[14:14 + IP(frame[14:]).len])
+    assert pkt.len == 45 + 4
+    assert bytes(pkt[TCP].payload) == b"hello!!!!"
+    assert valid(frame[14:14 + pkt.len])
+    # The padding of the link layer is kept after the datagram
+    assert frame[14 + pkt.len:] == b"\x00"
+
+
+def test_replay_padded_frame(tcp_template, tmp_path):
+    tcp_template.add_rule("replace", "RAW", "6f21212121", old="6f")
+    _padded_pcap(str(tmp_path / "in.pcap"))
+    Replayer(tcp_template).replay(str(tmp_path / "in.pcap"),
+                                  str(tmp_path / "out.pcap"))
+    _check(_read(str(tmp_path / "out.pcap"))[0])
+
+
+def test_rewriter_padded_frame(tcp_template, tmp_path):
+    tcp_template.add_rule("replace", "RAW", "6f21212121", old="6f")
+    _padded_pcap(str(tmp_path / "in.pcap"))
+    summary = PcapRewriter(tcp_template, workers=1).rewrite(
+        str(tmp_path / "in.pcap"), str(tmp_path / "out.pcap"))
+    assert summary["written"] == 1
+    _check(_read(str(tmp_path / "out.pcap"))[0])
@@ -0,0 +1,84 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import pytest
+from scapy.all import IP, TCP, UDP, Raw, IPOption_NOP
+from polymorph.interceptor import Interceptor
+from polymorph.replay import ReplayPacket
+from polymorph.rules import compile_rules
+from tests.conftest import valid
+
+
+def _intercept(template, raw):
+    packet = ReplayPacket(raw)
+    Interceptor(template).linux_modify(packet)
+    return packet
+
+
+def test_field_rules(tcp_template):
+    tcp_template.add_rule("set", "IP", "10.9.9.9", field="dst")
+    tcp_template.add_rule("add", "IP", -1, field="ttl")
+    # The integer fields wrap around their width
+    tcp_template.add_rule("add", "TCP", 10, field="dstport")
+    raw = bytes(IP(src="10.0.0.1", ttl=64, options=[IPOption_NOP()] * 4) /
+                TCP(dport=65530, options=[("NOP", None)] * 4) / Raw(b"x"))
+    packet = _intercept(tcp_template, raw)
+    result = IP(packet.get_payload())
+    assert packet.verdict == "accept"
+    assert result.dst == "10.9.9.9" and result.ttl == 63
+    assert result[TCP].dport == 4
+    assert valid(packet.get_payload())
+
+
+def test_payload_rules(tcp_template):
+    tcp_template.add_rule("replace", "RAW", b"hack".hex(), old=b"beef".hex(),
+                          count=1)
+    tcp_template.add_rule("regex", "RAW", "pass=XX", old="pass=[a-z]+")
+    tcp_template.add_rule("set", "RAW", b"AB".hex(), offset=1)
+    raw = bytes(IP(options=[IPOption_NOP()] * 4) / TCP(dport=80) /
+                Raw(b"beef beef pass=secret"))
+    packet = _intercept(tcp_template, raw)
+    result = IP(packet.get_payload())
+    assert bytes(result[TCP].payload) == b"hABk beef pass=XX"
+    assert result.len == len(packet.get_payload())
+    assert valid(packet.get_payload())
+
+
+def test_rules_change_the_lengths(udp_template):
+    udp_template.add_dictionary("words", {b"abc": b"ABCDE", b"xyz": b""})
+    udp_template.add_rule("replace", "RAW", b"1234".hex(), old=b"12".hex())
+    udp_template.add_rule("replace_all", value="words")
+    raw = bytes(IP() / UDP(sport=40000, dport=53) / Raw(b"12 abc xyz abc"))
+    packet = _intercept(udp_template, raw)
+    result = IP(packet.get_payload())
+    assert bytes(result[UDP].payload) == b"1234 ABCDE  ABCDE"
+    assert result.len == len(packet.get_payload())
+    assert result[UDP].len == result.len - 20
+    assert valid(packet.get_payload())
+
+
+def test_conditional_rules(tcp_template):
+    tcp_template.add_rule("drop", conditions=[
+        dict(layer="IP", field="src", op="eq", value="6.6.6.6")])
+    tcp_template.add_rule("set", "IP", 1, field="ttl", conditions=[
+        dict(layer="TCP", field="dstport", op="eq", value=22)])
+    packet = _intercept(tcp_template, bytes(IP(src="6.6.6.6") / TCP()))
+    assert packet.verdict == "drop"
+    packet = _intercept(tcp_template, bytes(IP(ttl=9) / TCP(dport=22)))
+    assert packet.verdict == "accept"
+    assert IP(packet.get_payload()).ttl == 1
+    raw = bytes(IP(ttl=9) / TCP(dport=80))
+    packet = _intercept(tcp_template, raw)
+    assert packet.verdict == "accept" and packet.get_payload() == raw
+
+
+def test_invalid_rules(tcp_template):
+    assert compile_rules(tcp_template) is None
+    for rule in [dict(action="add", layer="IP", field="src", value=1),
+                 dict(action="replace", layer="IP", field="ttl", old="00",
+                      value="01"),
+                 dict(action="replace_all", value="missing"),
+                 dict(action="zap")]:
+        with pytest.raises(ValueError):
+            compile_rules(tcp_template, [rule])
@@ -0,0 +1,36 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+from polymorph.stats import Histogram, SUB_BUCKETS, BUCKETS
+
+
+def test_buckets():
+    last = -1
+    for value in list(range(5000)) + [2**40 + 12345, 2**64 - 1]:
+        index = Histogram._index(value)
+        assert 0 <= index < BUCKETS
+        # The highest value of the bucket bounds the value with a relative
+        # error lower than 1 / SUB_BUCKETS
+        assert value <= Histogram._value(index)
+        assert Histogram._value(index) - value <= value / SUB_BUCKETS
+        assert Histogram._index(Histogram._value(index)) == index
+        assert index >= last
+        last = index
+
+
+def test_percentiles():
+    rnd = random.Random(7)
+    values = [int(rnd.lognormvariate(10, 2)) for _ in range(10000)]
+    hist = Histogram()
+    for value in values:
+        hist.record(value)
+    values.sort()
+    for p in [1, 25, 50, 90, 99, 99.9, 100]:
+        exact = values[int(max(1, -(-len(values) * p // 100))) - 1]
+        assert exact <= hist.percentile(p) <= exact * (1 + 1 / SUB_BUCKETS)
+    assert hist.percentile(100) == hist.max == values[-1]
+    assert hist.count == len(values)
+    assert hist.mean() == sum(values) / len(values)
+    assert Histogram().dict()["p99"] == 0
@@ -0,0 +1,73 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+from scapy.all import Ether, IP, UDP, Raw
+from polymorph.converter import Converter
+from polymorph.ftype import Ftype
+from polymorph.packet import Packet
+from polymorph.template import Template
+from tests.conftest import IP_FIELDS, UDP_FIELDS, _layer
+
+# The payload is a length, a variable field and a trailer
+PAYLOAD_FIELDS = [("len", 42, 1, Ftype.FT_INT_BE, None),
+                  ("data", 43, 3, Ftype.FT_BYTES, None)]
+
+
+def _struct_template():
+    raw = bytes(Ether() / IP(src="10.0.0.1", dst="10.0.0.2") /
+                UDP(sport=40000, dport=53) / Raw(b"\x03abcXY"))
+    template = Template("test", raw=raw)
+    template.addlayer(_layer("ETH", raw, 0, 14, []))
+    template.addlayer(_layer("IP", raw, 14, 34, IP_FIELDS))
+    template.addlayer(_layer("UDP", raw, 34, 42, UDP_FIELDS))
+    payload = _layer("RAW", raw, 42, len(raw), PAYLOAD_FIELDS)
+    payload.add_struct("data", ["len"], "43", "this.len")
+    template.addlayer(payload)
+    return template
+
+
+def test_struct_parser_matches_construct():
+    template = _struct_template()
+    layer = template.getlayer("RAW")
+    parser, struct = layer.get_struct_parser("data"), layer.get_struct("data")
+    pkt = Packet(template)
+    rnd = random.Random(7)
+    for _ in range(100):
+        data = bytes(rnd.randrange(256) for _ in range(rnd.randrange(40)))
+        pkt.load(bytes(IP(src="10.0.0.1", dst="10.0.0.2") /
+                       UDP(sport=40000, dport=53) /
+                       Raw(bytes([len(data)]) + data + b"XY")))
+        raw = bytes(pkt._buf)
+        start, stop = parser(raw)
+        assert raw[start:stop] == struct.parse(raw)["data"] == data
+        assert pkt["RAW"]["data"] == data
+        # The setter writes on the position calculated by the parser
+        pkt["RAW"]["data"] = bytes(len(data))
+        assert pkt._buf[start:stop] == bytes(len(data))
+        assert pkt._buf[stop:] == b"XY"
+
+
+def test_compiled_accessors_match_converter(udp_template):
+    cv = Converter()
+    pkt = Packet(udp_template)
+    rnd = random.Random(3)
+    for _ in range(100):
+        pkt.load(bytes(IP(src="10.0.0.%d" % rnd.randrange(256),
+                          dst="10.0.0.2", ttl=rnd.randrange(256),
+                          ihl=5, tos=rnd.randrange(256)) /
+                       UDP(sport=rnd.randrange(65536), dport=53) /
+                       Raw(b"abc")))
+        for lname in ["IP", "UDP"]:
+            tlayer = udp_template.getlayer(lname)
+            for field in tlayer.fields:
+                fraw = bytes(pkt._buf[field.slice])
+                assert pkt[lname][field.name] == cv.get_frepr(
+                    field.type, fraw, field.size, field.mask, field.name)
+        # The binary fields keep the rest of the bits of their byte
+        pkt["IP"]["hdr_len"] = 5
+        assert pkt["IP"]["version"] == 4
+        value = rnd.randrange(256)
+        pkt["IP"]["ttl"] = value
+        assert pkt._buf[22] == value
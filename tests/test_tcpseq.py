@@ -0,0 +1,53 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+from scapy.all import IP, TCP, UDP, Raw
+from polymorph.interceptor import Interceptor
+from polymorph.replay import ReplayPacket
+from tests.conftest import valid
+
+
+def _insert(packet):
+    """Duplicates the payload of the packet."""
+    start = packet._shifts[2] + packet._tstarts[2]
+    packet.write(start, len(packet._buf), bytes(packet._buf[start:]) * 2)
+    return packet
+
+
+def _forward(interceptor, raw):
+    packet = ReplayPacket(raw)
+    interceptor.linux_modify(packet)
+    return IP(packet.get_payload()), packet.get_payload()
+
+
+def test_tcp_seq_translation(tcp_template):
+    i = Interceptor(tcp_template, tcp_seq=True)
+    i._functions = [_insert]
+    pkt, raw = _forward(i, bytes(
+        IP(src="10.0.0.1", dst="10.0.0.2") /
+        TCP(sport=40000, dport=80, flags="PA", seq=1000) / Raw(b"abcd")))
+    assert pkt.len == len(raw) and valid(raw)
+    assert pkt[TCP].seq == 1000 and bytes(pkt[TCP].payload) == b"abcdabcd"
+    i._functions = []
+    pkt, raw = _forward(i, bytes(
+        IP(src="10.0.0.1", dst="10.0.0.2") /
+        TCP(sport=40000, dport=80, flags="PA", seq=1004) / Raw(b"ef")))
+    assert pkt[TCP].seq == 1008 and valid(raw)
+    pkt, raw = _forward(i, bytes(
+        IP(src="10.0.0.2", dst="10.0.0.1") /
+        TCP(sport=80, dport=40000, flags="A", ack=1010,
+            options=[("SAck", (1008, 1010))])))
+    assert pkt[TCP].ack == 1006 and valid(raw)
+    assert pkt[TCP].options[0] == ("SAck", (1004, 1006))
+
+
+def test_tcp_seq_udp_lengths(udp_template):
+    i = Interceptor(udp_template, tcp_seq=True)
+    i._functions = [_insert]
+    pkt, raw = _forward(i, bytes(
+        IP(src="10.0.0.1", dst="10.0.0.2") /
+        UDP(sport=40000, dport=53) / Raw(b"abcd")))
+    assert pkt.len == len(raw) and pkt[UDP].len == len(raw) - 20
+    assert bytes(pkt[UDP].payload) == b"abcdabcd"
+    assert valid(raw)
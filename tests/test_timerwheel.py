@@ -0,0 +1,42 @@
+# File from polymorph project
+# Copyright (C) 2020 Santiago Hernandez Ramos <shramos@protonmail.com>
+# For more information about the project: https://github.com/shramos/polymorph
+
+import random
+from polymorph.timerwheel import TimerWheel
+
+
+def test_timers_expire_in_order():
+    wheel = TimerWheel(tick=0.001, slots=16)
+    start = wheel._time
+    rnd = random.Random(11)
+    # Some delays need several turns of the wheel
+    delays = [rnd.randrange(1, 100) / 1000 for _ in range(300)]
+    for n, delay in enumerate(delays):
+        wheel.add(delay, (delay, n))
+    assert len(wheel) == len(delays)
+    expired = []
+    for ms in range(1, 103):
+        now = start + ms / 1000 + 0.0005
+        batch = [delay for delay, n in wheel.advance(now)]
+        for delay in batch:
+            # The timers do not expire early, and at most a tick late
+            assert delay <= now - start < delay + 0.0025
+        # Timers of different ticks expire in order
+        if batch and expired:
+            assert min(batch) >= max(expired)
+        expired.extend(batch)
+    assert sorted(expired) == sorted(delays)
+    assert len(wheel) == 0
+
+
+def test_timer_does_not_expire_early():
+    wheel = TimerWheel(tick=0.001, slots=8)
+    start = wheel._time
+    wheel.add(0.0205, "item")
+    assert wheel.advance(start + 0.0195) == []
+    assert wheel.advance(start + 0.0225) == ["item"]
+    # An empty wheel restarts from the current time
+    assert wheel.advance(start + 1) == []
+    wheel.add(0, "now")
+    assert wheel.advance(start + 1.0015) == ["now"]